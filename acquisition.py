@@ -0,0 +1,387 @@
+"""
+Acquisition of samples from the Arduino through an already open serial port.
+
+The reads wait in select() on the file descriptor of the port, so the acquisition thread wakes up as soon as bytes arrive,
+and on a pipe written by Acquisition.wake(), so a STOP does not have to wait for a read timeout.
+"""
+import io
+import os
+import selectors
+import threading
+import time
+from collections import namedtuple
+import serial
+from instrumentation import AcquisitionStats, AlarmLatency
+from metrics import BreathDetector, measured_metrics
+from telemetry import FrameDecoder, POLLED, STREAM, MODES
+
+Batch = namedtuple('Batch', ['times', 'samples', 'metrics', 'breaths', 'alarm', 'gaps'])
+Batch.__doc__ = '''
+Samples received in one read, published by the acquisition thread to the GUI: times (seconds since START, one per sample),
+samples (list of telemetry.Sample), metrics (metrics.Metrics measured by the Arduino in the last sample), breaths (list of
+metrics.Breath completed by these samples), alarm (names of the alarm rules that went off, empty if none) and gaps (samples
+lost before some of these samples, see telemetry.SequenceChecker.check(), empty if none).
+'''
+
+class SerialReader(object):
+        '''
+        Reads samples from the Arduino using one of the two acquisition modes:
+        - POLLED: write "1" every poll_interval seconds and wait for the answer. One sample per request, the sample rate is
+          limited by the interval and the serial round trip.
+        - STREAM: the Arduino is told once to send continuously. Each call to read() waits until data arrives and then drains
+          everything waiting in the input buffer with a single read, so the sample rate is set by the device.
+        After each read, read_time and parse_time hold the time.perf_counter() at which the bytes were received and decoded.
+
+        The waits are done in select() on the port and on wake (the read end of a pipe): read() returns as soon as the first
+        byte arrives, or with no samples as soon as something is written to the pipe. Ports without file descriptor (e.g.
+        replay.ReplayPort, or Windows) are read with the blocking reads and sleeps of serial.Serial.
+
+        :param port: open serial.Serial instance
+        :param mode: POLLED or STREAM
+        :param poll_interval: seconds between requests in POLLED mode
+        :param decoder: telemetry.FrameDecoder to use, to keep its counters across readers (a new one by default)
+        :param wake: file descriptor that interrupts the waits when it is readable (it is drained), None if they can not be interrupted
+        '''
+
+        def __init__(self, port, mode=POLLED, poll_interval=0.06, decoder=None, wake=None):
+                if mode not in MODES:
+                        raise ValueError("Unknown acquisition mode %r, expected one of %s" % (mode, ", ".join(MODES)))
+                self.port = port
+                self.mode = mode
+                self.poll_interval = poll_interval
+                self.decoder = FrameDecoder() if decoder is None else decoder
+                self.wake = wake
+                self.read_time = None
+                self.parse_time = None
+                self.woken = False #The last wait was interrupted through wake
+                self.next_poll = None #time.monotonic() of the next request in POLLED mode
+                self._selectors = None #(selector of the port and wake, selector of wake alone), None without file descriptor
+                try:
+                        fileno = port.fileno()
+                except (AttributeError, io.UnsupportedOperation):
+                        fileno = None
+                if fileno is not None:
+                        selector, sleeper = selectors.DefaultSelector(), selectors.DefaultSelector()
+                        selector.register(fileno, selectors.EVENT_READ, port)
+                        if wake is not None:
+                                selector.register(wake, selectors.EVENT_READ, None)
+                                sleeper.register(wake, selectors.EVENT_READ, None)
+                        self._selectors = (selector, sleeper)
+
+        def close(self):
+                """Release the selectors (the port is closed by its owner)."""
+                if self._selectors is not None:
+                        for selector in self._selectors:
+                                selector.close()
+                        self._selectors = None
+
+        def _wait(self, timeout, port=True):
+                """
+                Wait up to timeout seconds for data from the port (or, if port is False, just sleep). Return True if there is
+                data to read, False if the time is over or the wait was interrupted through wake (then woken is True).
+                """
+                if self._selectors is None:
+                        if not port:
+                                time.sleep(timeout)
+                        return port
+                selector = self._selectors[0 if port else 1]
+                if not selector.get_map(): #Sleeping without wake
+                        time.sleep(timeout)
+                        return False
+                for key, events in selector.select(timeout):
+                        if key.data is None:
+                                try:
+                                        while os.read(self.wake, 64):
+                                                pass
+                                except BlockingIOError:
+                                        pass
+                                self.woken = True
+                                return False
+                        return True
+                return False
+
+        def start(self):
+                """Discard whatever the Arduino sent before and get it ready to send samples in the selected mode."""
+                self.port.flushInput() #Discard all the contents of the input buffer, to be sure that there is not any previous caracter
+                self.decoder.reset()
+                if self.mode == STREAM:
+                        self.port.write("S\n".encode('utf-8'))
+                else:
+                        #We need to make sure that Arduino is sending reliable data, therefore, we wait for it to send two values and then keep reading continuosly
+                        self.woken = False
+                        for i in range(2):
+                                self._wait(self.poll_interval, port=False)
+                                if self.woken:
+                                        return
+                                self._poll()
+
+        def read(self):
+                """
+                Return the list of samples received since the previous call. It can be empty if the read timed out or was
+                interrupted through wake.
+                """
+                self.woken = False
+                port = self.port
+                if self.mode == STREAM:
+                        if not self._wait(port.timeout): #Wake up as soon as there is something to read
+                                return []
+                        data = port.read(max(1, port.in_waiting))
+                        self.read_time = time.perf_counter()
+                        if port.in_waiting:
+                                data += port.read(port.in_waiting)
+                        return self._decode(data)
+                #One request every poll_interval (60 ms, due to the RPI), whatever the time taken by the answer
+                now = time.monotonic()
+                if self.next_poll is None or self.next_poll < now - self.poll_interval: #First request, or late: do not make up for it
+                        self.next_poll = now
+                if self.next_poll > now:
+                        self._wait(self.next_poll - now, port=False)
+                        if self.woken:
+                                return []
+                self.next_poll += self.poll_interval
+                return self._poll()
+
+        def _poll(self):
+                """Ask the Arduino for a new value and return the samples decoded from its answer."""
+                decoder = self.decoder
+                rejected = decoder.malformed + decoder.crc_errors
+                port = self.port
+                port.write("1".encode('utf-8')) #Write "1" to the Arduino to receive data from it.
+                deadline = None if port.timeout is None else time.monotonic() + port.timeout
+                samples = []
+                while not samples:
+                        if not self._wait(None if deadline is None else max(0.0, deadline - time.monotonic())):
+                                break
+                        data = port.read(max(1, port.in_waiting)) #Blocks until the answer arrives or the timeout expires (without selector)
+                        if not data:
+                                break
+                        self.read_time = time.perf_counter()
+                        samples = self._decode(data)
+                        if decoder.malformed + decoder.crc_errors != rejected: #The answer was corrupted, do not wait for more data
+                                break
+                return samples
+
+        def _decode(self, data):
+                decoder = self.decoder
+                rejected = decoder.malformed + decoder.crc_errors
+                samples = decoder.feed(data)
+                self.parse_time = time.perf_counter()
+                if decoder.malformed + decoder.crc_errors != rejected:
+                        print("Discarded telemetry from the Arduino (%d malformed, %d CRC errors so far): %s" % (decoder.malformed, decoder.crc_errors, decoder.last_error))
+                return samples
+
+def settings_command(mode, frequency, tidal_volume, insp_pause, IE_or_trigger, pip):
+        """
+        Command that starts the Arduino with the given settings. mode is "C" (continuous mandatory ventilation, the fifth
+        value is the I:E setting) or "P"/"F" (assisted control with pressure/flow trigger, the fifth value is the trigger).
+        """
+        return (mode+','+str(frequency)+','+str(tidal_volume)+','+str(insp_pause)+','+str(IE_or_trigger)+','+str(pip)+'\n')
+
+class Acquisition(object):
+        '''
+        Acquisition loop of one Arduino, without any GUI: it is run by the worker thread of the main window (readArduino())
+        and by the headless mode.
+
+        Each read is turned into a Batch by process(): the samples get their times, are fed to the breath detector and the
+        samples and breaths are checked by the alarm rules. If the serial port fails, the loop waits for the connection manager to open it again and sends
+        the Arduino its settings again, since it reboots when the port is opened.
+
+        :param connection: connection.SerialConnection of the Arduino
+        :param mode: POLLED or STREAM
+        :param start_time: time.time() when the ventilation was started, the sample times are relative to it
+        :param alarms: alarms.AlarmEngine with the rules and settings to check (None disables the alarms)
+        :param on_alarm: function called to turn the alarm on when a rule goes off
+        :param settings: function returning the command that starts the Arduino with the current settings
+        :param on_reconnect: optional function called with the new port after a reconnection
+        :param recorder: optional recorder.SessionRecorder that gets every batch, from the acquisition thread
+        :param publisher: optional publisher.TelemetryPublisher that gets every batch, from the acquisition thread
+        :param clock: optional function returning the seconds since start_time, instead of the wall clock (e.g. replay.SessionReplay.clock)
+        :param latency: instrumentation.AlarmLatency where the latency of every alarm is added (a new one if None)
+        :param stats: instrumentation.AcquisitionStats where the reads, decoding errors and alarms are counted (a new one if None)
+        '''
+
+        def __init__(self, connection, mode=POLLED, start_time=None, alarms=None, on_alarm=None, settings=None, on_reconnect=None, recorder=None, clock=None, latency=None,
+                        publisher=None, stats=None):
+                self.connection = connection
+                self.mode = mode
+                self.start_time = time.time() if start_time is None else start_time
+                self.alarms = alarms
+                self.on_alarm = on_alarm
+                self.settings = settings
+                self.on_reconnect = on_reconnect
+                self.recorder = recorder
+                self.publisher = publisher
+                self.clock = clock or (lambda: time.time() - self.start_time)
+                self.latency = AlarmLatency() if latency is None else latency
+                self.stats = AcquisitionStats() if stats is None else stats
+                self.breath_detector = BreathDetector() #Mean pressure, compliance and minute ventilation are derived once per breath from the waveform
+                self.resistance_value = None #Airway resistance of the last breath
+                self.last_time = self.clock()
+                #time.perf_counter() at start_time, for the device timestamps. With another clock (a replay) they are mapped onto it instead
+                self.perf_origin = time.perf_counter() - self.last_time if clock is None else None
+                self.reader = None
+                self._wake = None #Pipe that wakes the reads up, while run() is running
+                self._wake_lock = threading.RLock() #Reentrant: wake() can be called from a signal handler of the thread of run()
+                self._wake_pending = False #wake() was called before run() created the pipe
+                self.resync()
+
+        def process(self, samples, now=None, read_time=None, parse_time=None):
+                """
+                Return the Batch of the samples of one read, received at now (seconds since start_time), turning on the alarm if needed.
+                If read_time and parse_time (time.perf_counter() when the samples were read and decoded) are given, the latency of
+                the alarms is added to self.latency and recorded, and the samples with device timestamps get the time at which
+                they were measured (see clock.DeviceClock, mapped onto the clock given to the constructor if any) instead of being
+                spread between the previous read and now.
+                """
+                if now is None:
+                        now = self.clock()
+                decoder = self.stats.decoder
+                rejected = decoder.malformed + decoder.crc_errors
+                gaps = self.stats.sequence.check(samples, now, rejected - self.rejected)
+                self.rejected = rejected
+                if read_time is not None and all(sample.device_time is not None for sample in samples):
+                        clock = self.stats.clock
+                        if self.perf_origin is None:
+                                clock.update(samples[-1].device_time, now)
+                                origin = 0.0
+                        else:
+                                clock.update(samples[-1].device_time, read_time)
+                                origin = self.perf_origin
+                        times = []
+                        previous = self.last_time
+                        for sample in samples: #Never before the previous sample, the estimation of the clock can move back a little
+                                t = clock.host_time(sample.device_time) - origin
+                                previous = t if t > previous else previous
+                                times.append(previous)
+                        self.last_time = previous
+                else:
+                        #The samples of one read (and the ones lost between them) arrived between the previous read and now, spread their times in that interval
+                        lost = dict(gaps)
+                        position = []
+                        shift = 0
+                        for k in range(len(samples)):
+                                shift += lost.get(k, 0)
+                                position.append(k + shift)
+                        slots = position[-1] + 1
+                        step = (now - self.last_time) / slots
+                        times = [now - step * (slots - 1 - k) for k in position]
+                        self.last_time = now
+                breaths = self.breath_detector.feed(times, samples)
+                if breaths:
+                        self.resistance_value = breaths[-1].metrics.resistance
+                alarm = self.alarms.evaluate(times, samples, breaths, loss=self.stats.sequence.loss()) if self.alarms is not None else []
+                if read_time is not None:
+                        self.stats.add_read(read_time, len(samples))
+                if alarm: #If any rule went off, then, turn on the alarm.
+                        for name in alarm:
+                                self.stats.add_alarm(name)
+                        evaluated = time.perf_counter()
+                        self._alarm()
+                        actuated = time.perf_counter()
+                        if read_time is not None:
+                                for name in alarm:
+                                        event = self.latency.add(now, name, read_time, parse_time, evaluated, actuated)
+                                        if self.recorder is not None:
+                                                self.recorder.record_alarm(event)
+                                        if self.publisher is not None:
+                                                self.publisher.publish_alarm(event)
+                return Batch(times, samples, measured_metrics(samples[-1]), breaths, alarm, gaps)
+
+        def _alarm(self):
+                if self.on_alarm is not None:
+                        self.on_alarm()
+
+        def wake(self):
+                """
+                Interrupt the read that run() is waiting for, so that it checks stopped() now instead of after the read timeout.
+                It can be called from any thread and from signal handlers.
+                """
+                with self._wake_lock:
+                        if self._wake is None:
+                                self._wake_pending = True
+                                return
+                        try:
+                                os.write(self._wake[1], b'\0')
+                        except BlockingIOError: #The pipe is full, the reader will wake up anyway
+                                pass
+
+        def resync(self):
+                """
+                The port was (re)opened: the sequence numbers and the device clock start again, and what was rejected before is not
+                a gap of the next read.
+                """
+                decoder = self.stats.decoder
+                self.stats.sequence.reset()
+                self.stats.clock.reset()
+                self.rejected = decoder.malformed + decoder.crc_errors
+
+        def _open(self, timeout):
+                """Get the port from the connection manager and start reading from it. Return False if it is not open yet."""
+                port = self.connection.get(timeout)
+                if port is None:
+                        return False
+                if self.reader is not None and self.settings is not None: #Reconnected, the Arduino rebooted
+                        port.write(self.settings().encode('utf-8'))
+                        if self.on_reconnect is not None:
+                                self.on_reconnect(port)
+                if self.reader is not None:
+                        self.reader.close()
+                self.reader = SerialReader(port, self.mode, decoder=self.stats.decoder, wake=self._wake[0])
+                self.reader.start()
+                self.resync()
+                return True
+
+        def run(self, publish, stopped):
+                """
+                Read samples until stopped() returns True, calling publish(batch) for every read that returned samples.
+                Errors are printed and the loop keeps working. Call wake() after stopped() becomes True to stop without
+                waiting for the read in progress.
+                """
+                wake = os.pipe()
+                for fd in wake:
+                        os.set_blocking(fd, False)
+                with self._wake_lock:
+                        self._wake = wake
+                        if self._wake_pending:
+                                self._wake_pending = False
+                                os.write(self._wake[1], b'\0')
+                try:
+                        self._run(publish, stopped)
+                finally:
+                        if self.reader is not None:
+                                self.reader.close()
+                        with self._wake_lock:
+                                self._wake = None
+                        for fd in wake:
+                                os.close(fd)
+
+        def _run(self, publish, stopped):
+                reconnect = True
+                self.stats.start()
+                while True:
+                        try:
+                                samples = []
+                                if reconnect:
+                                        reconnect = not self._open(1)
+                                else:
+                                        samples = self.reader.read()
+                                if samples:
+                                        batch = self.process(samples, read_time=self.reader.read_time, parse_time=self.reader.parse_time)
+                                        if self.recorder is not None:
+                                                self.recorder.record(batch)
+                                        if self.publisher is not None:
+                                                self.publisher.publish(batch)
+                                        publish(batch)
+                        except (serial.SerialException, OSError) as e: #The Arduino was unplugged, keep waiting until it is back
+                                print("Lost connection with the Arduino: %s" % e)
+                                if self.reader is not None:
+                                        self.connection.lost(self.reader.port)
+                                self.stats.lost()
+                                self.breath_detector.reset()
+                                reconnect = True
+                        except Exception as e: #If there is any error, the system must keep working, therefore, we print the error
+                                self.stats.errors += 1
+                                print(e)
+                        if stopped():
+                                self.stats.stop()
+                                break
@@ -0,0 +1,174 @@
+"""
+Alarm rules checked on the samples and breaths received from the Arduino.
+
+The rules are data (see Rule and DEFAULT_RULES) evaluated by AlarmEngine over all the samples of a read at once.
+"""
+import threading
+from collections import namedtuple
+import numpy as np
+from telemetry import pvf_to_error_flags
+
+HIGH, MEDIUM, LOW = 1, 2, 3 #Priorities
+ABOVE, BELOW, OUTSIDE = 'above', 'below', 'outside' #Conditions
+SAMPLE, BREATH, LINK = 'sample', 'breath', 'link' #Sources
+MODES = ('C', 'P', 'F') #Continuous mandatory ventilation, assisted control with pressure/flow trigger
+
+Rule = namedtuple('Rule', ['name', 'source', 'field', 'condition', 'setting', 'margin', 'modes', 'priority', 'debounce', 'hysteresis', 'latching'])
+Rule.__doc__ = '''
+One alarm condition:
+        - source: SAMPLE (field of telemetry.Sample), BREATH (field of the metrics.Metrics of each breath) or LINK (field
+          'loss': fraction of the samples lost recently, see telemetry.SequenceChecker.loss())
+        - condition: ABOVE (value > limit + margin), BELOW (value < limit - margin) or OUTSIDE (|value - limit| > margin), where
+          limit is the ventilation setting named setting, or setting itself if it is a number. Rules whose setting is not
+          set (None) are not checked.
+        - modes: ventilation modes in which the rule is checked
+        - priority: HIGH, MEDIUM or LOW
+        - debounce: seconds that the condition has to hold before the alarm goes off (0: the first sample)
+        - hysteresis: once on, the alarm goes off when the value is back hysteresis units inside the limit
+        - latching: once on, the alarm stays on until it is reset (the alarm button), even if the value is back
+'''
+
+DEFAULT_RULES = (
+        Rule('pip_high', SAMPLE, 'pip', ABOVE, 'pip', 0, MODES, HIGH, 0.1, 1.0, True),
+        Rule('sensor_error', SAMPLE, 'error_pvf', ABOVE, 0, 0, MODES, HIGH, 0.0, 0.0, True),
+        #Tidal volume of each breath measured from the flow (the volume of the samples is below the setting during the expiration)
+        Rule('volume_low', BREATH, 'tidal_volume', BELOW, 'tidal_volume', 40, MODES, MEDIUM, 0.0, 10.0, False),
+        Rule('volume_high', BREATH, 'tidal_volume', ABOVE, 'tidal_volume', 20, MODES, MEDIUM, 0.0, 10.0, False),
+        #In assisted control the I:E is set by the patient, it is not checked
+        Rule('ie_mismatch', SAMPLE, 'IE', OUTSIDE, 'IE', 0.2, ('C',), MEDIUM, 1.0, 0.05, False),
+        Rule('resistance_high', BREATH, 'resistance', ABOVE, 'resistance_limit', 0, MODES, MEDIUM, 0.0, 0.0, False),
+        #More than 10% of the telemetry lost over the last seconds: the waveform and the other alarms can not be trusted
+        Rule('data_loss', LINK, 'loss', ABOVE, 0.1, 0, MODES, MEDIUM, 0.5, 0.05, False),
+)
+
+#Sample fields that are not numbers, converted before comparing them
+COLUMNS = {'error_pvf': pvf_to_error_flags}
+
+class AlarmEngine(object):
+        '''
+        Evaluates alarm rules over the batches of samples and breaths of the acquisition.
+
+        The values of each field are compared with NumPy for the whole batch, and the state of each rule (when its condition
+        started to hold, whether it is on) is carried from one batch to the next, so debounce and hysteresis work across reads.
+        evaluate() runs in the acquisition thread; active() and priority() can be called from any other (the GUI).
+
+        :param rules: Rule instances, DEFAULT_RULES by default
+        '''
+
+        def __init__(self, rules=DEFAULT_RULES):
+                self.rules = list(rules)
+                self.mode = None
+                self.settings = {}
+                self.on = {} #Name of the rules that are on: time at which they went off
+                self.since = {} #Name of the rules whose condition holds at the end of the last batch: time since it holds
+                self.raised = 0 #Alarms that went off
+                self._reset = False
+                self._lock = threading.Lock() #Held by evaluate() while it changes on and since
+
+        def configure(self, mode, **settings):
+                """Set the ventilation mode ("C", "P" or "F") and the settings (pip, tidal_volume, IE, resistance_limit...)."""
+                self.mode = mode
+                self.settings = settings
+
+        def reset(self):
+                """Turn off every alarm (the alarm button). It can be called from any thread, it is applied in the next evaluate()."""
+                self._reset = True
+
+        def active(self):
+                """Names of the rules that are on, highest priority first."""
+                priority = {rule.name: rule.priority for rule in self.rules}
+                with self._lock:
+                        on = dict(self.on)
+                return sorted(on, key=lambda name: (priority.get(name, LOW), on[name]))
+
+        def priority(self):
+                """Highest priority of the rules that are on, None if none is."""
+                with self._lock:
+                        on = set(self.on)
+                priorities = [rule.priority for rule in self.rules if rule.name in on]
+                return min(priorities) if priorities else None
+
+        def evaluate(self, times, samples, breaths=(), loss=None):
+                """
+                Check the samples (received at times), breaths and loss (fraction of the samples lost, None if unknown: the LINK
+                rules are not checked). Return the names of the rules that went off.
+                """
+                with self._lock:
+                        return self._evaluate(times, samples, breaths, loss)
+
+        def _evaluate(self, times, samples, breaths, loss):
+                if self._reset:
+                        self._reset = False
+                        self.on.clear()
+                        self.since.clear()
+                sample_times = np.asarray(times, dtype=float)
+                breath_times = np.array([breath.start + breath.inspiration + breath.expiration for breath in breaths], dtype=float)
+                columns = {}
+                link = {'loss': loss} #Values of the LINK fields
+                raised = []
+                for rule in self.rules:
+                        if self.mode not in rule.modes:
+                                continue
+                        limit = self.settings.get(rule.setting) if isinstance(rule.setting, str) else rule.setting
+                        if limit is None:
+                                continue
+                        if rule.source == SAMPLE:
+                                if rule.field not in columns:
+                                        convert = COLUMNS.get(rule.field, float)
+                                        columns[rule.field] = np.fromiter((convert(getattr(sample, rule.field)) for sample in samples), float, len(samples))
+                                t, values = sample_times, columns[rule.field]
+                        elif rule.source == BREATH:
+                                t = breath_times
+                                values = np.array([getattr(breath.metrics, rule.field) for breath in breaths], dtype=float) #None becomes NaN
+                        else:
+                                if link[rule.field] is None:
+                                        continue
+                                t, values = sample_times, np.full(len(sample_times), link[rule.field])
+                        if len(values) and self._update(rule, t, values, float(limit)):
+                                raised.append(rule.name)
+                self.raised += len(raised)
+                return raised
+
+        def _update(self, rule, t, values, limit):
+                """Update the state of rule with the values received at times t. Return True if the alarm went off."""
+                if rule.condition == ABOVE:
+                        bad = values > limit + rule.margin
+                        back = values <= limit + rule.margin - rule.hysteresis
+                elif rule.condition == BELOW:
+                        bad = values < limit - rule.margin
+                        back = values >= limit - rule.margin + rule.hysteresis
+                else:
+                        deviation = np.abs(values - limit)
+                        bad = deviation > rule.margin
+                        back = deviation <= rule.margin - rule.hysteresis
+                #Time at which the condition started to hold, for every sample where it holds (NaN values never hold nor release)
+                n = len(values)
+                index = np.arange(n)
+                last_good = np.maximum.accumulate(np.where(bad, -1, index))
+                since = self.since.get(rule.name, t[0])
+                start = np.where(last_good < 0, since, t[np.minimum(last_good + 1, n - 1)])
+                triggered = bad & (t - start >= rule.debounce)
+                if bad[-1]:
+                        self.since[rule.name] = float(start[-1])
+                else:
+                        self.since.pop(rule.name, None)
+                #Walk through the transitions of the batch (on -> off -> on...), there are only a few
+                raised = False
+                i = 0
+                while i < n:
+                        if rule.name not in self.on:
+                                hits = np.flatnonzero(triggered[i:])
+                                if not len(hits):
+                                        break
+                                i += hits[0]
+                                self.on[rule.name] = float(t[i])
+                                raised = True
+                        else:
+                                if rule.latching:
+                                        break
+                                hits = np.flatnonzero(back[i:])
+                                if not len(hits):
+                                        break
+                                i += hits[0]
+                                del self.on[rule.name]
+                return raised
@@ -0,0 +1,482 @@
+"""
+Latency and throughput benchmarks of the acquisition and plotting pipeline.
+
+Scenarios:
+        - parser: FrameDecoder on ASCII lines and binary frames (no serial port)
+        - acquisition: simulated Arduino -> acquisition.Acquisition -> Qt signal, latency until the slot runs
+        - render: Batch -> WaveformBuffer -> setData() of the three plots, time per frame
+        - render_long: the same with a 5 minute window, drawn through the min/max decimation (MinMaxDecimator)
+        - pipeline: simulated Arduino -> the main window of the app (main.Ui_MainWindow): acquisition thread -> signal ->
+          progress_fn() -> WaveformBuffer -> PlotRefresher -> update_plot_data(), latency until the sample is drawn
+        - max_rate: highest simulated sample rate that the acquisition keeps up with
+        - multi_device: 1, 2, 4 and 8 simulated Arduinos read by one monitor.DeviceMonitor, CPU time of the monitor thread
+          per device
+        - alarm: pipeline with a sensor error injected every 100 ms, latency of each stage of the alarm path (serial port ->
+          samples decoded -> rules checked -> buzzer) while the main window redraws the plots
+        - false_alarms: alarm rules checked on the simulated waveform of a patient ventilated exactly as set, for several
+          settings and modes; every alarm raised is a false one (the result has ok: false)
+
+Every scenario reports p50/p99 latencies, CPU usage (process CPU time / wall time) and allocation counters, and the
+results are written as JSON so runs of different releases can be compared:
+        $ python3 benchmark.py --output bench.json
+        $ python3 benchmark.py --scenario parser --scenario pipeline
+The Qt scenarios use the offscreen platform when there is no display.
+"""
+import argparse
+import contextlib
+import gc
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+import numpy as np
+from acquisition import Acquisition, settings_command, STREAM
+from alarms import AlarmEngine
+from connection import SerialConnection
+from instrumentation import STAGES
+from metrics import BreathDetector
+from monitor import Device, DeviceMonitor
+from simulator import ArduinoSimulator
+from telemetry import FrameDecoder, encode_frame, encode_line
+from waveform import MinMaxDecimator, WaveformBuffer
+
+SCENARIOS = ('parser', 'acquisition', 'render', 'render_long', 'pipeline', 'max_rate', 'multi_device', 'alarm', 'false_alarms')
+
+def latency_stats(latencies):
+        """p50, p99 and max of a list of latencies in seconds, reported in milliseconds."""
+        if not latencies:
+                return {'count': 0, 'p50_ms': None, 'p99_ms': None, 'max_ms': None}
+        values = np.asarray(latencies) * 1000
+        return {'count': len(latencies), 'p50_ms': round(float(np.percentile(values, 50)), 3),
+                'p99_ms': round(float(np.percentile(values, 99)), 3), 'max_ms': round(float(values.max()), 3)}
+
+class Usage(object):
+        '''
+        Measures the wall time, CPU time and allocations of the code run inside a with block.
+        With trace=True tracemalloc is also used to report the peak of traced memory (it slows the code down).
+        '''
+
+        def __init__(self, trace=False):
+                self.trace = trace
+
+        def __enter__(self):
+                gc.collect()
+                self.collections = [generation['collections'] for generation in gc.get_stats()]
+                self.blocks = sys.getallocatedblocks()
+                if self.trace:
+                        tracemalloc.start()
+                self.wall = time.perf_counter()
+                self.cpu = time.process_time()
+                return self
+
+        def __exit__(self, *exc):
+                self.wall = time.perf_counter() - self.wall
+                self.cpu = time.process_time() - self.cpu
+                self.peak = tracemalloc.get_traced_memory()[1] if self.trace else None
+                if self.trace:
+                        tracemalloc.stop()
+                self.blocks = sys.getallocatedblocks() - self.blocks
+                self.collections = [generation['collections'] - before for generation, before in zip(gc.get_stats(), self.collections)]
+                return False
+
+        def report(self):
+                report = {'wall_s': round(self.wall, 3), 'cpu_percent': round(100 * self.cpu / self.wall, 1) if self.wall else None,
+                        'allocated_blocks_delta': self.blocks, 'gc_gen0_collections': self.collections[0]}
+                if self.peak is not None:
+                        report['traced_peak_bytes'] = self.peak
+                return report
+
+def make_samples(count, seed=1):
+        simulator = ArduinoSimulator(seed=seed)
+        simulator.mode = 'C'
+        return [simulator.sample(i * 0.005) for i in range(count)]
+
+def scenario_parser(count=20000, chunk=4096):
+        """Decode count samples fed in chunks of chunk bytes, for both formats."""
+        samples = make_samples(count)
+        results = {}
+        for name, data in (('ascii', b''.join(encode_line(s) for s in samples)), ('binary', b''.join(encode_frame(s, i) for i, s in enumerate(samples)))):
+                chunks = [data[i:i + chunk] for i in range(0, len(data), chunk)]
+                decoder = FrameDecoder()
+                latencies = []
+                decoded = 0
+                with Usage() as usage:
+                        for piece in chunks:
+                                start = time.perf_counter()
+                                decoded += len(decoder.feed(piece))
+                                latencies.append(time.perf_counter() - start)
+                result = {'samples': decoded, 'bytes': len(data), 'samples_per_s': round(decoded / usage.wall), 'feed_latency': latency_stats(latencies)}
+                result.update(usage.report())
+                decoder = FrameDecoder()
+                with Usage(trace=True) as traced: #Second pass only for the memory peak, tracemalloc slows the decoder down
+                        for piece in chunks:
+                                decoder.feed(piece)
+                result['traced_peak_bytes'] = traced.peak
+                results[name] = result
+        return results
+
+def qt_application(widgets=False):
+        """Return the running Qt application, creating it (offscreen when there is no display) if needed."""
+        if not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+                os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from PyQt5 import QtCore, QtWidgets
+        app = QtCore.QCoreApplication.instance()
+        if app is None:
+                app = QtWidgets.QApplication(sys.argv) if widgets else QtCore.QCoreApplication(sys.argv)
+        return app
+
+def run_event_loop(app, seconds):
+        """Process the events of app for seconds. A local loop: quitting app would run its aboutToQuit handlers (e.g. close the port)."""
+        from PyQt5 import QtCore
+        loop = QtCore.QEventLoop()
+        QtCore.QTimer.singleShot(int(seconds * 1000), loop.quit)
+        loop.exec_()
+
+def make_signals():
+        from PyQt5 import QtCore
+        class Signals(QtCore.QObject):
+                progress = QtCore.pyqtSignal(object)
+        return Signals()
+
+class SimulatedAcquisition(object):
+        '''
+        The acquisition thread of readArduino() (acquisition.Acquisition in stream mode, with the default alarm rules) against a
+        simulated Arduino, emitting one Batch per read. The simulator sends binary frames so every sample can be matched to its send time.
+        '''
+
+        def __init__(self, rate, progress):
+                self.simulator = ArduinoSimulator(rate=rate, binary=True, seed=1)
+                self.simulator.sent_at = {}
+                self.progress = progress
+                self.received = 0
+                self.stopping = False
+
+        def start(self):
+                self.connection = SerialConnection(self.simulator.start(), timeout=0.1, settle=0)
+                self.connection.start()
+                self.connection.get(5).write(settings_command('C', 20, 400, 0.2, 5, 40).encode('utf-8'))
+                self.alarms = AlarmEngine()
+                self.alarms.configure('C', pip=40, tidal_volume=400, IE=2.5)
+                #The alarms are acknowledged as soon as they go off, so every fault injected turns the buzzer on again
+                self.acquisition = Acquisition(self.connection, STREAM, alarms=self.alarms, on_alarm=self.alarms.reset)
+                self.thread = threading.Thread(target=self.acquisition.run, args=(self.publish, lambda: self.stopping))
+                self.thread.start()
+                deadline = time.monotonic() + 5
+                while not self.received and time.monotonic() < deadline: #Streaming, the timed part starts now
+                        time.sleep(0.01)
+
+        def counts(self):
+                """Samples sent by the simulator and received so far."""
+                return self.simulator.sent, self.received
+
+        def publish(self, batch):
+                self.received += len(batch.samples)
+                self.progress.emit(batch)
+
+        def stop(self):
+                self.stopping = True
+                self.acquisition.wake()
+                self.thread.join()
+                self.connection.get(0).write("22\n".encode('utf-8'))
+                self.connection.close()
+                self.simulator.stop()
+
+        def latency(self, batch, now):
+                sent_at = self.simulator.sent_at
+                return [now - sent_at[sample.seq] for sample in batch.samples if sample.seq in sent_at]
+
+def scenario_acquisition(rate=500, seconds=5.0):
+        """Latency from the simulated Arduino sending a frame to the GUI slot receiving it."""
+        app = qt_application()
+        signals = make_signals()
+        acquisition = SimulatedAcquisition(rate, signals.progress)
+        latencies = []
+        signals.progress.connect(lambda batch: latencies.extend(acquisition.latency(batch, time.monotonic())))
+        with Usage() as usage:
+                acquisition.start()
+                start = acquisition.counts()
+                begin = time.monotonic()
+                run_event_loop(app, seconds)
+                elapsed = time.monotonic() - begin #The timer of the event loop is not exact
+                sent, received = [end - first for first, end in zip(start, acquisition.counts())] #Only while streaming
+                acquisition.stop()
+        result = {'rate_hz': rate, 'seconds': round(elapsed, 3), 'sent': sent, 'received': received,
+                'samples_per_s': round(received / elapsed), 'latency': latency_stats(latencies)}
+        result.update(usage.report())
+        return result
+
+def make_plots():
+        import pyqtgraph as pg
+        widgets = [pg.PlotWidget() for i in range(3)]
+        lines = [widget.plot([], []) for widget in widgets]
+        return widgets, lines
+
+def scenario_render(frames=300, window=10.0, rate=500, buckets=None):
+        """
+        Time to append one frame worth of samples and redraw the three plots with a full plot window. With buckets, the
+        window is drawn through a MinMaxDecimator of that many buckets, as the GUI does with long windows.
+        """
+        app = qt_application(widgets=True)
+        widgets, lines = make_plots()
+        waveform = WaveformBuffer(8192)
+        decimator = MinMaxDecimator(window, buckets) if buckets else None
+        samples = make_samples(min(int(window * rate), 20000) + frames * 20)
+        per_frame = max(1, int(rate / 30))
+        k = 0
+        for k in range(int(window * rate)): #Fill the window first
+                sample = samples[k % len(samples)]
+                waveform.append(k / rate, sample.pressure, sample.volume, sample.flow)
+                if decimator is not None and k % per_frame == 0:
+                        decimator.update(waveform)
+        latencies = []
+        with Usage() as usage:
+                for frame in range(frames):
+                        start = time.perf_counter()
+                        for i in range(per_frame):
+                                k += 1
+                                sample = samples[k % len(samples)]
+                                waveform.append(k / rate, sample.pressure, sample.volume, sample.flow)
+                        if decimator is not None:
+                                decimator.update(waveform)
+                                t, pressure, volume, flow = decimator.window()
+                        else:
+                                t, pressure, volume, flow = waveform.window(window)
+                        lines[0].setData(t, pressure)
+                        lines[1].setData(t, volume)
+                        lines[2].setData(t, flow)
+                        app.processEvents()
+                        latencies.append(time.perf_counter() - start)
+        result = {'window_s': window, 'frames': frames, 'samples_per_frame': per_frame, 'points_per_plot': len(t),
+                'frame_time': latency_stats(latencies)}
+        result.update(usage.report())
+        return result
+
+class SimulatedWindow(object):
+        '''
+        The main window of the app (main.Ui_MainWindow, offscreen when there is no display) reading a simulated Arduino in
+        stream mode. START, STOP and the rest of the path are the ones of the GUI: acquisition thread -> progress_fn() ->
+        WaveformBuffer.extend() -> PlotRefresher -> update_plot_data() (decimators and setData()). Only progress_fn() and
+        the draw function of the PlotRefresher are wrapped, to take the time at which every sample gets to them.
+        '''
+
+        def __init__(self, rate, window=10):
+                from PyQt5 import QtWidgets
+                import main
+                self.simulator = ArduinoSimulator(rate=rate, binary=True, seed=1)
+                self.simulator.sent_at = {}
+                self.main_window = QtWidgets.QMainWindow()
+                self.ui = main.Ui_MainWindow(self.simulator.start(), STREAM, gpio='mock')
+                self.ui.setupUi(self.main_window)
+                self.main_window.show()
+                self.ui.finish_setup()
+                self.ui.plot_window = window
+                self.received = 0
+                self.pending = [] #Send times of the samples not drawn yet
+                self.signal_latencies = []
+                self.draw_latencies = []
+                self.frame_times = []
+                progress_fn = self.ui.progress_fn
+                def progress(batch): #Connected by sendThread() instead of ui.progress_fn
+                        now = time.monotonic()
+                        self.received += len(batch.samples)
+                        sent_at = self.simulator.sent_at
+                        sent = [sent_at.get(sample.seq) for sample in batch.samples]
+                        self.signal_latencies.extend(now - s for s in sent if s is not None)
+                        self.pending.extend(s for s in sent if s is not None)
+                        progress_fn(batch)
+                self.ui.progress_fn = progress
+                refresher = self.ui.plot_refresher
+                draw = refresher.draw
+                def frame():
+                        start = time.perf_counter()
+                        draw()
+                        now = time.monotonic()
+                        self.frame_times.append(time.perf_counter() - start)
+                        self.draw_latencies.extend(now - s for s in self.pending)
+                        del self.pending[:]
+                refresher.draw = frame
+
+        def start(self, app):
+                ui = self.ui
+                if ui.connection.get(5) is None:
+                        raise RuntimeError("The simulated Arduino did not connect")
+                ui.spinBox_cont_mand_vent_freq_value.setValue(20)
+                ui.spinBox_cont_mand_vent_tid_vol_value.setValue(400)
+                ui.spinBox_cont_mand_vent_I_E_value.setValue(5)
+                ui.spinBox_cont_mand_vent_PIP_value.setValue(40)
+                ui.pressed_cont_mand_asist_start()
+                deadline = time.monotonic() + 5
+                while not self.received and time.monotonic() < deadline: #Streaming, the timed part starts now
+                        app.processEvents()
+                        time.sleep(0.01)
+
+        def counts(self):
+                """Samples sent by the simulator and received by progress_fn() so far."""
+                return self.simulator.sent, self.received
+
+        def fault(self):
+                """Inject a sensor error, acknowledging the previous alarms (the alarm button) so that it goes off again."""
+                self.ui.alarms.reset()
+                self.simulator.inject('P00')
+
+        def stop(self, app):
+                self.ui.pressed_cont_mand_asist_stop()
+                self.ui.threadpool.waitForDone(5000)
+                app.processEvents() #thread_complete()
+                self.ui.connection.close()
+                self.ui.buzzer.close()
+                self.simulator.stop()
+                self.main_window.close()
+
+def scenario_pipeline(rate=500, seconds=5.0, window=10, fault_interval=None):
+        """
+        Latency from the simulated Arduino sending a frame to the plots of the main window being redrawn with it, and time
+        taken by every frame (see SimulatedWindow). If fault_interval is given, a sensor error is injected every
+        fault_interval seconds and the latency of the alarm path is reported too.
+        """
+        from PyQt5 import QtCore
+        app = qt_application(widgets=True)
+        gui = SimulatedWindow(rate, window)
+        faults = QtCore.QTimer()
+        faults.timeout.connect(gui.fault)
+        with Usage() as usage:
+                gui.start(app)
+                start = gui.counts()
+                begin = time.monotonic()
+                if fault_interval is not None:
+                        faults.start(int(fault_interval * 1000))
+                run_event_loop(app, seconds)
+                elapsed = time.monotonic() - begin
+                faults.stop()
+                sent, received = [end - first for first, end in zip(start, gui.counts())]
+                gui.stop(app)
+        result = {'rate_hz': rate, 'fps': gui.ui.plot_fps, 'window_s': window, 'seconds': round(elapsed, 3), 'sent': sent, 'received': received,
+                'samples_per_s': round(received / elapsed), 'latency_to_signal': latency_stats(gui.signal_latencies),
+                'latency_to_setData': latency_stats(gui.draw_latencies), 'frame_time': latency_stats(gui.frame_times)}
+        if fault_interval is not None:
+                events = gui.ui.alarm_latency.events
+                result['alarms'] = len(events)
+                result['alarm_latency'] = {stage: latency_stats([getattr(event, stage) for event in events]) for stage in STAGES}
+        result.update(usage.report())
+        return result
+
+def scenario_max_rate(rates=(100, 250, 500, 1000, 2000, 4000), seconds=2.0, max_p99_ms=100.0):
+        """
+        Highest rate at which the samples of the whole run (rate * its duration) are sent and received with a p99 latency below
+        max_p99_ms. If the simulator itself can not send at the rate, the search stops there and generator_limited is set:
+        the acquisition was not the limit, the result is only a lower bound.
+        """
+        runs = []
+        sustainable = None
+        generator_limited = False
+        for rate in rates:
+                run = scenario_acquisition(rate, seconds)
+                expected = 0.99 * rate * run['seconds']
+                generated = run['sent'] >= expected
+                p99 = run['latency']['p99_ms']
+                ok = generated and run['received'] >= expected and p99 is not None and p99 <= max_p99_ms
+                runs.append({'rate_hz': rate, 'sent': run['sent'], 'received': run['received'], 'p99_ms': p99,
+                        'cpu_percent': run['cpu_percent'], 'generated': generated, 'sustained': ok})
+                if not ok:
+                        generator_limited = not generated
+                        break
+                sustainable = rate
+        return {'max_sustainable_rate_hz': sustainable, 'generator_limited': generator_limited, 'max_p99_ms': max_p99_ms, 'runs': runs}
+
+def scenario_multi_device(counts=(1, 2, 4, 8), rate=100, seconds=3.0):
+        """
+        CPU time of the DeviceMonitor thread (all the devices: reads, decoding, breaths and alarms) for each amount of
+        simulated devices. It should grow linearly with the samples received, so the CPU per device stays flat.
+        """
+        runs = []
+        for count in counts:
+                simulators = [ArduinoSimulator(rate=rate, binary=True, seed=i) for i in range(count)]
+                devices = []
+                for i, simulator in enumerate(simulators):
+                        alarms = AlarmEngine()
+                        alarms.configure('C', pip=40, tidal_volume=400, IE=2.5)
+                        devices.append(Device('sim%d' % i, simulator.start(), settings_command('C', 20, 400, 0.2, 5, 40), alarms))
+                monitor = DeviceMonitor(devices, STREAM, settle=0)
+                monitor.start()
+                time.sleep(0.5) #Connected and streaming
+                samples = sum(device.samples for device in devices)
+                cpu = monitor.cpu_time
+                time.sleep(seconds)
+                samples = sum(device.samples for device in devices) - samples
+                cpu = monitor.cpu_time - cpu
+                monitor.stop()
+                for simulator in simulators:
+                        simulator.stop()
+                runs.append({'devices': count, 'samples_per_s': round(samples / seconds), 'cpu_percent': round(100 * cpu / seconds, 1),
+                        'cpu_percent_per_device': round(100 * cpu / seconds / count, 2), 'cpu_us_per_sample': round(1e6 * cpu / samples, 1) if samples else None})
+        return {'rate_hz': rate, 'runs': runs}
+
+def scenario_false_alarms(seconds=60.0, rate=100, read=10):
+        """
+        Alarms raised by the default rules on normal ventilation: the samples of the simulator (without faults) at each of
+        the settings below, read read samples at a time through BreathDetector and AlarmEngine as the acquisition does.
+        """
+        cases = (('C', 20, 400, 0, 5, 40), ('C', 20, 400, 0.2, 5, 40), ('C', 30, 500, 0.5, 0, 40), ('C', 12, 600, 0, 9, 40),
+                ('P', 15, 400, 0.2, 3, 40), ('F', 20, 350, 0, 3, 40))
+        runs = []
+        for mode, frequency, tidal_volume, insp_pause, IE_or_trigger, pip in cases:
+                simulator = ArduinoSimulator(rate=rate, seed=1)
+                simulator._command(settings_command(mode, frequency, tidal_volume, insp_pause, IE_or_trigger, pip).strip())
+                alarms = AlarmEngine()
+                alarms.configure(mode, pip=pip, tidal_volume=tidal_volume, IE=float('2.' + str(IE_or_trigger)) if mode == 'C' else None)
+                detector = BreathDetector()
+                times = [k / rate for k in range(int(seconds * rate))]
+                raised = []
+                breaths = 0
+                for i in range(0, len(times), read):
+                        batch_times = times[i:i + read]
+                        samples = [simulator.sample(t) for t in batch_times]
+                        completed = detector.feed(batch_times, samples)
+                        breaths += len(completed)
+                        raised.extend((round(batch_times[-1], 2), name) for name in alarms.evaluate(batch_times, samples, completed, loss=0.0))
+                runs.append({'settings': settings_command(mode, frequency, tidal_volume, insp_pause, IE_or_trigger, pip).strip(),
+                        'breaths': breaths, 'alarms': raised})
+        return {'seconds': seconds, 'ok': not any(run['alarms'] for run in runs), 'runs': runs}
+
+def run(scenarios, rate=500, seconds=5.0):
+        results = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'machine': platform.machine(),
+                'platform': platform.platform(), 'numpy': np.__version__, 'scenarios': {}}
+        for name in scenarios:
+                if name == 'parser':
+                        results['scenarios'][name] = scenario_parser()
+                elif name == 'acquisition':
+                        results['scenarios'][name] = scenario_acquisition(rate, seconds)
+                elif name == 'render':
+                        results['scenarios'][name] = scenario_render(rate=rate)
+                elif name == 'render_long':
+                        results['scenarios'][name] = scenario_render(window=300.0, rate=rate, buckets=1024)
+                elif name == 'pipeline':
+                        results['scenarios'][name] = scenario_pipeline(rate, seconds)
+                elif name == 'max_rate':
+                        results['scenarios'][name] = scenario_max_rate()
+                elif name == 'multi_device':
+                        results['scenarios'][name] = scenario_multi_device(seconds=seconds)
+                elif name == 'alarm':
+                        results['scenarios'][name] = scenario_pipeline(rate, seconds, fault_interval=0.1)
+                elif name == 'false_alarms':
+                        results['scenarios'][name] = scenario_false_alarms()
+        return results
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="ATMO-Vent acquisition and plotting benchmarks")
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="scenario to run (can be repeated, default all)")
+        parser.add_argument('--rate', type=float, default=500, help="simulated sample rate in Hz (default 500)")
+        parser.add_argument('--seconds', type=float, default=5.0, help="duration of the timed scenarios (default 5)")
+        parser.add_argument('--output', default=None, help="write the JSON results to this file instead of stdout")
+        args = parser.parse_args()
+        with contextlib.redirect_stdout(sys.stderr): #Keep the messages of the connection manager out of the JSON
+                results = run(args.scenario or SCENARIOS, args.rate, args.seconds)
+        text = json.dumps(results, indent=2)
+        if args.output:
+                with open(args.output, 'w') as f:
+                        f.write(text + '\n')
+        else:
+                print(text)
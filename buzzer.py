@@ -0,0 +1,244 @@
+"""
+Output of the alarm buzzer through a GPIO pin.
+
+The GPIO is accessed through a backend, so the app also runs on machines without RPi.GPIO:
+        - RPiGPIOBackend: RPi.GPIO (Raspberry Pi)
+        - GpiodBackend: libgpiod Python bindings (version 1 or 2), /dev/gpiochipN
+        - SysfsBackend: /sys/class/gpio, without any Python package
+        - MockBackend: in memory, for tests, simulators and machines without GPIO
+BuzzerDriver plays a tone pattern for each alarm priority from its own thread.
+"""
+import os
+import threading
+import time
+
+BACKENDS = ('auto', 'rpi', 'gpiod', 'sysfs', 'mock')
+HIGH, MEDIUM, LOW = 1, 2, 3 #Alarm priorities, the same as alarms.HIGH, MEDIUM and LOW (not imported, it would load NumPy at startup)
+
+class RPiGPIOBackend(object):
+        '''GPIO through RPi.GPIO, pins numbered as BCM.'''
+
+        def __init__(self):
+                import RPi.GPIO as GPIO
+                self.GPIO = GPIO
+                GPIO.setwarnings(False)#Disable warnings (optional)
+                GPIO.setmode(GPIO.BCM)#Select GPIO mode
+
+        def setup(self, pin):
+                self.GPIO.setup(pin, self.GPIO.OUT)
+
+        def output(self, pin, value):
+                self.GPIO.output(pin, self.GPIO.HIGH if value else self.GPIO.LOW)
+
+        def cleanup(self):
+                self.GPIO.cleanup()
+
+class GpiodBackend(object):
+        '''
+        GPIO through the libgpiod Python bindings (version 1 or 2).
+
+        :param chip: path of the GPIO chip (on a Raspberry Pi, the lines of gpiochip0 are the BCM numbers)
+        '''
+
+        def __init__(self, chip='/dev/gpiochip0'):
+                import gpiod
+                if not os.path.exists(chip):
+                        raise OSError("%s does not exist" % chip)
+                self.gpiod = gpiod
+                self.chip = chip
+                self.lines = {}
+
+        def setup(self, pin):
+                gpiod = self.gpiod
+                if hasattr(gpiod, 'request_lines'): #libgpiod 2
+                        self.lines[pin] = gpiod.request_lines(self.chip, consumer='atmovent',
+                                config={pin: gpiod.LineSettings(direction=gpiod.line.Direction.OUTPUT)})
+                else:
+                        line = gpiod.Chip(self.chip).get_line(pin)
+                        line.request(consumer='atmovent', type=gpiod.LINE_REQ_DIR_OUT)
+                        self.lines[pin] = line
+
+        def output(self, pin, value):
+                line = self.lines[pin]
+                if hasattr(self.gpiod, 'request_lines'):
+                        line.set_value(pin, self.gpiod.line.Value.ACTIVE if value else self.gpiod.line.Value.INACTIVE)
+                else:
+                        line.set_value(1 if value else 0)
+
+        def cleanup(self):
+                for line in self.lines.values():
+                        line.release()
+                self.lines = {}
+
+class SysfsBackend(object):
+        '''
+        GPIO through the sysfs interface (/sys/class/gpio), deprecated by the kernel but available without any package.
+
+        :param base: number of the first GPIO of the chip in sysfs (0 on older kernels; see /sys/class/gpio/gpiochip*/base)
+        '''
+        ROOT = '/sys/class/gpio'
+
+        def __init__(self, base=0):
+                self.base = base
+                self.files = {}
+                self.exported = []
+
+        def setup(self, pin):
+                number = self.base + pin
+                path = os.path.join(self.ROOT, 'gpio%d' % number)
+                if not os.path.exists(path):
+                        with open(os.path.join(self.ROOT, 'export'), 'w') as f:
+                                f.write(str(number))
+                        self.exported.append(number)
+                for attempt in range(20): #udev may take a moment to give us permission on the new files
+                        try:
+                                with open(os.path.join(path, 'direction'), 'w') as f:
+                                        f.write('out')
+                                break
+                        except PermissionError:
+                                time.sleep(0.05)
+                self.files[pin] = os.open(os.path.join(path, 'value'), os.O_WRONLY)
+
+        def output(self, pin, value):
+                os.pwrite(self.files[pin], b'1' if value else b'0', 0)
+
+        def cleanup(self):
+                for fd in self.files.values():
+                        os.close(fd)
+                self.files = {}
+                for number in self.exported:
+                        with open(os.path.join(self.ROOT, 'unexport'), 'w') as f:
+                                f.write(str(number))
+                self.exported = []
+
+class MockBackend(object):
+        '''GPIO in memory: values holds the value of every pin and history the changes, as (time.monotonic(), pin, value).'''
+
+        def __init__(self):
+                self.values = {}
+                self.history = []
+
+        def setup(self, pin):
+                self.values[pin] = False
+
+        def output(self, pin, value):
+                self.values[pin] = bool(value)
+                self.history.append((time.monotonic(), pin, bool(value)))
+
+        def cleanup(self):
+                pass
+
+def open_backend(name='auto'):
+        """
+        Return the GPIO backend name ("rpi", "gpiod", "sysfs" or "mock"). With "auto", the first one available in that order,
+        the mock if there is no GPIO at all.
+        """
+        if name == 'rpi':
+                return RPiGPIOBackend()
+        if name == 'gpiod':
+                return GpiodBackend()
+        if name == 'sysfs':
+                return SysfsBackend()
+        if name == 'mock':
+                return MockBackend()
+        if name != 'auto':
+                raise ValueError("Unknown GPIO backend %r, expected one of %s" % (name, ", ".join(BACKENDS)))
+        for backend in (RPiGPIOBackend, GpiodBackend):
+                try:
+                        return backend()
+                except (ImportError, RuntimeError, OSError): #RPi.GPIO raises RuntimeError when it is not run on a Raspberry Pi
+                        pass
+        if os.access(os.path.join(SysfsBackend.ROOT, 'export'), os.W_OK):
+                return SysfsBackend()
+        print("No GPIO available, the buzzer is simulated")
+        return MockBackend()
+
+#(seconds on, seconds off) pulses repeated while the alarm is on. High priority: bursts of 3 + 2 fast pulses, as the
+#alarm signals of IEC 60601-1-8; medium: 3 slower pulses; low: 2 pulses every 15 seconds.
+PATTERNS = {
+        HIGH: ((0.1, 0.1), (0.1, 0.1), (0.1, 0.4), (0.1, 0.1), (0.1, 1.0)),
+        MEDIUM: ((0.2, 0.2), (0.2, 0.2), (0.2, 3.0)),
+        LOW: ((0.2, 0.2), (0.2, 15.0)),
+}
+
+class BuzzerDriver(object):
+        '''
+        Plays the tone pattern of the highest priority alarm on a buzzer, from a background thread.
+
+        play() and stop() only change the state and wake the thread, so they never block the acquisition or the GUI and
+        can be called from any thread.
+
+        :param backend: GPIO backend (see open_backend())
+        :param pin: pin of the buzzer
+        :param patterns: {priority: ((seconds on, seconds off), ...)}
+        '''
+
+        def __init__(self, backend, pin, patterns=PATTERNS):
+                self.backend = backend
+                self.pin = pin
+                self.patterns = patterns
+                self.priority = None #Priority of the pattern being played, None if silent
+                self.on = None #Current output of the pin (None until it is set the first time)
+                self._changed = threading.Event()
+                self._lock = threading.Lock()
+                self._closing = False
+                self._thread = None
+
+        def start(self):
+                self.backend.setup(self.pin)
+                self._output(False)
+                self._closing = False
+                self._thread = threading.Thread(target=self._run, name="BuzzerDriver")
+                self._thread.daemon = True
+                self._thread.start()
+
+        def play(self, priority=HIGH):
+                """Play the pattern of priority, unless one of a higher priority is already playing."""
+                with self._lock:
+                        if self.priority is None or priority < self.priority:
+                                self.priority = priority
+                                self._changed.set()
+
+        def stop(self):
+                """Silence the buzzer (the alarm button)."""
+                with self._lock:
+                        if self.priority is not None:
+                                self.priority = None
+                                self._changed.set()
+
+        def close(self):
+                """Silence the buzzer, stop the thread and release the GPIO."""
+                self._closing = True
+                self._changed.set()
+                if self._thread is not None:
+                        self._thread.join()
+                        self._thread = None
+                self._output(False)
+                self.backend.cleanup()
+
+        def _output(self, value):
+                if value != self.on:
+                        self.backend.output(self.pin, value)
+                        self.on = value
+
+        def _wait(self, seconds):
+                """Wait seconds, return True if the state changed meanwhile."""
+                if self._changed.wait(seconds):
+                        self._changed.clear()
+                        return True
+                return False
+
+        def _run(self):
+                while not self._closing:
+                        pattern = self.patterns.get(self.priority)
+                        if pattern is None:
+                                self._output(False)
+                                self._wait(None)
+                                continue
+                        for on, off in pattern:
+                                self._output(True)
+                                if self._wait(on):
+                                        break
+                                self._output(False)
+                                if self._wait(off):
+                                        break
@@ -0,0 +1,104 @@
+"""
+Mapping of the clock of the Arduino (the device timestamps of the telemetry) onto the monotonic clock of the host.
+"""
+from collections import deque
+
+TICK = 1e-6 #Seconds per unit of the device timestamps (micros())
+WRAP = 1 << 32 #The device timestamps are 32 bits
+MAX_DRIFT = 0.01 #Relative difference between both clocks above which the fit is not trusted (ceramic resonators are within 0.5%)
+
+class DeviceClock(object):
+        '''
+        Converts the device timestamps of the samples to time.perf_counter() of the host, so that the time of every sample
+        is when it was measured, whatever the delays of the serial port, the acquisition thread or the GUI.
+
+        The host time at which a read arrives is the device time of its last sample, plus the offset between both clocks,
+        plus the drift between both crystals (proportional to the device time), plus the transmission delay, which only
+        adds. So within every segment of segment seconds (of device time), the read with the lowest host - device time is
+        the one with the least delay. The drift is the slope of the least squares line through those minima over the last
+        segments (a minute by default), fitted again at the end of every segment, and the offset puts the line through the
+        lowest of them. Until two segments are complete the drift is taken as 0. Whenever a read arrives before the time
+        the line gives to its sample (less delay than ever seen), the line is moved down to it, since a sample can not be
+        received before it was measured.
+
+        Timestamps wrap around every 71 minutes, they are unwrapped. A jump backwards (the Arduino rebooted) starts the
+        estimation again.
+
+        :param segment: seconds of device time per segment
+        :param segments: amount of segments used for the fit
+        '''
+
+        def __init__(self, segment=2.0, segments=30):
+                self.segment = segment
+                self.points = deque(maxlen=segments) #(device time, host - device time) of the minimum of each complete segment
+                self.reset()
+
+        def reset(self):
+                """Forget the estimation (the Arduino was reconnected)."""
+                self.points.clear()
+                self.ticks = None #Last device timestamp
+                self.device = 0.0 #Unwrapped device time (s) of the last timestamp, 0 at the first one
+                self.current = None #Index of the current segment
+                self.minimum = None #(device time, host - device time) of the minimum of the current segment
+                self.offset = None #host - device time at device time 0, None until the first read
+                self.drift = 0.0 #Host seconds per device second, minus one
+                self.restarts = 0
+
+        def device_time(self, ticks):
+                """Unwrapped device time (s) of a timestamp, which can not be older than the previous one."""
+                if self.ticks is None:
+                        self.ticks = ticks
+                        return 0.0
+                delta = (ticks - self.ticks) % WRAP
+                if delta >= WRAP // 2: #Backwards: the Arduino rebooted
+                        restarts = self.restarts + 1
+                        self.reset()
+                        self.restarts = restarts
+                        self.ticks = ticks
+                        return 0.0
+                self.ticks = ticks
+                self.device += delta * TICK
+                return self.device
+
+        def update(self, ticks, host):
+                """Add a read whose last sample has the timestamp ticks, received at host (a time.perf_counter())."""
+                device = self.device_time(ticks)
+                excess = host - device
+                segment = int(device // self.segment)
+                if segment != self.current:
+                        if self.minimum is not None:
+                                self.points.append(self.minimum)
+                                self._fit()
+                        self.current = segment
+                        self.minimum = None
+                if self.minimum is None or excess < self.minimum[1]:
+                        self.minimum = (device, excess)
+                if self.offset is None or excess < self.offset + self.drift * device: #Causality
+                        self.offset = excess - self.drift * device
+
+        def _fit(self):
+                n = len(self.points)
+                if n < 2:
+                        return
+                mean_d = sum(d for d, e in self.points) / n
+                mean_e = sum(e for d, e in self.points) / n
+                variance = sum((d - mean_d) ** 2 for d, e in self.points)
+                if variance <= 0:
+                        return
+                drift = sum((d - mean_d) * (e - mean_e) for d, e in self.points) / variance
+                if abs(drift) > MAX_DRIFT:
+                        return
+                self.drift = drift
+                self.offset = min(e - drift * d for d, e in self.points) #Through the lowest minimum, never ahead of a read
+
+        def host_time(self, ticks):
+                """time.perf_counter() at which the sample with the timestamp ticks was measured. update() must have been called before."""
+                delta = (ticks - self.ticks) % WRAP
+                if delta >= WRAP // 2: #Older than the last timestamp (the samples before the last one of a read)
+                        delta -= WRAP
+                device = self.device + delta * TICK
+                return device + self.offset + self.drift * device
+
+        def ppm(self):
+                """Drift of the device clock with respect to the host, in parts per million (positive if the device is slow)."""
+                return self.drift * 1e6
@@ -0,0 +1,126 @@
+"""
+Long-lived serial connection to the Arduino.
+"""
+import os
+import threading
+import serial
+
+class SerialConnection(object):
+        '''
+        Keeps the serial port of the Arduino open for the whole session.
+
+        A background thread opens the port, watches that the device is still plugged in and, when it disappears or the
+        users of the port report an I/O error with lost(), closes it and opens it again with exponential backoff
+        (min_backoff, 2*min_backoff, ... up to max_backoff seconds between attempts). get() hands out the live handle,
+        so pressing START does not have to open the port and wait for the Arduino to boot.
+
+        :param device: path of the serial device (e.g. /dev/serial/by-id/...)
+        :param baudrate: baud rate of the port
+        :param timeout: read timeout of the port, in seconds
+        :param settle: seconds to wait after opening the port, the Arduino reboots when it is opened
+        :param min_backoff: seconds to wait after the first failed attempt to open the port
+        :param max_backoff: maximum seconds between attempts
+        :param check_interval: seconds between checks that the device is still plugged in
+        :param on_state: optional function called (from the background thread) with True/False when the port is opened/lost
+        '''
+
+        def __init__(self, device, baudrate=115200, timeout=1, settle=1.0, min_backoff=0.5, max_backoff=10.0, check_interval=0.5, on_state=None):
+                self.device = device
+                self.baudrate = baudrate
+                self.timeout = timeout
+                self.settle = settle
+                self.min_backoff = min_backoff
+                self.max_backoff = max_backoff
+                self.check_interval = check_interval
+                self.on_state = on_state
+                self.port = None
+                self.connects = 0 #Times the port was opened
+                self.failures = 0 #Failed attempts to open the port
+                self.last_error = None
+                self._connected = threading.Event()
+                self._wake = threading.Event() #Set to wake the background thread (stop or port lost)
+                self._stopping = False
+                self._lock = threading.Lock()
+                self._thread = None
+
+        @property
+        def connected(self):
+                return self._connected.is_set()
+
+        def start(self):
+                """Start the background thread that opens and watches the port."""
+                if self._thread is not None:
+                        return
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="SerialConnection(%s)" % self.device)
+                self._thread.daemon = True
+                self._thread.start()
+
+        def close(self):
+                """Stop the background thread and close the port."""
+                self._stopping = True
+                self._wake.set()
+                if self._thread is not None:
+                        self._thread.join()
+                        self._thread = None
+                self._drop()
+
+        def get(self, timeout=None):
+                """Return the open port, waiting up to timeout seconds (forever if None) for it. Return None if it is not open."""
+                self._connected.wait(timeout)
+                return self.port
+
+        def lost(self, port):
+                """Report that an I/O operation on port failed. The port is closed and opened again in the background."""
+                with self._lock:
+                        if port is not self.port:
+                                return #Already replaced
+                self._drop()
+                self._wake.set()
+
+        def _drop(self):
+                with self._lock:
+                        port = self.port
+                        self.port = None
+                        was_connected = self._connected.is_set()
+                        self._connected.clear()
+                if port is not None:
+                        try:
+                                port.close()
+                        except (serial.SerialException, OSError):
+                                pass
+                if was_connected and self.on_state is not None:
+                        self.on_state(False)
+
+        def _run(self):
+                backoff = self.min_backoff
+                while not self._stopping:
+                        if self.port is None:
+                                try:
+                                        port = serial.Serial(self.device, self.baudrate, timeout=self.timeout)
+                                except (serial.SerialException, OSError) as e:
+                                        self.failures += 1
+                                        self.last_error = e
+                                        self._wake.wait(backoff)
+                                        self._wake.clear()
+                                        backoff = min(backoff * 2, self.max_backoff)
+                                        continue
+                                self._wake.wait(self.settle) #Wait to make sure that the connection was established
+                                self._wake.clear()
+                                if self._stopping:
+                                        port.close()
+                                        break
+                                with self._lock:
+                                        self.port = port
+                                        self._connected.set()
+                                self.connects += 1
+                                backoff = self.min_backoff
+                                print("Connected to the Arduino at %s" % self.device)
+                                if self.on_state is not None:
+                                        self.on_state(True)
+                        elif not os.path.exists(self.device): #Unplugged
+                                print("The Arduino at %s was disconnected" % self.device)
+                                self._drop()
+                        else:
+                                self._wake.wait(self.check_interval)
+                                self._wake.clear()
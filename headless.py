@@ -0,0 +1,198 @@
+"""
+Headless mode: acquisition, metrics and alarms without any Qt widget, for units without display and soak tests.
+
+        $ python3 main.py --headless --device /dev/ttyACM0 --mode C --frequency 20 --tidal-volume 400 --ie 5 --pip 40
+
+One line is printed per breath with its metrics. The buzzer is driven as in the GUI; send SIGUSR1 to the process to reset
+the alarm (the equivalent of the alarm button) and SIGINT/SIGTERM to stop the Arduino and exit.
+
+With --monitor, several Arduinos are followed at once (see monitor.py), each started with the same settings:
+
+        $ python3 main.py --headless --monitor bed1=/dev/ttyACM0 bed2=/dev/ttyACM1 --mode C --frequency 20
+"""
+import signal
+import threading
+import time
+
+def add_arguments(parser):
+        """Add the ventilation settings used by the headless mode to an argparse parser."""
+        group = parser.add_argument_group("headless ventilation settings")
+        group.add_argument('--mode', choices=('C', 'P', 'F'), default='C', help="C: continuous mandatory ventilation, P/F: assisted control with pressure/flow trigger (default C)")
+        group.add_argument('--frequency', type=int, default=20, help="bpm (default 20)")
+        group.add_argument('--tidal-volume', type=int, default=400, help="mL (default 400)")
+        group.add_argument('--insp-pause', type=float, default=0.0, help="s (default 0)")
+        group.add_argument('--ie', type=int, default=5, help="I:E setting, 1:2.<ie> (mode C, default 5)")
+        group.add_argument('--trigger', type=int, default=0, help="trigger value (modes P and F, default 0)")
+        group.add_argument('--pip', type=int, default=40, help="cm H2O (default 40)")
+        group.add_argument('--resistance-limit', type=float, default=None, help="cm H2O/L/s, alarm when a breath exceeds it (default disabled)")
+        group.add_argument('--buzzer-pin', type=int, default=22, help="BCM pin of the buzzer (default 22)")
+
+def format_breath(breath):
+        m = breath.metrics
+        return ("%.2f breath: freq %s bpm, VT %s mL, PIP %s, plateau %s, PEEP %s, mean %s cm H2O, I:E 1:%s, compliance %s mL/cm H2O, "
+                "min. vent. %s L/min, resistance %s cm H2O/L/s" % (breath.start, m.frequency, m.tidal_volume, m.pip, m.plateau, m.peep,
+                m.mean, m.IE, m.compliance, m.min_ventilation, m.resistance))
+
+def configure(args, alarms):
+        """Configure alarms with the settings of args and return the command that starts the Arduino with them."""
+        from acquisition import settings_command
+        #The I:E setting is shown as 1:2.<value>; in assisted control it is set by the patient and the rule does not apply
+        alarms.configure(args.mode, pip=args.pip, tidal_volume=args.tidal_volume, IE=float('2.' + str(args.ie)), resistance_limit=args.resistance_limit)
+        return settings_command(args.mode, args.frequency, args.tidal_volume, args.insp_pause, args.ie if args.mode == 'C' else args.trigger, args.pip)
+
+def open_health(args, collect, check):
+        """Return a started health.HealthServer if --metrics was given, None otherwise."""
+        if args.metrics is None:
+                return None
+        from health import HealthServer
+        server = HealthServer(args.metrics, collect, check, args.metrics_host)
+        server.start()
+        return server
+
+def monitor_metrics(devices):
+        """collect and check functions of health.HealthServer for several devices (monitor.Device instances), labelled with their name."""
+        from health import add_acquisition, add_latency, acquisition_problems
+        def collect(metrics):
+                for device in devices:
+                        add_acquisition(metrics, device.stats, {'device': device.name})
+                        if device.acquisition is not None:
+                                add_latency(metrics, device.acquisition.latency, {'device': device.name})
+        def check():
+                return [problem for device in devices for problem in acquisition_problems(device.stats, device.name)]
+        return collect, check
+
+def run(args, device, replay=None):
+        """
+        Run the headless mode until SIGINT/SIGTERM. Return the exit code. If replay (a replay.SessionReplay) is given, the
+        recorded session is played instead of reading from the Arduino at device, and the mode ends with it.
+        """
+        #Imported here: main.py imports this module to add its arguments, the GUI does not need to wait for them
+        from acquisition import Acquisition, POLLED
+        from alarms import AlarmEngine, HIGH
+        from buzzer import BuzzerDriver, open_backend
+        from connection import SerialConnection
+        from publisher import TelemetryPublisher
+        from recorder import SessionRecorder
+        from health import add_acquisition, add_latency, acquisition_problems
+        from instrumentation import AcquisitionStats, AlarmLatency
+        buzzer = BuzzerDriver(open_backend(args.gpio), args.buzzer_pin)
+        buzzer.start()
+        alarms = AlarmEngine()
+        def alarm_on():
+                buzzer.play(alarms.priority() or HIGH)
+        def reset_alarm(signum, frame):
+                alarms.reset()
+                buzzer.stop()#Turn off the alarm noise
+        stop = threading.Event()
+        acquisition = None
+        def stop_acquisition(signum, frame):
+                stop.set()
+                if acquisition is not None:
+                        acquisition.wake() #Do not wait for the serial read in progress
+        signal.signal(signal.SIGINT, stop_acquisition)
+        signal.signal(signal.SIGTERM, stop_acquisition)
+        signal.signal(signal.SIGUSR1, reset_alarm)
+
+        command = configure(args, alarms)
+        stats = AcquisitionStats()
+        latency = AlarmLatency()
+        def collect(metrics):
+                add_acquisition(metrics, stats)
+                add_latency(metrics, latency)
+        server = open_health(args, collect, lambda: acquisition_problems(stats))
+        connection = SerialConnection(device) if replay is None else replay
+        connection.start()
+        print("Waiting for the Arduino at %s" % connection.device)
+        port = None
+        recorder = None
+        publisher = None
+        while port is None and not stop.is_set():
+                port = connection.get(1)
+        try:
+                if port is None:
+                        return 1
+                port.write(command.encode('utf-8'))
+                start_time = time.time()
+                if args.record is not None:
+                        recorder = SessionRecorder(args.record)
+                        recorder.start(start_time)
+                if args.publish is not None or args.publish_ws is not None:
+                        publisher = TelemetryPublisher(args.publish, args.publish_ws, args.publish_host)
+                        publisher.start()
+                        publisher.start_session(start_time)
+                acquisition = Acquisition(connection, args.acquisition or POLLED, start_time, alarms=alarms, on_alarm=alarm_on,
+                        settings=lambda: command, recorder=recorder, publisher=publisher, stats=stats, latency=latency,
+                        clock=replay.clock if replay is not None else None)
+                def publish(batch):
+                        for breath in batch.breaths:
+                                print(format_breath(breath))
+                        if batch.alarm: #All the alarms of a batch share the same latency
+                                print("ALARM: %s (%.2f ms from the serial port to the buzzer)" % (", ".join(batch.alarm), acquisition.latency.events[-1].total * 1000))
+                acquisition.run(publish, stop.is_set if replay is None else lambda: stop.is_set() or replay.finished)
+                print(acquisition.latency.summary())
+                return 0
+        finally:
+                if recorder is not None:
+                        recorder.stop()
+                if publisher is not None:
+                        publisher.stop()
+                port = connection.get(0)
+                if port is not None:
+                        try:
+                                port.write(('22'+'\n').encode('utf-8')) #Stop the Arduino
+                        except OSError as e:
+                                print(e)
+                connection.close()
+                buzzer.close()
+                if server is not None:
+                        server.stop()
+
+def open_monitor(args, devices, publish=None):
+        """
+        Return a started monitor.DeviceMonitor of devices (monitor.Device instances) and the buzzer.BuzzerDriver that it turns
+        on. Every device gets its own alarms.AlarmEngine, and is started with the ventilation settings of args.
+        """
+        from alarms import AlarmEngine, HIGH
+        from buzzer import BuzzerDriver, open_backend
+        from monitor import DeviceMonitor
+        from telemetry import STREAM
+        buzzer = BuzzerDriver(open_backend(args.gpio), args.buzzer_pin)
+        buzzer.start()
+        for device in devices:
+                device.alarms = AlarmEngine()
+                device.settings = configure(args, device.alarms)
+        def alarm_on(device):
+                buzzer.play(device.alarms.priority() or HIGH)
+        monitor = DeviceMonitor(devices, args.acquisition or STREAM, publish, alarm_on) #Streaming, polling N devices would cost N times more
+        monitor.start()
+        return monitor, buzzer
+
+def run_monitor(args, devices):
+        """
+        Follow several Arduinos (monitor.Device instances) until SIGINT/SIGTERM, printing the breaths and alarms of each one.
+        Return the exit code.
+        """
+        def publish(device, batch):
+                for breath in batch.breaths:
+                        print("%s: %s" % (device.name, format_breath(breath)))
+                if batch.alarm:
+                        print("%s: ALARM: %s" % (device.name, ", ".join(batch.alarm)))
+        def reset_alarm(signum, frame):
+                for device in devices:
+                        device.alarms.reset()
+                buzzer.stop()#Turn off the alarm noise
+        stop = threading.Event()
+        signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGUSR1, reset_alarm)
+        monitor, buzzer = open_monitor(args, devices, publish)
+        server = open_health(args, *monitor_metrics(devices))
+        try:
+                while not stop.wait(1):
+                        pass
+                return 0
+        finally:
+                if server is not None:
+                        server.stop()
+                monitor.stop()
+                buzzer.close()
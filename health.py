@@ -0,0 +1,182 @@
+"""
+Metrics and health endpoint, for the units that run unattended.
+
+HealthServer answers from its own thread:
+        - /metrics: the counters of the acquisition, the alarms and the plots in the Prometheus text format
+        - /health: "ok" (200), or the problems found, one per line (503), e.g. no samples for some seconds
+
+        $ python3 main.py --metrics 9100 --metrics-host 0.0.0.0
+        $ curl raspberrypi.local:9100/metrics
+
+Only the local host can connect unless another address is given (the endpoints have no authentication).
+"""
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = 'atmovent_'
+
+def format_labels(labels):
+        if not labels:
+                return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                for name, value in sorted(labels.items()))
+
+def format_value(value):
+        if isinstance(value, int):
+                return str(value)
+        if value == float('inf'):
+                return '+Inf'
+        return repr(float(value))
+
+class MetricFamilies(object):
+        '''
+        Metrics of one scrape, written in the Prometheus text format by text(). The samples of the same name (with different
+        labels, e.g. one per device) are grouped under one HELP/TYPE header.
+        '''
+
+        def __init__(self):
+                self.families = {} #name -> [type, help, lines]
+
+        def declare(self, name, kind, help):
+                """Lines of the family name, created (and written even without samples) if it is new."""
+                family = self.families.get(PREFIX + name)
+                if family is None:
+                        family = self.families[PREFIX + name] = [kind, help, []]
+                return family[2]
+
+        def add(self, name, kind, help, value, labels=None):
+                """Add a sample of a counter or gauge (kind). Samples without value (None) are left out."""
+                lines = self.declare(name, kind, help)
+                if value is not None:
+                        lines.append('%s%s%s %s' % (PREFIX, name, format_labels(labels), format_value(value)))
+
+        def histogram(self, name, help, histogram, labels=None):
+                """Add an instrumentation.Histogram."""
+                lines = self.declare(name, 'histogram', help)
+                labels = labels or {}
+                seen = 0
+                for bound, count in zip(histogram.buckets, list(histogram.counts)):
+                        seen += count
+                        lines.append('%s%s_bucket%s %d' % (PREFIX, name, format_labels(dict(labels, le=format_value(bound))), seen))
+                if histogram.buckets[-1] != float('inf'):
+                        lines.append('%s%s_bucket%s %d' % (PREFIX, name, format_labels(dict(labels, le='+Inf')), histogram.count))
+                lines.append('%s%s_sum%s %s' % (PREFIX, name, format_labels(labels), format_value(histogram.sum)))
+                lines.append('%s%s_count%s %d' % (PREFIX, name, format_labels(labels), histogram.count))
+
+        def text(self):
+                out = []
+                for name, (kind, help, lines) in self.families.items():
+                        out.append('# HELP %s %s' % (name, help))
+                        out.append('# TYPE %s %s' % (name, kind))
+                        out.extend(lines)
+                return '\n'.join(out) + '\n'
+
+def add_acquisition(metrics, stats, labels=None):
+        """Add the counters of an instrumentation.AcquisitionStats (and its decoder) to metrics."""
+        decoder = stats.decoder
+        metrics.add('samples_total', 'counter', "Samples read from the Arduino", stats.samples, labels)
+        metrics.add('reads_total', 'counter', "Serial reads that returned samples", stats.reads, labels)
+        metrics.add('frames_total', 'counter', "Binary frames decoded", decoder.frames, labels)
+        metrics.add('lines_total', 'counter', "ASCII lines decoded", decoder.lines, labels)
+        metrics.add('lines_dropped_total', 'counter', "ASCII lines dropped because they did not have 9 fields (10 with a timestamp)", decoder.wrong_fields, labels)
+        metrics.add('decode_errors_total', 'counter', "Rejected telemetry: malformed lines, garbage bytes and CRC errors",
+                decoder.malformed + decoder.crc_errors, labels)
+        metrics.add('crc_errors_total', 'counter', "Binary frames rejected because of their CRC", decoder.crc_errors, labels)
+        sequence = stats.sequence
+        metrics.add('samples_lost_total', 'counter', "Samples lost (sequence number gaps, or rejected lines without sequence number)", sequence.lost, labels)
+        metrics.add('gaps_total', 'counter', "Places where samples were lost", sequence.gaps, labels)
+        metrics.add('sample_loss_ratio', 'gauge', "Fraction of the samples lost in the last %g s" % sequence.window, sequence.loss(), labels)
+        metrics.add('reconnects_total', 'counter', "Times the connection with the Arduino was lost", stats.reconnects, labels)
+        metrics.add('acquisition_errors_total', 'counter', "Unexpected errors in the acquisition loop", stats.errors, labels)
+        metrics.add('sample_rate', 'gauge', "Samples per second received in the last %g s" % stats.window, stats.rate(), labels)
+        metrics.add('sample_jitter_seconds', 'gauge', "Standard deviation of the interval between samples in the last %g s" % stats.window,
+                stats.jitter(), labels)
+        metrics.histogram('sample_interval_seconds', "Interval between samples", stats.interval, labels)
+        clock = stats.clock
+        metrics.add('device_clock_drift_ppm', 'gauge', "Drift of the clock of the Arduino with respect to the host (only with device timestamps)",
+                clock.ppm() if clock.offset is not None else None, labels)
+        metrics.add('event_queue_depth', 'gauge', "Batches sent by the acquisition thread to the GUI and not processed yet", stats.queue_depth(), labels)
+        metrics.add('acquisition_running', 'gauge', "1 while the acquisition is running", int(stats.running), labels)
+        metrics.declare('alarm_activations_total', 'counter', "Times each alarm rule went off")
+        for name, count in sorted(dict(stats.alarms).items()):
+                metrics.add('alarm_activations_total', 'counter', "Times each alarm rule went off", count, dict(labels or {}, rule=name))
+
+def add_latency(metrics, latency, labels=None):
+        """Add the histograms of an instrumentation.AlarmLatency to metrics."""
+        for stage, histogram in latency.histograms.items():
+                metrics.histogram('alarm_latency_seconds', "Latency of each stage of the alarm path (parse, evaluate, actuate, total)",
+                        histogram, dict(labels or {}, stage=stage))
+
+def acquisition_problems(stats, name=None, stall_timeout=2.0, max_queue=100):
+        """Problems of an instrumentation.AcquisitionStats (list of str, empty if it is healthy)."""
+        prefix = "%s: " % name if name else ""
+        problems = []
+        if stats.stalled(stall_timeout):
+                problems.append(prefix + "no samples for more than %g s" % stall_timeout)
+        if stats.queue_depth() > max_queue:
+                problems.append(prefix + "%d batches waiting to be processed" % stats.queue_depth())
+        return problems
+
+class HealthServer(object):
+        '''
+        HTTP server of /metrics and /health, from its own thread. collect and check are called from that thread for every
+        request, so they should only read counters.
+
+        :param port: TCP port
+        :param collect: function that adds the current metrics to the MetricFamilies it gets
+        :param check: function returning the problems found (list of str), an empty list when healthy
+        :param host: address to listen on, only the local host by default ('0.0.0.0' for every interface)
+        '''
+
+        def __init__(self, port, collect, check, host='127.0.0.1'):
+                self.port = port
+                self.collect = collect
+                self.check = check
+                self.host = host
+                self.address = None #Listening (host, port), useful with port 0
+                self._server = None
+                self._thread = None
+
+        def start(self):
+                owner = self
+                class Handler(BaseHTTPRequestHandler):
+                        def do_GET(self):
+                                path = self.path.split('?', 1)[0]
+                                try:
+                                        if path == '/metrics':
+                                                metrics = MetricFamilies()
+                                                owner.collect(metrics)
+                                                self.reply(200, metrics.text(), 'text/plain; version=0.0.4; charset=utf-8')
+                                        elif path == '/health':
+                                                problems = owner.check()
+                                                self.reply(503 if problems else 200, '\n'.join(problems or ['ok']) + '\n')
+                                        else:
+                                                self.reply(404, "Not found, try /metrics or /health\n")
+                                except Exception as e: #A bug in a collector must not stop the server
+                                        print(e)
+                                        self.reply(500, "%s\n" % e)
+
+                        def reply(self, code, body, content_type='text/plain; charset=utf-8'):
+                                body = body.encode('utf-8')
+                                self.send_response(code)
+                                self.send_header('Content-Type', content_type)
+                                self.send_header('Content-Length', str(len(body)))
+                                self.end_headers()
+                                self.wfile.write(body)
+
+                        def log_message(self, format, *args): #Scrapes every few seconds would flood the output
+                                pass
+                self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+                self._server.daemon_threads = True
+                self.address = self._server.server_address
+                self._thread = threading.Thread(target=self._server.serve_forever, name="HealthServer")
+                self._thread.daemon = True
+                self._thread.start()
+
+        def stop(self):
+                if self._server is None:
+                        return
+                self._server.shutdown()
+                self._server.server_close()
+                self._thread.join()
+                self._server = None
@@ -0,0 +1,232 @@
+"""
+Timing instrumentation of the running app (startup time, alarm latency, acquisition counters).
+"""
+import bisect
+import math
+import os
+import time
+from collections import deque, namedtuple
+from clock import DeviceClock
+from telemetry import FrameDecoder, SequenceChecker
+
+AlarmEvent = namedtuple('AlarmEvent', ['time', 'name', 'parse', 'evaluate', 'actuate', 'total'])
+AlarmEvent.__doc__ = '''
+One alarm that went off: session time (s) of the last sample of the read, name of the rule and the latencies (s) of each
+stage of the alarm path: parse (bytes read from the port -> samples decoded), evaluate (-> rules checked), actuate (->
+buzzer turned on, or told to play its pattern) and total (bytes read -> buzzer).
+'''
+
+STAGES = ('parse', 'evaluate', 'actuate', 'total')
+
+def process_start():
+        """time.perf_counter() at which the process was started (Linux only, 10 ms resolution), None if it is not known."""
+        try:
+                with open('/proc/self/stat') as f:
+                        ticks = int(f.read().rsplit(')', 1)[1].split()[19]) #Field 22, starttime, in clock ticks since boot
+                with open('/proc/uptime') as f:
+                        uptime = float(f.read().split()[0])
+                now = time.perf_counter()
+                return now - max(0.0, uptime - ticks / os.sysconf('SC_CLK_TCK'))
+        except (OSError, ValueError, IndexError):
+                return None
+
+class StartupTimer(object):
+        '''
+        Time taken by each step of the startup of the app, from the start of the process (so the time spent by the Python
+        interpreter before running main.py is included) to the window being ready to use.
+
+        :param start: time.perf_counter() of the start, process_start() (or now if it is not known) by default
+        '''
+
+        def __init__(self, start=None):
+                if start is None:
+                        start = process_start()
+                self.start = time.perf_counter() if start is None else start
+                self.marks = [] #(step, time.perf_counter() at which it ended)
+
+        def mark(self, step):
+                """Record the end of step."""
+                self.marks.append((step, time.perf_counter()))
+
+        def steps(self):
+                """[(step, seconds it took), ...] in order."""
+                steps = []
+                previous = self.start
+                for step, end in self.marks:
+                        steps.append((step, end - previous))
+                        previous = end
+                return steps
+
+        def total(self):
+                return self.marks[-1][1] - self.start if self.marks else 0.0
+
+        def summary(self):
+                """One line with the total and the time of each step, in s."""
+                return "Started in %.2f s (%s)" % (self.total(), ", ".join("%s %.2f s" % step for step in self.steps()))
+
+class Histogram(object):
+        '''
+        Histogram of durations with fixed buckets, cheap enough to be updated from the acquisition thread.
+
+        :param buckets: upper bounds of the buckets in seconds, in increasing order (the last one should be infinity)
+        '''
+        BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, float('inf'))
+
+        def __init__(self, buckets=BUCKETS):
+                self.buckets = tuple(buckets)
+                self.reset()
+
+        def reset(self):
+                self.counts = [0] * len(self.buckets)
+                self.count = 0
+                self.sum = 0.0
+                self.max = 0.0
+
+        def add(self, value, count=1):
+                """Add count times value."""
+                self.counts[bisect.bisect_left(self.buckets, value)] += count
+                self.count += count
+                self.sum += value * count
+                if value > self.max:
+                        self.max = value
+
+        def quantile(self, q):
+                """Upper bound of the bucket holding the q quantile (0 <= q <= 1), the max if it is the last bucket. None if empty."""
+                if not self.count:
+                        return None
+                rank = q * self.count
+                seen = 0
+                for bound, count in zip(self.buckets, self.counts):
+                        seen += count
+                        if seen >= rank and count:
+                                return min(bound, self.max)
+                return self.max
+
+        def as_dict(self):
+                return {'count': self.count, 'sum': self.sum, 'max': self.max, 'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                        'buckets': [[bound, count] for bound, count in zip(self.buckets, self.counts)]}
+
+class AlarmLatency(object):
+        '''
+        Latency of the alarm path, from the bytes of a bad sample arriving on the serial port to the buzzer being turned on.
+        Every alarm that goes off adds its stage latencies (see AlarmEvent) to one Histogram per stage, and the last events
+        are kept in events.
+
+        :param max_events: amount of events kept
+        '''
+
+        def __init__(self, max_events=100):
+                self.histograms = {stage: Histogram() for stage in STAGES}
+                self.events = deque(maxlen=max_events)
+
+        def add(self, t, name, read, parse, evaluate, actuate):
+                """Add an alarm from the time.perf_counter() of each stage. Return its AlarmEvent."""
+                event = AlarmEvent(t, name, parse - read, evaluate - parse, actuate - evaluate, actuate - read)
+                for stage in STAGES:
+                        self.histograms[stage].add(getattr(event, stage))
+                self.events.append(event)
+                return event
+
+        def reset(self):
+                for histogram in self.histograms.values():
+                        histogram.reset()
+                self.events.clear()
+
+        def as_dict(self):
+                return {stage: self.histograms[stage].as_dict() for stage in STAGES}
+
+        def summary(self):
+                """One line with the count, p50, p99 and max of the total latency, in ms."""
+                total = self.histograms['total']
+                if not total.count:
+                        return "No alarms"
+                return "%d alarms, latency from the serial port to the buzzer: p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (total.count,
+                        total.quantile(0.5) * 1000, total.quantile(0.99) * 1000, total.max * 1000)
+
+class AcquisitionStats(object):
+        '''
+        Live counters of the acquisition of one Arduino, updated from the acquisition thread and read from any other one (the
+        metrics endpoint, see health.py).
+
+        The decoder is shared by every serial reader of the acquisitions that report here, so its counters (frames, lines,
+        malformed lines, CRC errors) cover reconnections and every session, and so does the sequence checker (samples lost).
+        clock maps the device timestamps of the samples to the host clock (when the firmware sends them). The samples of one read arrived some time between
+        the previous read and this one, so the interval of each sample is the time between the reads divided by the samples
+        of the read, as the sample times of Acquisition.process(). The rate and the jitter (standard deviation of that
+        interval) are computed over the reads of the last window seconds.
+
+        :param window: seconds of reads used for the rate and the jitter
+        '''
+
+        def __init__(self, window=2.0):
+                self.window = window
+                self.decoder = FrameDecoder()
+                self.sequence = SequenceChecker(window)
+                self.clock = DeviceClock()
+                self.samples = 0 #Samples read
+                self.reads = 0 #Reads that returned samples
+                self.published = 0 #Batches sent by the acquisition thread to the GUI thread, see queue_depth()
+                self.delivered = 0 #Batches processed by the GUI thread
+                self.reconnects = 0 #Times the Arduino was lost
+                self.errors = 0 #Unexpected errors in the acquisition loop
+                self.alarms = {} #Activations of each alarm rule
+                self.interval = Histogram() #Interval between samples
+                self.recent = deque() #(time.perf_counter() of the read, samples, interval between its samples) in the last window
+                self.previous = None #time.perf_counter() of the previous read, None after a reconnection
+                self.last_read = None #time.perf_counter() of the last read, or of the start of the acquisition
+                self.running = False
+
+        def start(self):
+                """The acquisition started (or stopped, see stop()): it is stalled if it does not read anything."""
+                self.running = True
+                self.previous = None
+                self.last_read = time.perf_counter()
+
+        def stop(self):
+                self.running = False
+
+        def add_read(self, read_time, samples):
+                """Count a read that returned samples (an amount) at read_time (a time.perf_counter())."""
+                self.samples += samples
+                self.reads += 1
+                if self.previous is not None and read_time > self.previous:
+                        interval = (read_time - self.previous) / samples
+                        self.interval.add(interval, samples)
+                        self.recent.append((read_time, samples, interval))
+                        while self.recent[0][0] < read_time - self.window:
+                                self.recent.popleft()
+                self.previous = self.last_read = read_time
+
+        def add_alarm(self, name):
+                self.alarms[name] = self.alarms.get(name, 0) + 1
+
+        def lost(self):
+                """The connection was lost: the next read does not tell the interval between samples."""
+                self.reconnects += 1
+                self.previous = None
+
+        def _recent(self, now=None):
+                now = time.perf_counter() if now is None else now
+                return [read for read in list(self.recent) if read[0] >= now - self.window]
+
+        def rate(self, now=None):
+                """Samples per second received in the last window seconds."""
+                return sum(samples for read_time, samples, interval in self._recent(now)) / self.window
+
+        def jitter(self, now=None):
+                """Standard deviation (s) of the interval between the samples received in the last window seconds, None if there were none."""
+                recent = self._recent(now)
+                count = sum(samples for read_time, samples, interval in recent)
+                if not count:
+                        return None
+                mean = sum(samples * interval for read_time, samples, interval in recent) / count
+                return math.sqrt(sum(samples * (interval - mean) ** 2 for read_time, samples, interval in recent) / count)
+
+        def queue_depth(self):
+                """Batches sent to the GUI thread and not processed yet (always 0 without GUI, the batches are processed by the acquisition thread)."""
+                return self.published - self.delivered
+
+        def stalled(self, timeout, now=None):
+                """True if the acquisition is running and nothing was read for timeout seconds."""
+                now = time.perf_counter() if now is None else now
+                return self.running and now - self.last_read > timeout
@@ -1,12 +1,37 @@
+from instrumentation import AcquisitionStats, Histogram, StartupTimer
+startup = StartupTimer() #Time of each step until the window is ready, printed by Ui_MainWindow.finish_setup()
+startup.mark('python')
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtCore import QThread, pyqtSignal
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 import traceback, sys
-import numpy as np
-from random import randint
-import RPi.GPIO as GPIO
+import math
+from buzzer import BACKENDS
+from telemetry import MODES, POLLED, STREAM
+
+def import_deferred():
+        """
+        Import the modules that are not needed to show the window: pyqtgraph, NumPy (through the acquisition, alarms and
+        waveform buffer) and pyserial take most of the startup time on a Raspberry Pi, so they are imported by
+        Ui_MainWindow.finish_setup() once the window was painted.
+        """
+        global pg, serial, Acquisition, AlarmEngine, HIGH, BuzzerDriver, open_backend, SerialConnection, AlarmLatency, SessionRecorder, TrendStore, MinMaxDecimator, WaveformBuffer
+        import pyqtgraph as pg
+        import serial
+        from acquisition import Acquisition
+        from alarms import AlarmEngine, HIGH
+        from buzzer import BuzzerDriver, open_backend
+        from connection import SerialConnection
+        from instrumentation import AlarmLatency
+        from recorder import SessionRecorder
+        from trends import TrendStore
+        from waveform import MinMaxDecimator, WaveformBuffer
+
+############################IMPORTANT TO CHANGE THE ARDUINO ID TO THE ONE THAT YOU ARE USING#################################
+ARDUINO_ID = '/dev/serial/by-id/usb-Arduino__www.arduino.cc__0042_75736303236351606110-if00'
+############################IMPORTANT TO CHANGE THE ARDUINO ID TO THE ONE THAT YOU ARE USING#################################
 
 class WorkerSignals(QObject):
         '''
@@ -25,7 +50,7 @@ class WorkerSignals(QObject):
         error = pyqtSignal(tuple)
         result = pyqtSignal(object)
         res = pyqtSignal(str)
-        progress = pyqtSignal(str)
+        progress = pyqtSignal(object)
 
 class Worker(QRunnable):
         '''
@@ -68,6 +93,125 @@ class Worker(QRunnable):
                 finally:
                         self.signals.finished.emit()  # Done
 
+class PlotRefresher(QObject):
+        '''
+        Redraws the waveform plots at a fixed frame rate, independently of the rate at which the samples arrive.
+
+        On every tick of its QTimer it checks whether new samples were added to the waveform buffer since the previous frame.
+        If there are, all of them are drawn at once calling draw(); if not, the frame is skipped. This way the Arduino can send
+        hundreds of values per second while the GUI only redraws fps times per second. The time taken by every frame is
+        added to frame_time.
+
+        :param waveform: WaveformBuffer with the samples to draw
+        :param draw: function that updates the plots with the contents of the buffer
+        :param fps: frames per second
+        '''
+
+        def __init__(self, waveform, draw, fps=30):
+                super(PlotRefresher, self).__init__()
+                self.waveform = waveform
+                self.draw = draw
+                self.drawn = 0 #waveform.total at the last frame
+                self.frames_drawn = 0
+                self.frames_skipped = 0
+                self.frame_time = Histogram()
+                self.timer = QTimer(self)
+                self.timer.timeout.connect(self.refresh)
+                self.set_fps(fps)
+
+        def set_fps(self, fps):
+                self.fps = fps
+                self.timer.setInterval(int(1000 / fps))
+
+        def start(self):
+                self.drawn = 0
+                self.timer.start()
+
+        def invalidate(self):
+                """Redraw on the next frame even if no sample arrived (e.g. the window shown changed)."""
+                self.drawn = -1
+
+        def stop(self):
+                self.timer.stop()
+
+        @pyqtSlot()
+        def refresh(self):
+                total = self.waveform.total
+                if total == self.drawn: #Nothing arrived since the previous frame
+                        self.frames_skipped += 1
+                        return
+                self.drawn = total
+                self.frames_drawn += 1
+                start = time.perf_counter()
+                self.draw()
+                self.frame_time.add(time.perf_counter() - start)
+
+class LabelPresenter(QObject):
+        '''
+        Shows values in the labels of the GUI at a limited rate.
+
+        update() only stores the latest value of each key; a QTimer applies them rate times per second, and a label is only
+        written when its text actually changed. This avoids relayouting the labels for every sample received.
+
+        :param rate: maximum amount of label updates per second
+        '''
+
+        def __init__(self, rate=5):
+                super(LabelPresenter, self).__init__()
+                self.setters = {} #key -> (function that shows the text, function that formats the value)
+                self.pending = {} #Latest values not shown yet
+                self.shown = {} #Text currently shown for each key
+                self.timer = QTimer(self)
+                self.timer.timeout.connect(self.flush)
+                self.timer.setInterval(int(1000 / rate))
+
+        def bind(self, key, setter, text=str):
+                self.setters[key] = (setter, text)
+
+        def update(self, values):
+                """Store the values to show in the next update. None values are ignored."""
+                self.pending.update((key, value) for key, value in values.items() if value is not None)
+
+        def start(self):
+                self.shown.clear()
+                self.timer.start()
+
+        def stop(self):
+                self.flush()
+                self.timer.stop()
+
+        @pyqtSlot()
+        def flush(self):
+                for key, value in self.pending.items():
+                        if key not in self.setters:
+                                continue
+                        setter, text = self.setters[key]
+                        value = text(value)
+                        if self.shown.get(key) != value:
+                                setter(value)
+                                self.shown[key] = value
+                self.pending.clear()
+
+class FirstPaint(QObject):
+        '''
+        Calls callback once, as soon as widget was painted for the first time (when the event loop is idle again after the
+        paint, so the window is already on the screen).
+
+        :param widget: widget to watch, usually the main window
+        :param callback: function without arguments
+        '''
+
+        def __init__(self, widget, callback):
+                super(FirstPaint, self).__init__(widget)
+                self.callback = callback
+                widget.installEventFilter(self)
+
+        def eventFilter(self, watched, event):
+                if event.type() == QEvent.Paint:
+                        watched.removeEventFilter(self)
+                        QtCore.QTimer.singleShot(0, self.callback)
+                return False
+
 class Ui_patientSettingsWindow(QObject):
         #Initialize variables that will interact between classes
         patient_age = QtCore.pyqtSignal(int)
@@ -546,28 +690,275 @@ class Ui_FlowCalculatorWindow(object):
         def update_fio2(self, event):
                 self.spinBox_fio2.setValue(event)
 
+class Ui_TrendsWindow(object):
+        '''
+        Trends of the metrics of every breath since the app started (see trends.TrendStore): mean of each bucket with its
+        min/max band, over the last hours. The plot is drawn from the rollups, so it takes the same time for 1 or 24 hours.
+        While the window is visible it is redrawn every refresh_interval seconds if new breaths arrived.
+
+        :param trends: trends.TrendStore
+        :param refresh_interval: seconds between redraws
+        '''
+        #(label, Metrics field, unit) of the metrics that can be shown
+        METRICS = (("PIP", 'pip', "cm H2O"), ("Plateau", 'plateau', "cm H2O"), ("PEEP", 'peep', "cm H2O"), ("Mean pressure", 'mean', "cm H2O"),
+                ("Tidal volume", 'tidal_volume', "mL"), ("Frequency", 'frequency', "bpm"), ("Min. ventilation", 'min_ventilation', "L/min"),
+                ("Compliance", 'compliance', "mL/cm H2O"), ("Resistance", 'resistance', "cm H2O/L/s"), ("I:E", 'IE', "1:x"))
+        SPANS = (("1 h", 3600), ("6 h", 6 * 3600), ("12 h", 12 * 3600), ("24 h", 24 * 3600))
+
+        def __init__(self, trends, refresh_interval=5):
+                self.trends = trends
+                self.refresh_interval = refresh_interval
+                self.drawn = None #(trends.total, metric, span) of the last redraw
+
+        def setupUi(self, TrendsWindow):
+                self.window = TrendsWindow
+                TrendsWindow.setObjectName("TrendsWindow")
+                TrendsWindow.resize(800, 500)
+                self.centralwidget = QtWidgets.QWidget(TrendsWindow)
+                self.centralwidget.setObjectName("centralwidget")
+                self.verticalLayout = QtWidgets.QVBoxLayout(self.centralwidget)
+                self.verticalLayout.setObjectName("verticalLayout")
+                self.horizontalLayout = QtWidgets.QHBoxLayout()
+                self.horizontalLayout.setObjectName("horizontalLayout")
+                font = QtGui.QFont()
+                font.setPointSize(18)
+                self.comboBox_metric = QtWidgets.QComboBox(self.centralwidget)
+                self.comboBox_metric.setFont(font)
+                self.comboBox_metric.setObjectName("comboBox_metric")
+                self.comboBox_metric.addItems([label for label, field, unit in self.METRICS])
+                self.horizontalLayout.addWidget(self.comboBox_metric)
+                self.comboBox_span = QtWidgets.QComboBox(self.centralwidget)
+                self.comboBox_span.setFont(font)
+                self.comboBox_span.setObjectName("comboBox_span")
+                self.comboBox_span.addItems([label for label, seconds in self.SPANS])
+                self.horizontalLayout.addWidget(self.comboBox_span)
+                self.verticalLayout.addLayout(self.horizontalLayout)
+                self.graphicsView_trend = pg.PlotWidget(self.centralwidget)
+                self.graphicsView_trend.setObjectName("graphicsView_trend")
+                self.graphicsView_trend.setLabel('bottom', "Hours")
+                self.line_min = self.graphicsView_trend.plot([], [], pen=pg.mkPen('b', width=1))
+                self.line_max = self.graphicsView_trend.plot([], [], pen=pg.mkPen('b', width=1))
+                self.graphicsView_trend.addItem(pg.FillBetweenItem(self.line_min, self.line_max, brush=(0, 0, 255, 80)))
+                self.line_mean = self.graphicsView_trend.plot([], [], pen=pg.mkPen('w', width=2))
+                self.verticalLayout.addWidget(self.graphicsView_trend)
+                TrendsWindow.setCentralWidget(self.centralwidget)
+                self.comboBox_metric.currentIndexChanged.connect(self.refresh)
+                self.comboBox_span.currentIndexChanged.connect(self.refresh)
+                self.timer = QTimer(TrendsWindow)
+                self.timer.timeout.connect(self.refresh)
+                self.timer.start(int(self.refresh_interval * 1000))
+                TrendsWindow.setWindowTitle("Trends")
+
+        def refresh(self):
+                """Redraw the trend if the window is visible and something changed since the last redraw."""
+                label, field, unit = self.METRICS[self.comboBox_metric.currentIndex()]
+                span = self.SPANS[self.comboBox_span.currentIndex()][1]
+                state = (self.trends.total, field, span)
+                if not self.window.isVisible() or state == self.drawn:
+                        return
+                self.drawn = state
+                t, low, mean, high = self.trends.window(field, span, time.time())
+                hours = (t - time.time()) / 3600 #Hours before now
+                self.line_min.setData(hours, low)
+                self.line_max.setData(hours, high)
+                self.line_mean.setData(hours, mean, connect='finite')
+                self.graphicsView_trend.setLabel('left', "%s (%s)" % (label, unit))
+                self.graphicsView_trend.setXRange(-span / 3600, 0)
+
+class Ui_DeviceTile(object):
+        '''
+        Compact tile of one monitored ventilator in the dashboard: name, connection state, last metrics, active alarms, the
+        pressure of the last plot_window seconds and a button that resets its alarms.
+
+        :param device: monitor.Device
+        :param on_reset: function called with the device when its RESET button is pushed
+        :param plot_window: seconds of pressure shown
+        '''
+        STYLE = "QFrame#frame_tile {background-color: %s; border: 2px solid #555; border-radius: 10px;}"
+
+        def __init__(self, device, on_reset, plot_window=10):
+                self.device = device
+                self.on_reset = on_reset
+                self.plot_window = plot_window
+                self.drawn = None #(device.samples, device.state, alarms) at the last refresh
+
+        def setupUi(self, parent):
+                self.frame_tile = QtWidgets.QFrame(parent)
+                self.frame_tile.setObjectName("frame_tile")
+                self.frame_tile.setMinimumSize(QtCore.QSize(280, 220))
+                self.frame_tile.setStyleSheet(self.STYLE % "rgb(164, 176, 179)")
+                self.verticalLayout = QtWidgets.QVBoxLayout(self.frame_tile)
+                self.horizontalLayout = QtWidgets.QHBoxLayout()
+                self.label_name = QtWidgets.QLabel(self.frame_tile)
+                font = QtGui.QFont()
+                font.setPointSize(16)
+                font.setBold(True)
+                self.label_name.setFont(font)
+                self.label_name.setText(self.device.name)
+                self.horizontalLayout.addWidget(self.label_name)
+                self.label_state = QtWidgets.QLabel(self.frame_tile)
+                self.label_state.setAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+                self.horizontalLayout.addWidget(self.label_state)
+                self.verticalLayout.addLayout(self.horizontalLayout)
+                self.label_values = QtWidgets.QLabel(self.frame_tile)
+                font = QtGui.QFont()
+                font.setPointSize(12)
+                self.label_values.setFont(font)
+                self.verticalLayout.addWidget(self.label_values)
+                self.graphicsView_pressure = pg.PlotWidget(self.frame_tile)
+                self.graphicsView_pressure.setMinimumSize(QtCore.QSize(0, 100))
+                self.graphicsView_pressure.setMouseEnabled(False, False)
+                self.graphicsView_pressure.hideButtons()
+                self.line_pressure = self.graphicsView_pressure.plot([], [], pen=pg.mkPen('r', width=1))
+                self.verticalLayout.addWidget(self.graphicsView_pressure)
+                self.horizontalLayout_2 = QtWidgets.QHBoxLayout()
+                self.label_alarms = QtWidgets.QLabel(self.frame_tile)
+                self.label_alarms.setWordWrap(True)
+                self.horizontalLayout_2.addWidget(self.label_alarms)
+                self.button_reset = QtWidgets.QPushButton(self.frame_tile)
+                self.button_reset.setText("RESET")
+                self.button_reset.clicked.connect(lambda: self.on_reset(self.device))
+                self.horizontalLayout_2.addWidget(self.button_reset)
+                self.verticalLayout.addLayout(self.horizontalLayout_2)
+                return self.frame_tile
+
+        def refresh(self):
+                """Redraw the tile if the device received samples, changed state or its alarms changed since the last refresh."""
+                device = self.device
+                alarms = tuple(device.alarms.active()) if device.alarms is not None else ()
+                state = (device.samples, device.state, alarms)
+                if state == self.drawn:
+                        return
+                self.drawn = state
+                with device.lock: #The monitor thread writes them, copy what is drawn
+                        t, pressure, volume, flow = device.waveform.window(self.plot_window)
+                        t, pressure = t.copy(), pressure.copy()
+                        m = device.metrics
+                        breath = device.breath
+                self.label_state.setText(device.state if device.state != 'running' else "%d samples" % device.samples)
+                if m is not None:
+                        self.label_values.setText("PIP %s  PEEP %s cm H2O\nVT %s mL  freq %s bpm  C %s" % (m.pip, m.peep, m.tidal_volume,
+                                m.frequency, breath.metrics.compliance if breath is not None and breath.metrics.compliance is not None else "-"))
+                self.line_pressure.setData(t, pressure)
+                self.label_alarms.setText(", ".join(alarms))
+                self.frame_tile.setStyleSheet(self.STYLE % ("rgb(230, 80, 80)" if alarms else "rgb(164, 176, 179)"))
+
+class Ui_DashboardWindow(object):
+        '''
+        Dashboard of several ventilators followed by a monitor.DeviceMonitor: one Ui_DeviceTile per device, in a grid. The
+        tiles are refreshed fps times per second, and only the ones that changed are redrawn.
+
+        :param monitor: monitor.DeviceMonitor
+        :param buzzer: buzzer.BuzzerDriver silenced by the RESET buttons
+        :param fps: refreshes per second
+        '''
+
+        def __init__(self, monitor, buzzer, fps=10):
+                self.monitor = monitor
+                self.buzzer = buzzer
+                self.fps = fps
+
+        def setupUi(self, DashboardWindow):
+                DashboardWindow.setObjectName("DashboardWindow")
+                DashboardWindow.resize(956, 800)
+                self.centralwidget = QtWidgets.QWidget(DashboardWindow)
+                self.centralwidget.setObjectName("centralwidget")
+                self.gridLayout = QtWidgets.QGridLayout(self.centralwidget)
+                self.gridLayout.setObjectName("gridLayout")
+                columns = max(1, int(math.ceil(math.sqrt(len(self.monitor.devices)))))
+                self.tiles = []
+                for i, device in enumerate(self.monitor.devices):
+                        tile = Ui_DeviceTile(device, self.reset_alarm)
+                        self.gridLayout.addWidget(tile.setupUi(self.centralwidget), i // columns, i % columns, 1, 1)
+                        self.tiles.append(tile)
+                DashboardWindow.setCentralWidget(self.centralwidget)
+                DashboardWindow.setWindowTitle("ATMO-Vent - %d ventilators" % len(self.tiles))
+                self.timer = QTimer(DashboardWindow)
+                self.timer.timeout.connect(self.refresh)
+                self.timer.start(int(1000 / self.fps))
+
+        def refresh(self):
+                for tile in self.tiles:
+                        tile.refresh()
+
+        def reset_alarm(self, device):
+                device.alarms.reset()
+                self.buzzer.stop()#Turn off the alarm noise
+
 class Ui_MainWindow(object):
-        def __init__(self):
+        def __init__(self, arduino_id=None, acquisition_mode=None, record_directory=None, replay=None, gpio='auto', publish_port=None, publish_ws_port=None, metrics_port=None,
+                        metrics_host='127.0.0.1', publish_host='127.0.0.1'):
+                """
+                arduino_id and acquisition_mode override ARDUINO_ID and POLLED (e.g. from the command line). If record_directory is
+                given, every session (from START to STOP) is recorded there at full rate, see recorder.SessionRecorder. If replay (a
+                replay.SessionReplay) is given, the recorded session is played instead of reading from the Arduino. gpio is the
+                backend of the buzzer output (see buzzer.open_backend()). If publish_port or publish_ws_port are given, the
+                telemetry is streamed on those TCP/WebSocket ports of the publish_host address, see publisher.TelemetryPublisher. If metrics_port is given,
+                the counters of the acquisition and the plots are served there on the metrics_host address, see health.HealthServer.
+                """
                 super(Ui_MainWindow, self).__init__()
+                self.arduino_id = arduino_id or ARDUINO_ID
+                self.acquisition_mode = acquisition_mode or POLLED
+                self.record_directory = record_directory
+                self.replay = replay
+                self.gpio = gpio
+                self.publish_port = publish_port
+                self.publish_ws_port = publish_ws_port
+                self.publish_host = publish_host
+                self.publisher = None
+                self.metrics_port = metrics_port
+                self.metrics_host = metrics_host
+                self.health_server = None
+                self.flow_calculator_window = None #Secondary windows, built once and reused
+                self.patient_settings_window = None
+                self.trends_window = None
 
         def openFlowCalculator(self):
                 """
                 Method in charge of implementing the Flow Calculator window. It is called when the button "button_flowcalculator" is clicked.
+                The window is built once (see build_secondary_windows()) and only shown again on the next clicks.
                 """
-                self.flow_calculator_window = QtWidgets.QMainWindow()
-                self.ui_flow_calculator = Ui_FlowCalculatorWindow()
-                self.ui_flow_calculator.setupUi(self.flow_calculator_window)
-                self.flow_calculator_window.show()
+                self.build_secondary_windows()
+                self.show_window(self.flow_calculator_window)
 
         def openpatientSettings(self):
                 """
                 Method in charge of implementing the Patient Settings window. It is called when the button "button_patient_settings" is clicked.
+                The window is built once (see build_secondary_windows()) and only shown again on the next clicks.
+                """
+                self.build_secondary_windows()
+                self.show_window(self.patient_settings_window)
+
+        def openTrends(self):
+                """Show the Trends window. It is called when the button "button_trends" is clicked."""
+                self.build_secondary_windows()
+                self.show_window(self.trends_window)
+                self.ui_trends.refresh()
+
+        def show_window(self, window):
+                """Show a secondary window, in front of the others if it was already open."""
+                window.show()
+                window.raise_()
+                window.activateWindow()
+
+        def build_secondary_windows(self):
                 """
-                self.patient_settings_window = QtWidgets.QMainWindow()
-                self.ui_patient_settings = Ui_patientSettingsWindow()
-                self.ui_patient_settings.setupUi(self.patient_settings_window)
-                self.patient_settings_window.show()
-                self.ui_patient_settings.signals.res.connect(self.read_patient_settings) #Obtain the values set by the user and send them to read_patient_settings() funtion
+                Build the Flow Calculator, Patient Settings and Trends windows, if they were not built yet, without showing them. Called once the
+                main window is ready, so that even the first click on their buttons only has to show them.
+                """
+                if self.flow_calculator_window is None:
+                        self.flow_calculator_window = QtWidgets.QMainWindow()
+                        self.ui_flow_calculator = Ui_FlowCalculatorWindow()
+                        self.ui_flow_calculator.setupUi(self.flow_calculator_window)
+                if self.patient_settings_window is None:
+                        self.patient_settings_window = QtWidgets.QMainWindow()
+                        self.ui_patient_settings = Ui_patientSettingsWindow()
+                        self.ui_patient_settings.setupUi(self.patient_settings_window)
+                        self.ui_patient_settings.signals.res.connect(self.read_patient_settings) #Obtain the values set by the user and send them to read_patient_settings() funtion
+                if self.trends_window is None:
+                        self.trends_window = QtWidgets.QMainWindow()
+                        self.ui_trends = Ui_TrendsWindow(self.trends)
+                        self.ui_trends.setupUi(self.trends_window)
 
         def setupUi(self, MainWindow):
                 """
@@ -843,31 +1234,15 @@ class Ui_MainWindow(object):
                 font = QtGui.QFont()
                 font.setPointSize(17)
                 self.label_x_axis.setFont(font)
-                labelStyle = {'color': '#FFF', 'font-size': '17pt'}
-                pg.setConfigOption('foreground', 'w')
                 self.label_x_axis.setAlignment(QtCore.Qt.AlignCenter)
                 self.label_x_axis.setObjectName("label_x_axis")
                 self.gridLayout_4.addWidget(self.label_x_axis, 3, 0, 1, 1)
-                self.graphicsView_pressure = pg.PlotWidget(self.frame_plots)
-                self.graphicsView_pressure.setMinimumSize(QtCore.QSize(0, 100))
-                self.graphicsView_pressure.setObjectName("graphicsView_pressure")
-                self.graphicsView_pressure.setLabel('left', "<html><body><p>P (cm H<span style=\" vertical-align:sub;\">2</span>O)</p></body></html>", **labelStyle)
-                # self.graphicsView_pressure.setConfigOption('foreground ', 'r')
-                
-                self.gridLayout_4.addWidget(self.graphicsView_pressure, 0, 0, 1, 1)
-                self.graphicsView_volume = pg.PlotWidget(self.frame_plots)
-                self.graphicsView_volume.setMinimumSize(QtCore.QSize(0, 100))
-                self.graphicsView_volume.setObjectName("graphicsView_volume")
-                self.graphicsView_volume.setLabel('left', 'Volume (mL)', **labelStyle)
-                # self.graphicsView_volume.setConfigOption('foreground',  'y')
-
-                self.gridLayout_4.addWidget(self.graphicsView_volume, 1, 0, 1, 1)
-                self.graphicsView_flow = pg.PlotWidget(self.frame_plots)
-                self.graphicsView_flow.setMinimumSize(QtCore.QSize(0, 100))
-                self.graphicsView_flow.setObjectName("graphicsView_flow")
-                self.graphicsView_flow.setLabel('left', 'Flow (lpm)', **labelStyle)
-                self.gridLayout_4.addWidget(self.graphicsView_flow, 2, 0, 1, 1)
-                # self.graphicsView_flow.setConfigOption('foreground', ' g')
+                self.comboBox_plot_window = QtWidgets.QComboBox(self.frame_plots)
+                self.comboBox_plot_window.setFont(font)
+                self.comboBox_plot_window.setObjectName("comboBox_plot_window")
+                self.comboBox_plot_window.addItems(["", "", "", ""])
+                self.gridLayout_4.addWidget(self.comboBox_plot_window, 3, 0, 1, 1, QtCore.Qt.AlignRight)
+                #The plots (pyqtgraph) are added by setup_plots() once the window is shown
 
                 self.gridLayout_3.addWidget(self.frame_plots, 0, 1, 1, 1)
                 self.frame_3 = QtWidgets.QFrame(self.centralwidget)
@@ -921,6 +1296,13 @@ class Ui_MainWindow(object):
                                                         "")
                 self.button_flowcalculator.setObjectName("button_flowcalculator")
                 self.verticalLayout_22.addWidget(self.button_flowcalculator)
+                self.button_trends = QtWidgets.QPushButton(self.frame_3)
+                font = QtGui.QFont()
+                font.setPointSize(18)
+                self.button_trends.setFont(font)
+                self.button_trends.setStyleSheet(self.button_flowcalculator.styleSheet())
+                self.button_trends.setObjectName("button_trends")
+                self.verticalLayout_22.addWidget(self.button_trends)
                 self.button_alarm = QtWidgets.QPushButton(self.frame_3)
                 self.button_alarm.setMinimumSize(QtCore.QSize(0, 60))
                 font = QtGui.QFont()
@@ -1577,35 +1959,133 @@ class Ui_MainWindow(object):
                 self.button_asis_cont_stop.clicked.connect(self.pressed_asis_cont_stop)
                 self.button_patient_settings.clicked.connect(self.openpatientSettings)
                 self.button_flowcalculator.clicked.connect(self.openFlowCalculator)
+                self.button_trends.clicked.connect(self.openTrends)
                 self.button_alarm.clicked.connect(self.reset_alarm)
                 self.button_cont_mand_asist_update.clicked.connect(self.pressed_cont_mand_asist_update)
                 self.button_asis_cont_update.clicked.connect(self.pressed_asis_cont_update)
-                #Setup for alarm system
-                GPIO.setwarnings(False)#Disable warnings (optional)
-                GPIO.setmode(GPIO.BCM)#Select GPIO mode
-                self.buzzer=22#Set buzzer, in this case, pin 23 as output
-                GPIO.setup(self.buzzer,GPIO.OUT)
+                self.comboBox_plot_window.currentIndexChanged.connect(self.select_plot_window)
                 #Initialize variables
                 self.threadpool = QThreadPool()
                 self.threadflag = 0
+                self.acquisition = None #acquisition.Acquisition of the running thread
                 self.frequency_value_input = 0
                 self.tidal_vol_volume_input = 0
                 self.insp_pause_input = 0
                 self.i_e_value_input = 0
                 self.pip_value_input = 0
                 self.trigger_value_input = 0
-                self.time_array = [] 
-                self.array_pressure = [] 
-                self.array_volume = []
-                self.array_flow = [] 
-                ############################IMPORTANT TO CHANGE THE ARDUINO ID TO THE ONE THAT YOU ARE USING#################################
-                self.arduino_id = '/dev/serial/by-id/usb-Arduino__www.arduino.cc__0042_75736303236351606110-if00'
-                ############################IMPORTANT TO CHANGE THE ARDUINO ID TO THE ONE THAT YOU ARE USING#################################
+                self.resistance_limit = None #cm H2O/L/sec. If set, the alarm goes off when the resistance of a breath is higher (None disables it)
+                self.plot_windows = (10, 30, 60, 300) #Seconds of waveform that can be shown in the plots (self.comboBox_plot_window)
+                self.plot_window = 10 #Seconds of waveform shown in the plots
+                self.plot_buckets = 1024 #Longer windows are drawn as this amount of min/max pairs, at least one per pixel of the plots
+                self.plot_fps = 30 #The plots are redrawn at most this amount of times per second, whatever the sample rate is
+                self.label_rate = 5 #The value labels are updated at most this amount of times per second
+                self.label_presenter = LabelPresenter(self.label_rate)
+                self.label_presenter.bind('frequency', self.label_frequency_value.setText, lambda value: str(round(value,2)))
+                self.label_presenter.bind('tidal_volume', self.label_tidal_vol_value.setText, lambda value: str(round(value,2)))
+                self.label_presenter.bind('pip', self.label_PIP_value.setText)
+                self.label_presenter.bind('plateau', self.label_plateau_value.setText)
+                self.label_presenter.bind('peep', self.label_PEEP_value.setText)
+                self.label_presenter.bind('IE', self.label_IE_value.setText)
+                self.label_presenter.bind('min_ventilation', self.label_min_vent_value.setText)
+                self.label_presenter.bind('compliance', self.label_complains_value.setText)
+                self.label_presenter.bind('mean', self.label_mean_value.setText)
+                self.label_presenter.bind('resistance', self.label_resistance_value.setText)
+                self.alarm_shown = False
+                self.arduino_settings = None #Last settings command sent to the Arduino
+                #self.acquisition_mode is used for the next connection: POLLED asks for every value writing "1" (works with every firmware),
+                #STREAM lets the Arduino send continuously, so the sample rate is set by the device instead of by the host.
 
                 print("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount()) #Know the amount of threads available in the machine
                 self.retranslateUi(MainWindow)
                 self.tab_widget_modes.setCurrentIndex(0)
                 QtCore.QMetaObject.connectSlotsByName(MainWindow)
+                #Everything that is not needed to show the window is done by finish_setup() once it is on the screen. Until then
+                #the ventilation modes and the alarm, trends, patient settings and flow calculator buttons are disabled (the last two
+                #build the secondary windows, which need the trends and pyqtgraph).
+                self.tab_widget_modes.setEnabled(False)
+                self.button_alarm.setEnabled(False)
+                self.button_trends.setEnabled(False)
+                self.button_patient_settings.setEnabled(False)
+                self.button_flowcalculator.setEnabled(False)
+                self.ready = False
+                self.first_paint = FirstPaint(MainWindow, self.finish_setup)
+                startup.mark('setupUi')
+
+        def finish_setup(self):
+                """
+                Second part of the setup, run once the window was painted for the first time: import pyqtgraph, NumPy and pyserial,
+                create the plots, the alarm engine and the buzzer, and open the serial port. Then the secondary windows are built.
+                """
+                if self.ready:
+                        return
+                startup.mark('first paint')
+                import_deferred()
+                startup.mark('deferred imports')
+                self.setup_plots()
+                #Setup for alarm system
+                self.buzzer_pin=22#Set buzzer, in this case, pin 23 as output
+                self.buzzer = BuzzerDriver(open_backend(self.gpio), self.buzzer_pin) #Plays the pattern of the alarm priority from its own thread
+                self.buzzer.start()
+                self.alarms = AlarmEngine() #Alarm rules (see alarms.DEFAULT_RULES), configured with the settings on every START/UPDATE
+                self.alarm_latency = AlarmLatency() #Time from a bad sample arriving on the serial port to the buzzer, for every alarm since the app started
+                self.acquisition_stats = AcquisitionStats() #Samples, decoding errors, sample rate... for every session since the app started
+                self.waveform = WaveformBuffer(8192) #Time, pressure, volume and flow of the last samples (enough for the plot window at several hundred Hz)
+                self.plot_refresher = PlotRefresher(self.waveform, self.update_plot_data, self.plot_fps)
+                #Min/max decimation of the waveform for each window, updated with the new samples only on every frame
+                self.decimators = {seconds: MinMaxDecimator(seconds, self.plot_buckets) for seconds in self.plot_windows}
+                self.trends = TrendStore() #Metrics of every breath since the app started, with their 1 s, 1 min and 10 min rollups
+                #We open the serial port using the Arduinos ID instead of the machines port number, letting us use the hardware in any machine.
+                #The port is opened once in the background and kept open; if the Arduino is unplugged it is reopened when it comes back.
+                self.connection = SerialConnection(self.arduino_id) if self.replay is None else self.replay
+                self.connection.start()
+                app = QtWidgets.QApplication.instance()
+                app.aboutToQuit.connect(self.connection.close)
+                app.aboutToQuit.connect(self.buzzer.close)
+                if self.publish_port is not None or self.publish_ws_port is not None: #Stream for a central station, sent from its own thread
+                        from publisher import TelemetryPublisher
+                        self.publisher = TelemetryPublisher(self.publish_port, self.publish_ws_port, self.publish_host)
+                        self.publisher.start()
+                        app.aboutToQuit.connect(self.publisher.stop)
+                if self.metrics_port is not None: #Counters for unattended units, served from its own thread
+                        from health import HealthServer
+                        self.health_server = HealthServer(self.metrics_port, self.collect_metrics, self.health_problems, self.metrics_host)
+                        self.health_server.start()
+                        app.aboutToQuit.connect(self.health_server.stop)
+                self.tab_widget_modes.setEnabled(True)
+                self.button_alarm.setEnabled(True)
+                self.button_trends.setEnabled(True)
+                self.button_patient_settings.setEnabled(True)
+                self.button_flowcalculator.setEnabled(True)
+                self.ready = True
+                startup.mark('ready')
+                print(startup.summary())
+                QtCore.QTimer.singleShot(0, self.build_secondary_windows)
+
+        def setup_plots(self):
+                """Create the pressure, volume and flow plots in the plot frame. Called by finish_setup(), pyqtgraph is imported then."""
+                labelStyle = {'color': '#FFF', 'font-size': '17pt'}
+                pg.setConfigOption('foreground', 'w')
+                self.graphicsView_pressure = pg.PlotWidget(self.frame_plots)
+                self.graphicsView_pressure.setMinimumSize(QtCore.QSize(0, 100))
+                self.graphicsView_pressure.setObjectName("graphicsView_pressure")
+                self.graphicsView_pressure.setLabel('left', "<html><body><p>P (cm H<span style=\" vertical-align:sub;\">2</span>O)</p></body></html>", **labelStyle)
+                # self.graphicsView_pressure.setConfigOption('foreground ', 'r')
+                
+                self.gridLayout_4.addWidget(self.graphicsView_pressure, 0, 0, 1, 1)
+                self.graphicsView_volume = pg.PlotWidget(self.frame_plots)
+                self.graphicsView_volume.setMinimumSize(QtCore.QSize(0, 100))
+                self.graphicsView_volume.setObjectName("graphicsView_volume")
+                self.graphicsView_volume.setLabel('left', 'Volume (mL)', **labelStyle)
+                # self.graphicsView_volume.setConfigOption('foreground',  'y')
+
+                self.gridLayout_4.addWidget(self.graphicsView_volume, 1, 0, 1, 1)
+                self.graphicsView_flow = pg.PlotWidget(self.frame_plots)
+                self.graphicsView_flow.setMinimumSize(QtCore.QSize(0, 100))
+                self.graphicsView_flow.setObjectName("graphicsView_flow")
+                self.graphicsView_flow.setLabel('left', 'Flow (lpm)', **labelStyle)
+                self.gridLayout_4.addWidget(self.graphicsView_flow, 2, 0, 1, 1)
+                # self.graphicsView_flow.setConfigOption('foreground', ' g')
 
         def retranslateUi(self, MainWindow):
                 """This method retranslateUi() sets the text and titles of the widgets."""
@@ -1627,10 +2107,15 @@ class Ui_MainWindow(object):
                 self.label_complains_value.setText(_translate("MainWindow", "450"))
                 self.label_complains_unit.setText(_translate("MainWindow", "<html><head/><body><p>ml/cm H<span style=\" vertical-align:sub;\">2</span>O</p></body></html>"))
                 self.label_x_axis.setText(_translate("MainWindow", "Time [s]"))
+                self.comboBox_plot_window.setItemText(0, _translate("MainWindow", "10 s"))
+                self.comboBox_plot_window.setItemText(1, _translate("MainWindow", "30 s"))
+                self.comboBox_plot_window.setItemText(2, _translate("MainWindow", "1 min"))
+                self.comboBox_plot_window.setItemText(3, _translate("MainWindow", "5 min"))
                 self.button_patient_settings.setText(_translate("MainWindow", "PATIENT \n"
                         " SETTINGS"))
                 self.button_flowcalculator.setText(_translate("MainWindow", "FLOW \n"
                         " CALCULATOR"))
+                self.button_trends.setText(_translate("MainWindow", "TRENDS"))
                 self.label_cont_mand_vent_frequency.setText(_translate("MainWindow", "Frequency"))
                 self.label_cont_mand_vent_tid_vol.setText(_translate("MainWindow", "Tidal Volume"))
                 self.label_cont_mand_vent_insp_pause.setText(_translate("MainWindow", "Insp. Pause"))
@@ -1693,10 +2178,13 @@ class Ui_MainWindow(object):
                 #Concatenate each value, and set it up as the Arduino is expecting to read it.
                 write_Arduino = ('C,'+str(self.frequency_value_input)+','+str(self.tidal_vol_volume_input) + ','+str(self.insp_pause_input)+','+
                 str(self.i_e_value_input)+','+str(self.pip_value_input)+'\n')
-                #We open the serial port using the Arduinos ID instead of the machines port number, letting us use the hardware in any machine. 
-                #Everytime you use a new hardware or change arduino, you have to change the ID number.
-                self.arduino_controller = serial.Serial(self.arduino_id, 115200, timeout=1)
-                time.sleep(1) #Wait one second to make sure that the connection was established
+                #The serial port is already open: self.connection keeps it open and reconnects if the Arduino is unplugged.
+                self.arduino_controller = self.connection.get(0)
+                if self.arduino_controller is None:
+                        QtWidgets.QMessageBox.information(QtWidgets.QMainWindow(), "Attention!","The Arduino is not connected", QtWidgets.QMessageBox.Ok)
+                        return
+                self.arduino_settings = write_Arduino #Sent again if the Arduino has to be reconnected
+                self.configure_alarms(self.arduino_settings[0]) #Check the alarms with the new settings
                 self.arduino_controller.write(write_Arduino.encode('utf-8')) #Write to the arduino the concatenated string 
                 #Update the values in the GUI
                 self.label_frequency_value.setText(str(self.frequency_value_input))
@@ -1715,15 +2203,15 @@ class Ui_MainWindow(object):
                 Configuration for the STOP button inside the continuos mandatory ventilation tab section
                 """
                 self.threadflag = 1 #Update the threadflag variable to stop the current thread in the while loop in readArduino() function
+                if self.acquisition is not None:
+                        self.acquisition.wake() #Do not wait for the serial read in progress
                 #Clear all the plots
                 self.graphicsView_pressure.clear() 
                 self.graphicsView_volume.clear()
                 self.graphicsView_flow.clear()
                 #Update GUI
                 self.button_cont_mand_asist_start.setStyleSheet("background-color: rgb(169, 160, 157);") #Update the color button for START
-                self.button_cont_mand_asist_update.setEnabled(False)
-                self.button_cont_mand_asist_start.setEnabled(True)
-                time.sleep(0.5) #Wait for half a second until the thread stops correctly
+                self.button_cont_mand_asist_update.setEnabled(False) #START is enabled again by thread_complete() once the thread stopped
 
         def pressed_cont_mand_asist_update(self):
                 """
@@ -1738,6 +2226,8 @@ class Ui_MainWindow(object):
                 #Concatenate each value, and set it up as the Arduino is expecting to read it.
                 write_Arduino = ('22C,'+str(self.frequency_value_input)+','+str(self.tidal_vol_volume_input) + ','+str(self.insp_pause_input)+','+
                 str(self.i_e_value_input)+','+str(self.pip_value_input)+'\n')
+                self.arduino_settings = write_Arduino[len('22'):] #Start command with the new values, sent again if the Arduino has to be reconnected
+                self.configure_alarms(self.arduino_settings[0]) #Check the alarms with the new settings
                 self.arduino_controller.write(write_Arduino.encode('utf-8')) #Write to the arduino
                 #Update the values in the GUI
                 self.label_frequency_value.setText(str(self.frequency_value_input))
@@ -1761,10 +2251,13 @@ class Ui_MainWindow(object):
                         #Concatenate each value, and set it up as the Arduino is expecting to read it.
                         write_Arduino = ('P,'+str(self.frequency_value_input)+','+str(self.tidal_vol_volume_input) + ','+str(self.insp_pause_input)+','+
                         str(self.trigger_value_input)+','+str(self.pip_value_input)+'\n')
-                        #We open the serial port using the Arduinos ID instead of the machines port number, letting us use the hardware in any machine. 
-                        #Everytime you use a new hardware or change arduino, you have to change the ID number.
-                        self.arduino_controller = serial.Serial(self.arduino_id, 115200, timeout=1)  #RPI
-                        time.sleep(1) #Wait one second to make sure that the connection was established
+                        #The serial port is already open: self.connection keeps it open and reconnects if the Arduino is unplugged.
+                        self.arduino_controller = self.connection.get(0)
+                        if self.arduino_controller is None:
+                                QtWidgets.QMessageBox.information(QtWidgets.QMainWindow(), "Attention!","The Arduino is not connected", QtWidgets.QMessageBox.Ok)
+                                return
+                        self.arduino_settings = write_Arduino #Sent again if the Arduino has to be reconnected
+                        self.configure_alarms(self.arduino_settings[0]) #Check the alarms with the new settings
                         self.arduino_controller.write(write_Arduino.encode('utf-8')) #Write to the Arduino
 
                         #Update the values in the GUI
@@ -1782,10 +2275,13 @@ class Ui_MainWindow(object):
                         #Concatenate each value, and set it up as the Arduino is expecting to read it.
                         write_Arduino = ('F,'+str(self.frequency_value_input)+','+str(self.tidal_vol_volume_input) + ','+str(self.insp_pause_input)+','+
                         str(self.trigger_value_input)+','+str(self.pip_value_input)+'\n')
-                        #We open the serial port using the Arduinos ID instead of the machines port number, letting us use the hardware in any machine. 
-                        #Everytime you use a new hardware or change arduino, you have to change the ID number.
-                        self.arduino_controller = serial.Serial(self.arduino_id, 115200, timeout=1)  #RPI
-                        time.sleep(1) #Wait one second to make sure that the connection was established
+                        #The serial port is already open: self.connection keeps it open and reconnects if the Arduino is unplugged.
+                        self.arduino_controller = self.connection.get(0)
+                        if self.arduino_controller is None:
+                                QtWidgets.QMessageBox.information(QtWidgets.QMainWindow(), "Attention!","The Arduino is not connected", QtWidgets.QMessageBox.Ok)
+                                return
+                        self.arduino_settings = write_Arduino #Sent again if the Arduino has to be reconnected
+                        self.configure_alarms(self.arduino_settings[0]) #Check the alarms with the new settings
                         self.arduino_controller.write(write_Arduino.encode('utf-8'))#Write to the Arduino
 
                         #Update the values in the GUI
@@ -1808,15 +2304,15 @@ class Ui_MainWindow(object):
                 Configuration for STOP BUTTON inside the assisted control tab section
                 """
                 self.threadflag = 1 #Update the threadflag variable to stop the current thread in the while loop in readArduino() function
+                if self.acquisition is not None:
+                        self.acquisition.wake() #Do not wait for the serial read in progress
                 #Clear all the plots
                 self.graphicsView_pressure.clear()
                 self.graphicsView_volume.clear()
                 self.graphicsView_flow.clear()
                 #Update GUI
                 self.button_asis_cont_start.setStyleSheet("background-color: rgb(169, 160, 157);")  #Update the color button for START
-                self.button_asis_cont_update.setEnabled(False)
-                self.button_asis_cont_start.setEnabled(True)
-                time.sleep(0.5) #Wait for half a second until the thread stops correctly
+                self.button_asis_cont_update.setEnabled(False) #START is enabled again by thread_complete() once the thread stopped
 
         def pressed_asis_cont_update(self):
                 """
@@ -1833,6 +2329,8 @@ class Ui_MainWindow(object):
                         #Concatenate each value, and set it up as the Arduino is expecting to read it.
                         write_Arduino = ('P,'+str(self.frequency_value_input)+','+str(self.tidal_vol_volume_input) + ','+str(self.insp_pause_input)+','+
                         str(self.trigger_value_input)+','+str(self.pip_value_input)+'\n')
+                        self.arduino_settings = write_Arduino #Sent again if the Arduino has to be reconnected
+                        self.configure_alarms(self.arduino_settings[0]) #Check the alarms with the new settings
                         self.arduino_controller.write(write_Arduino.encode('utf-8'))#Write to the Arduino
                         #Update the values in the GUI
                         self.label_frequency_value.setText(str(self.frequency_value_input))
@@ -1844,6 +2342,8 @@ class Ui_MainWindow(object):
                         write_Arduino = ('F,'+str(self.frequency_value_input)+','+str(self.tidal_vol_volume_input) + ','+str(self.insp_pause_input)+','+
                         str(self.trigger_value_input)+','+str(self.pip_value_input)+'\n')
                         print(write_Arduino.encode('utf-8'))
+                        self.arduino_settings = write_Arduino #Sent again if the Arduino has to be reconnected
+                        self.configure_alarms(self.arduino_settings[0]) #Check the alarms with the new settings
                         self.arduino_controller.write(write_Arduino.encode('utf-8'))#Write to the Arduino
                         #Update the values in the GUI
                         self.label_frequency_value.setText(str(self.frequency_value_input))
@@ -1855,76 +2355,50 @@ class Ui_MainWindow(object):
         def readArduino(self, progress_callback):
                 """
                 This function will be executed continuously in a new thread different from the main one where the UI is running. This way the GUI will be responsive
-                while the readArduino() function is continuosly plotting new data in the graphs.
+                while the readArduino() function is continuosly plotting new data in the graphs. The loop itself (reading, alarms and metrics) is the same one
+                used by the headless mode, see acquisition.Acquisition.
                 """
-                self.data_line_pressure =  self.graphicsView_pressure.plot(self.time_array, self.array_pressure, pen=pg.mkPen('r', width=1))
-                self.data_line_volume =  self.graphicsView_volume.plot(self.time_array, self.array_volume, pen=pg.mkPen('g', width=1))
-                self.data_line_flow =  self.graphicsView_flow.plot(self.time_array, self.array_flow, pen=pg.mkPen('y', width=1))
-                #Initialize variables
-                i=0
-                flag = 0
-                value_str = "1" #Value that we have to send to the Arduino in order for it to send data
-                self.arduino_controller.flushInput() #At this point we have to flush the input buffer, discarding all its contents. To be sure that there is not any previous caracter
-
-                while True:
-                        time.sleep(0.06) # We take 6 ms between each value. Due to RPI
-                        if flag < 2:
-                                #We need to make sure that Arduino is sending reliable data, therefore, we wait for it to send two values and then keep reading continuosly
-                                self.arduino_controller.write(value_str.encode('utf-8')) #Write "1" to the Arduino to receive data from it.
-                                arduinoString_noDecode = self.arduino_controller.readline()
-                                flag += 1
-                                continue
-                        try:
-                                self.arduino_controller.write(value_str.encode('utf-8')) #Write "1" to the Arduino to receive data from it.
-                                arduinoString = self.arduino_controller.readline().decode("utf-8").rstrip("\n") #read the text line from serial port and decode from byte format to ASCII
-                                self.arduino_list = (list(map(str, arduinoString.split(',')))) #Split by commas the received text by the arduino and map them all as Strings
-                                if len(self.arduino_list) != 9: # The expected amount of value to be received is 9, therefore, if it is different to 9, we will wait for the next line
-                                        continue
-                                #Safe each value from the received list to a corresponding variable.
-                                self.pressure_cm = float(self.arduino_list[0])
-                                self.flow_lpm = float(self.arduino_list[1])
-                                self.volume_value = float(self.arduino_list[2])
-                                self.frequency = float(self.arduino_list[3]) # Units:bpm
-                                self.IE_value = float(self.arduino_list[4])
-                                self.pip_value = float(self.arduino_list[5]) #Units:cm H2O
-                                self.plateau_value = float(self.arduino_list[6])
-                                self.peep_value = float(self.arduino_list[7]) #Units:cm H2O
-                                self.error_pvf = (self.arduino_list[8]) #This values will indicate if there is an error with pressure, volume or flow. If everything is fine it should be "000"
-                                                                        #but if pressure fails then we will receive "P00", if volume "0V0", if flow "00F", if all "PVF"
-                                self.mean_value = round(0.5 * (self.pip_value - self.peep_value) * (1/self.IE_value)+self.peep_value,2)
-                                self.compliance_value = round(self.volume_value / (self.plateau_value - self.peep_value),2) # ml/cm H2O
-                                self.min_ventilation_value = round(self.volume_value * self.frequency /1000,2) #L/min
-                                # self.resistance_value = round((self.pip_value - self.plateau_value)*60/max(list_flow),2) #cm H2O/L/sec
-                                #Update GUI values
-                                self.label_frequency_value.setText(str(round(self.frequency,2)))
-                                self.label_tidal_vol_value.setText(str(round(self.volume_value,2)))
-                                self.label_PIP_value.setText(str(self.pip_value))
-                                self.label_plateau_value.setText(str(self.plateau_value))
-                                self.label_PEEP_value.setText(str(self.peep_value))
-                                self.label_IE_value.setText(str(self.IE_value))
-                                self.label_min_vent_value.setText(str(self.min_ventilation_value))
-                                self.label_complains_value.setText(str(self.compliance_value))
-                                self.label_mean_value.setText(str(self.mean_value))
-                                # self.label_resistance_value.setText(str(self.resistance_value))
-
-                                if self.pip_value > float(self.pip_value_input) or self.volume_value < self.tidal_vol_volume_input or abs(self.volume_value - self.tidal_vol_volume_input) > 20 or abs(self.IE_value - self.i_e_value_input)>0.2 :
-                                        #If any of it is True, then, turn on the alarm. 
-                                        GPIO.output(self.buzzer,GPIO.HIGH)
-                                        self.spinBox_cont_mand_vent_PIP_value.setStyleSheet('QLabel#nom_plan_label {color: red}')#change value to red
-                                
-                                if self.error_pvf != "000": #if the salf value is different from "000" (pressure, volume and flow correct) then, turn alarm ON. 
-                                        GPIO.output(self.buzzer,GPIO.HIGH)
-
-                        except Exception as e: #If there is any error, the system must keep working, therefore, we print the error of the error that the user made for them to fix
-                                                #but the system will still keep working.
-                                print(e)
-                                continue
-                        progress_callback.emit(arduinoString) #What we want to send as a callback during the execution of the thread
-                        if self.threadflag == 1:
-                                self.threadflag = 0
-                                break
+                recorder = None
+                if self.record_directory is not None: #The recorder writes from its own thread, a slow disk never delays the acquisition
+                        recorder = SessionRecorder(self.record_directory)
+                        recorder.start(self.start_time)
+                if self.publisher is not None:
+                        self.publisher.start_session(self.start_time)
+                self.acquisition = Acquisition(self.connection, self.acquisition_mode, self.start_time, alarms=self.alarms,
+                        on_alarm=self.alarm_on, settings=lambda: self.arduino_settings, on_reconnect=self.set_arduino_controller, recorder=recorder, latency=self.alarm_latency, clock=self.replay.clock if self.replay is not None else None,
+                        publisher=self.publisher, stats=self.acquisition_stats)
+                def publish(batch):
+                        self.acquisition_stats.published += 1 #Queued in the GUI event loop until progress_fn() gets it
+                        progress_callback.emit(batch)
+                try:
+                        self.acquisition.run(publish, self.stop_requested) #What we want to send as a callback during the execution of the thread
+                finally:
+                        if recorder is not None:
+                                recorder.stop()
+
+        def stop_requested(self):
+                """True once the STOP button was pushed (the threadflag is reset for the next START)."""
+                if self.threadflag == 1:
+                        self.threadflag = 0
+                        return True
+                return False
+
+        def configure_alarms(self, mode):
+                """Check the alarm rules of mode ("C", "P" or "F") with the settings of the last START/UPDATE."""
+                IE = float('2.' + str(self.i_e_value_input)) if mode == 'C' else None #The I:E setting is shown as 1:2.<value>
+                self.alarms.configure(mode, pip=self.pip_value_input, tidal_volume=self.tidal_vol_volume_input, IE=IE, resistance_limit=self.resistance_limit)
+
+        def alarm_on(self):
+                self.buzzer.play(self.alarms.priority() or HIGH)
+
+        def set_arduino_controller(self, port):
+                """Called by the acquisition thread when the Arduino was reconnected, so the UPDATE buttons write to the new port."""
+                self.arduino_controller = port
+
         def reset_alarm(self):#This function will be called when the self.button_alarm button is pushed. It will reset the alarm.
-                GPIO.output(self.buzzer,GPIO.LOW)#Turn off the alarm noise
+                self.buzzer.stop()#Turn off the alarm noise
+                self.alarms.reset()
+                self.alarm_shown = False
                 #Set the possible failures to black
                 self.spinBox_cont_mand_vent_PIP_value.setStyleSheet('QLabel#nom_plan_label {color: black}') 
                 self.spinBox_cont_mand_vent_freq_value.setStyleSheet('QLabel#nom_plan_label {color: black}') 
@@ -1933,57 +2407,101 @@ class Ui_MainWindow(object):
 
         def update_plot_data(self): 
                 """
-                This function is called by the progress_fn() function. It will be updated constantly while the thread is running and readArduino() 
-                function is receiving new values. It will store data for 10 seconds and then it will be updating the plot removing the first element
-                of the Array and adding one at the end.
+                This function is called by self.plot_refresher self.plot_fps times per second (30 by default), only when new values were
+                added to the waveform buffer since the previous frame. It plots the last self.plot_window seconds (10 by default). The plots
+                receive views of the buffer, so no array is copied or rebuilt. If the window has more samples than 2 * self.plot_buckets,
+                the min/max decimation of the window is drawn instead, so the time per frame does not grow with the length of the window
+                and no spike is hidden.
                 """
-                
-                if (time.time() - self.start_time > 10): #Once it has stored data for 10 seconds, starts to update.
-                        # Remove the first element (updating values)
-                        self.time_array = self.time_array[1:]
-                        self.array_pressure = self.array_pressure[1:] 
-                        self.array_volume = self.array_volume[1:] 
-                        self.array_flow = self.array_flow[1:] 
-                # Add a new measured value. (By default appends at the end)
-                self.array_pressure.append(self.pressure_cm) 
-                self.array_volume.append(self.volume_value)  
-                self.array_flow.append(self.flow_lpm) 
-                self.time_array.append(time.time() - self.start_time)
+                for decimator in self.decimators.values(): #Only the samples added since the previous frame are reduced
+                        decimator.update(self.waveform)
+                time_array, array_pressure, array_volume, array_flow = self.waveform.window(self.plot_window)
+                if len(time_array) > 2 * self.plot_buckets:
+                        time_array, array_pressure, array_volume, array_flow = self.decimators[self.plot_window].window()
                 # Update the plot with the new pressure, flow and volume data.
-                self.data_line_pressure.setData(self.time_array, self.array_pressure, pen=pg.mkPen('r', width=1))  
-                self.data_line_flow.setData(self.time_array, self.array_flow, pen=pg.mkPen('g', width=1))  
-                self.data_line_volume.setData(self.time_array, self.array_volume, pen=pg.mkPen('y', width=1))
+                self.data_line_pressure.setData(time_array, array_pressure, pen=pg.mkPen('r', width=1))  
+                self.data_line_flow.setData(time_array, array_flow, pen=pg.mkPen('g', width=1))  
+                self.data_line_volume.setData(time_array, array_volume, pen=pg.mkPen('y', width=1))
+
+        def select_plot_window(self, index):
+                """Show the window selected in self.comboBox_plot_window, from the next frame."""
+                self.plot_window = self.plot_windows[index]
+                if self.ready:
+                        self.plot_refresher.invalidate()
 
         def thread_complete(self):
                 """
-                This function is executed once the thread is ended (when the self.threadflag!=0). It will clear all the arrays,
-                flush the input left in the serial communication and send to the Arduino the stop command, and close the serial
-                communication.
+                This function is executed once the thread is ended (when the self.threadflag!=0). It will clear the waveform buffer,
+                flush the input left in the serial communication and send to the Arduino the stop command. The serial port is kept
+                open by self.connection for the next START, and the START buttons are enabled again.
                 """
-                self.array_pressure.clear() 
-                self.array_volume.clear()
-                self.array_flow.clear() 
-                self.time_array.clear() 
-                self.arduino_controller.flushInput()
-                write_Arduino = ('22'+'\n')
-                self.arduino_controller.write(write_Arduino.encode('utf-8'))
-                self.arduino_controller.close()
+                self.acquisition = None
+                self.button_cont_mand_asist_start.setEnabled(True)
+                self.button_asis_cont_start.setEnabled(True)
+                self.plot_refresher.stop()
+                self.label_presenter.stop()
+                self.waveform.reset()
+                print(self.alarm_latency.summary())
+                try:
+                        self.arduino_controller.flushInput()
+                        write_Arduino = ('22'+'\n')
+                        self.arduino_controller.write(write_Arduino.encode('utf-8'))
+                except (serial.SerialException, OSError) as e: #Unplugged, it will be reconnected by self.connection
+                        print(e)
+                        self.connection.lost(self.arduino_controller)
 
         def progress_fn(self, value):
                 """
                 This function tracks the progress and will stop when the thread is completed. It is controlled by the pyqtSignal() function 
-                from the WorkerSignals class. Thius function will check that the Arduino sent the expected amount of values (9) and that 
-                the main values (pressure, flow and volume) are not empty and call the function that will update the plots.
+                from the WorkerSignals class. It runs in the GUI thread and receives every batch of samples decoded by readArduino() (which
+                already checked that the Arduino sent the expected values). The samples are stored in the waveform buffer and the metrics are
+                handed to self.label_presenter (mean pressure, compliance and minute ventilation only when a breath ends). Neither the plots nor the labels are redrawn here: self.plot_refresher and self.label_presenter
+                do it at their own rate.
                 """
-                if len(self.arduino_list) ==9 and self.pressure_cm != ""and self.flow_lpm != "" and self.volume_value!="":  
-                        self.update_plot_data()
+                self.acquisition_stats.delivered += 1
+                # Add the new measured values, with a break where samples were lost. (The oldest ones are overwritten once the buffer is full)
+                self.waveform.extend(value.times, value.samples, value.gaps)
+                self.label_presenter.update(value.metrics._asdict())
+                for breath in value.breaths: #Derived values are only updated once per breath
+                        self.trends.add(self.start_time + breath.start + breath.inspiration + breath.expiration, breath.metrics)
+                        #Compliance and resistance are None without an inspiratory pause: show "-" instead of the last known value
+                        self.label_presenter.update({'mean': breath.metrics.mean, 'compliance': "-" if breath.metrics.compliance is None else breath.metrics.compliance,
+                                'min_ventilation': breath.metrics.min_ventilation, 'resistance': "-" if breath.metrics.resistance is None else breath.metrics.resistance})
+                if value.alarm and not self.alarm_shown:
+                        self.spinBox_cont_mand_vent_PIP_value.setStyleSheet('QLabel#nom_plan_label {color: red}')#change value to red
+                        self.alarm_shown = True
+                if value.alarm:
+                        self.button_alarm.setToolTip(", ".join(self.alarms.active()) + "\n" + self.alarm_latency.summary())
 
+        def collect_metrics(self, metrics):
+                """Add the counters of the acquisition, the alarms and the plots to metrics (a health.MetricFamilies). Called by the metrics server thread."""
+                from health import add_acquisition, add_latency
+                add_acquisition(metrics, self.acquisition_stats)
+                add_latency(metrics, self.alarm_latency)
+                refresher = self.plot_refresher
+                metrics.histogram('plot_frame_seconds', "Time taken to redraw the plots", refresher.frame_time)
+                metrics.add('plot_frames_total', 'counter', "Frames of the plots redrawn", refresher.frames_drawn)
+                metrics.add('plot_frames_skipped_total', 'counter', "Frames of the plots skipped because no sample arrived", refresher.frames_skipped)
+                if self.publisher is not None:
+                        metrics.add('publisher_subscribers', 'gauge', "Telemetry subscribers connected", len(self.publisher.subscribers))
+                        metrics.add('publisher_dropped_total', 'counter', "Batches not streamed because the publisher queue was full", self.publisher.dropped)
 
+        def health_problems(self):
+                from health import acquisition_problems
+                return acquisition_problems(self.acquisition_stats)
 
         def sendThread(self):
                 """
                 This function is the responsible one to initialize the threads and connect the signals to the corresponding functions. 
                 """
+                #Create the plot lines (from the GUI thread) and start redrawing them at self.plot_fps
+                time_array, array_pressure, array_volume, array_flow = self.waveform.view()
+                self.data_line_pressure =  self.graphicsView_pressure.plot(time_array, array_pressure, pen=pg.mkPen('r', width=1))
+                self.data_line_volume =  self.graphicsView_volume.plot(time_array, array_volume, pen=pg.mkPen('g', width=1))
+                self.data_line_flow =  self.graphicsView_flow.plot(time_array, array_flow, pen=pg.mkPen('y', width=1))
+                self.plot_refresher.set_fps(self.plot_fps)
+                self.plot_refresher.start()
+                self.label_presenter.start() #The START buttons wrote the settings in the labels, forget what the presenter showed before
                 #Pass the function to execute
                 self.worker = Worker(self.readArduino)
                 #Connect the worker handler functions to these signals to receive notification of completion and the result of threads.
@@ -1995,17 +2513,67 @@ class Ui_MainWindow(object):
 """
 Initialization of the app
 """
-import pyqtgraph as pg
-import serial
 import time
 import _thread
 import subprocess
 
 if __name__ == "__main__":
         import sys
-        app = QtWidgets.QApplication(sys.argv)
+        import argparse
+        import headless
+        parser = argparse.ArgumentParser(description="ATMO-Vent")
+        parser.add_argument('--headless', action='store_true', help="run the acquisition, metrics and alarms without GUI")
+        parser.add_argument('--device', default=None, help="serial device of the Arduino (default: ARDUINO_ID)")
+        parser.add_argument('--acquisition', choices=MODES, default=None, help="acquisition mode (default: %s)" % POLLED)
+        parser.add_argument('--record', default=None, metavar='DIRECTORY', help="record every session at full rate in DIRECTORY")
+        parser.add_argument('--replay', nargs='+', default=None, metavar='FILE', help="play recorded sessions instead of reading from the Arduino")
+        parser.add_argument('--replay-speed', default='1', help="playback speed of --replay, e.g. 1 or 10, or max (default 1)")
+        parser.add_argument('--monitor', nargs='+', default=None, metavar='DEVICE', help="follow several Arduinos at once in a dashboard, "
+                "each one given as NAME=PATH or PATH, and started with the headless ventilation settings")
+        parser.add_argument('--publish', type=int, default=None, metavar='PORT', help="stream the telemetry to the subscribers of TCP PORT (a session file)")
+        parser.add_argument('--publish-ws', type=int, default=None, metavar='PORT', help="stream the telemetry to the WebSocket subscribers of PORT")
+        parser.add_argument('--publish-host', default='127.0.0.1', metavar='ADDRESS', help="address of --publish and --publish-ws, e.g. 0.0.0.0 "
+                "for a central station on the network (default: 127.0.0.1, only the local host)")
+        parser.add_argument('--metrics', type=int, default=None, metavar='PORT', help="serve the counters of the acquisition on http://host:PORT/metrics and /health")
+        parser.add_argument('--metrics-host', default='127.0.0.1', metavar='ADDRESS', help="address of --metrics, e.g. 0.0.0.0 to be scraped "
+                "from other hosts (default: 127.0.0.1, only the local host)")
+        parser.add_argument('--gpio', choices=BACKENDS, default='auto', help="GPIO backend of the buzzer (default: the first one available, a simulated buzzer if none)")
+        headless.add_arguments(parser)
+        args, qt_args = parser.parse_known_args()
+        replay = None
+        if args.replay is not None:
+                from replay import SessionReplay, parse_speed #Only imported when needed, it loads NumPy
+                try:
+                        speed = parse_speed(args.replay_speed)
+                except (ValueError, argparse.ArgumentTypeError) as e:
+                        parser.error("argument --replay-speed: %s" % e)
+                replay = SessionReplay(args.replay, speed)
+                args.acquisition = args.acquisition or STREAM #Played at the selected speed, polling would set its own
+        devices = None
+        if args.monitor is not None:
+                from monitor import parse_device
+                devices = [parse_device(spec) for spec in args.monitor]
+        if args.headless:
+                sys.exit(headless.run(args, args.device or ARDUINO_ID, replay) if devices is None else headless.run_monitor(args, devices))
+        startup.mark('imports')
+        app = QtWidgets.QApplication(sys.argv[:1] + qt_args)
+        startup.mark('QApplication')
+        if devices is not None:
+                import_deferred()
+                monitor, buzzer = headless.open_monitor(args, devices)
+                DashboardWindow = QtWidgets.QMainWindow()
+                dashboard = Ui_DashboardWindow(monitor, buzzer)
+                dashboard.setupUi(DashboardWindow)
+                app.aboutToQuit.connect(monitor.stop)
+                app.aboutToQuit.connect(buzzer.close)
+                server = headless.open_health(args, *headless.monitor_metrics(devices))
+                if server is not None:
+                        app.aboutToQuit.connect(server.stop)
+                DashboardWindow.show()
+                sys.exit(app.exec_())
         MainWindow = QtWidgets.QMainWindow()
-        ui = Ui_MainWindow()
+        ui = Ui_MainWindow(args.device, args.acquisition, args.record, replay, args.gpio, args.publish, args.publish_ws, args.metrics,
+                args.metrics_host, args.publish_host)
         ui.setupUi(MainWindow)
-        MainWindow.show()
+        MainWindow.show() #The rest of the setup is done by ui.finish_setup() once the window is painted
         sys.exit(app.exec_())
@@ -0,0 +1,164 @@
+"""
+Ventilation metrics shown in the GUI.
+"""
+from collections import namedtuple
+import numpy as np
+
+Metrics = namedtuple('Metrics', ['frequency', 'tidal_volume', 'pip', 'plateau', 'peep', 'IE', 'mean', 'compliance', 'min_ventilation', 'resistance'])
+Metrics.__doc__ = '''
+Values shown in the labels of the main window. Units: frequency bpm, tidal_volume mL, pip/plateau/peep/mean cm H2O,
+compliance mL/cm H2O, min_ventilation L/min, resistance cm H2O/L/s.
+'''
+
+def firmware_metrics(sample):
+        """
+        Metrics of a sample using the values already computed by the Arduino (frequency, I:E, PIP, plateau and PEEP).
+        Mean pressure, compliance and minute ventilation are derived from them. The resistance needs the peak flow of the
+        breath, so it is left as None.
+        """
+        mean_value = round(0.5 * (sample.pip - sample.peep) * (1/sample.IE) + sample.peep, 2) if sample.IE else float('nan')
+        compliance_value = round(sample.volume / (sample.plateau - sample.peep), 2) if sample.plateau != sample.peep else float('nan') # ml/cm H2O
+        min_ventilation_value = round(sample.volume * sample.frequency / 1000, 2) #L/min
+        return Metrics(sample.frequency, sample.volume, sample.pip, sample.plateau, sample.peep, sample.IE,
+                mean_value, compliance_value, min_ventilation_value, None)
+
+def integrate(y, x):
+        """Trapezoidal integral of y over x (NumPy arrays of the same length)."""
+        return float(np.dot(y[1:] + y[:-1], np.diff(x))) * 0.5
+
+def measured_metrics(sample):
+        """
+        Metrics of a sample with only the values measured by the Arduino. Mean pressure, compliance, minute ventilation and
+        resistance are left as None: they are derived once per breath by BreathDetector.
+        """
+        return Metrics(sample.frequency, sample.volume, sample.pip, sample.plateau, sample.peep, sample.IE, None, None, None, None)
+
+Breath = namedtuple('Breath', ['start', 'inspiration', 'expiration', 'metrics', 'firmware'])
+Breath.__doc__ = '''
+One complete breath found by BreathDetector: start time, inspiration and expiration durations (s), metrics derived by
+the host from the waveform (Metrics) and the metrics computed by the Arduino at the end of the breath (Metrics), so both
+can be compared.
+'''
+
+class BreathDetector(object):
+        '''
+        Streaming segmentation of the waveform into breaths, using the flow:
+        - a breath starts when the flow rises above flow_threshold (L/min), which also ends the previous breath,
+        - its expiration starts when the flow falls below -flow_threshold. The inspiratory pause (flow close to 0)
+          is part of the inspiration.
+        Each phase must last at least min_phase seconds, so noise around 0 does not split breaths.
+
+        The samples of the current breath are kept in preallocated arrays. When a breath is complete its metrics are
+        computed with vectorized operations over those samples and a Breath is returned by add(). The peak inspiratory flow,
+        needed for the airway resistance, is tracked sample by sample (O(1)) and reset at each breath boundary.
+        The plateau, static compliance and resistance need an inspiratory pause; without one they are None (unknown).
+
+        :param flow_threshold: flow (L/min) above which the patient is inspiring
+        :param min_phase: minimum duration (s) of an inspiration or expiration
+        :param max_samples: maximum amount of samples in one breath, longer breaths (apnea) are discarded
+        '''
+        WAITING, INSPIRATION, EXPIRATION = range(3)
+
+        def __init__(self, flow_threshold=2.0, min_phase=0.1, max_samples=4096):
+                self.flow_threshold = flow_threshold
+                self.min_phase = min_phase
+                self.max_samples = max_samples
+                self.time = np.zeros(max_samples)
+                self.pressure = np.zeros(max_samples)
+                self.flow = np.zeros(max_samples)
+                self.breaths = 0 #Breaths detected
+                self.discarded = 0 #Breaths discarded because they were too long
+                self.reset()
+
+        def reset(self):
+                """Forget the breath in progress (e.g. when the acquisition is stopped)."""
+                self.state = self.WAITING
+                self.armed = False #While WAITING, a breath only starts after a sample without inspiratory flow (not in the middle of one)
+                self.count = 0 #Samples stored of the current breath
+                self.expiration_index = 0 #Index of the first sample of the expiration
+                self.phase_start = 0.0
+                self.last_sample = None
+                self.peak_flow = 0.0 #Peak inspiratory flow of the current breath (L/min)
+                self.peak_index = 0 #Index of the sample with the peak flow
+
+        def feed(self, times, samples):
+                """Add the samples of one read (with their times) and return the list of the breaths completed by them."""
+                breaths = []
+                for t, sample in zip(times, samples):
+                        breath = self.add(t, sample)
+                        if breath is not None:
+                                breaths.append(breath)
+                return breaths
+
+        def add(self, t, sample):
+                """Add one sample taken at time t (s). Return the Breath it completes, or None."""
+                flow = sample.flow
+                breath = None
+                if self.state == self.INSPIRATION:
+                        if flow < -self.flow_threshold and t - self.phase_start >= self.min_phase:
+                                self.state = self.EXPIRATION
+                                self.expiration_index = self.count
+                                self.phase_start = t
+                elif self.state == self.WAITING and flow <= self.flow_threshold:
+                        self.armed = True
+                elif flow > self.flow_threshold and (self.armed if self.state == self.WAITING else t - self.phase_start >= self.min_phase):
+                        if self.state == self.EXPIRATION:
+                                breath = self._complete(t)
+                        self.state = self.INSPIRATION
+                        self.count = 0
+                        self.phase_start = t
+                        self.peak_flow = 0.0
+                        self.peak_index = 0
+                if self.state == self.WAITING:
+                        return None
+                if self.count == self.max_samples: #Too long to be a breath, wait for the next inspiration
+                        self.discarded += 1
+                        self.reset()
+                        return breath
+                i = self.count
+                if flow > self.peak_flow and self.state == self.INSPIRATION:
+                        self.peak_flow = flow
+                        self.peak_index = i
+                self.time[i] = t
+                self.pressure[i] = sample.pressure
+                self.flow[i] = flow
+                self.count = i + 1
+                self.last_sample = sample
+                return breath
+
+        def _complete(self, end):
+                """Compute the metrics of the breath stored in the arrays, which ended at time end (start of the next one)."""
+                n = self.count
+                e = self.expiration_index
+                if e < 1 or n - e < 1:
+                        return None
+                t = self.time[:n]
+                p = self.pressure[:n]
+                f = self.flow[:n]
+                start = float(t[0])
+                inspiration = float(t[e]) - start
+                expiration = end - float(t[e])
+                duration = end - start
+                #Tidal volume: integral of the inspiratory flow (L/min -> mL/s)
+                tidal_volume = integrate(np.clip(f[:e], 0, None), t[:e]) * 1000 / 60 if e > 1 else 0.0
+                pip = float(p[:e].max())
+                #Plateau: pressure during the inspiratory pause (flow close to 0 after the peak of flow). Without pause it is unknown:
+                #the end-inspiratory pressure is still driven by the flow, so plateau, static compliance and resistance are left as None.
+                peak = self.peak_index
+                pause = np.abs(f[peak:e]) < self.flow_threshold
+                plateau = float(p[peak:e][pause].mean()) if pause.any() else None
+                #PEEP: pressure at the end of the expiration
+                peep = float(p[max(e, n - 5):n].mean())
+                mean = integrate(p, t) / (float(t[-1]) - start) if n > 1 and t[-1] > start else float(p.mean())
+                frequency = 60 / duration
+                min_ventilation = tidal_volume * frequency / 1000 #L/min
+                compliance = resistance = None
+                if plateau is not None:
+                        compliance = round(tidal_volume / (plateau - peep), 2) if plateau != peep else float('nan') # ml/cm H2O
+                        #Airway resistance: pressure drop between PIP and plateau at the peak flow (L/min -> L/s)
+                        resistance = round((pip - plateau) * 60 / self.peak_flow, 2) if self.peak_flow > 0 else float('nan') #cm H2O/L/sec
+                        plateau = round(plateau, 2)
+                metrics = Metrics(round(frequency, 2), round(tidal_volume, 2), round(pip, 2), plateau, round(peep, 2),
+                        round(expiration / inspiration, 2), round(mean, 2), compliance, round(min_ventilation, 2), resistance)
+                self.breaths += 1
+                return Breath(start, inspiration, expiration, metrics, firmware_metrics(self.last_sample))
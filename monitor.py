@@ -0,0 +1,260 @@
+"""
+Monitoring of several Arduinos (ventilators) from one process.
+
+DeviceMonitor reads the serial ports of all the devices from a single thread: the ports are non-blocking and registered
+in a selector, so the thread sleeps in select() until a port has data or a timer is due (a poll in POLLED mode, the end
+of the settle time after opening a port, a reconnection attempt). There is no thread nor sleep per device, so the CPU
+used grows with the samples received, not with the amount of devices.
+
+        $ python3 main.py --monitor bed1=/dev/serial/by-id/usb-Arduino...-if00 bed2=/dev/ttyACM1
+"""
+import os
+import selectors
+import threading
+import time
+import serial
+from acquisition import Acquisition
+from instrumentation import AcquisitionStats
+from telemetry import POLLED, STREAM, MODES
+from waveform import WaveformBuffer
+
+CLOSED, SETTLING, RUNNING = 'closed', 'settling', 'running' #States of a device
+
+class Device(object):
+        '''
+        One monitored Arduino: its port, decoder, acquisition (breath detection, alarms) and waveform.
+
+        waveform and metrics are written by the monitor thread while holding lock; readers in other threads (the dashboard)
+        have to hold it too while they copy them.
+
+        :param name: name shown in the dashboard
+        :param path: serial device of the Arduino
+        :param settings: command that starts the Arduino (see acquisition.settings_command()), sent every time the port is
+                opened because the Arduino reboots then. None to only listen to it.
+        :param alarms: alarms.AlarmEngine of this device, None disables the alarms
+        :param capacity: samples kept in waveform
+        '''
+
+        def __init__(self, name, path, settings=None, alarms=None, capacity=4096):
+                self.name = name
+                self.path = path
+                self.settings = settings
+                self.alarms = alarms
+                self.state = CLOSED
+                self.port = None
+                self.stats = AcquisitionStats() #Counters of the reads, decoding errors and alarms (see health.py)
+                self.decoder = self.stats.decoder
+                self.acquisition = None #acquisition.Acquisition, created by the monitor
+                self.waveform = WaveformBuffer(capacity)
+                self.metrics = None #metrics.Metrics of the last sample
+                self.breath = None #Last metrics.Breath
+                self.lock = threading.Lock()
+                self.samples = 0 #Samples received
+                self.connects = 0 #Times the port was opened
+                self.failures = 0 #Failed attempts to open the port
+                self.last_error = None
+                self.due = 0.0 #time.monotonic() of the next timer of the device
+                self.checked = 0.0 #time.monotonic() of the last check that the device is still plugged in
+                self.backoff = None
+
+        def __repr__(self):
+                return "Device(%r, %r)" % (self.name, self.path)
+
+def parse_device(spec):
+        """Device of a command line argument: "name=path", or just "path" (named after the file)."""
+        name, separator, path = spec.partition('=')
+        if not separator:
+                name, path = os.path.basename(spec), spec
+        return Device(name, path)
+
+class DeviceMonitor(object):
+        '''
+        Acquisition of several devices from one thread multiplexed with selectors (see the module documentation).
+
+        Each device goes through CLOSED (the port is opened, with exponential backoff between failed attempts), SETTLING
+        (settle seconds, the Arduino reboots when the port is opened) and RUNNING (its settings and "S" were sent, or it is
+        polled every poll_interval seconds). A read error or the device disappearing takes it back to CLOSED. Every read
+        with samples goes through the Acquisition of the device and is published as a Batch.
+
+        :param devices: Device instances
+        :param mode: POLLED or STREAM
+        :param publish: optional function called with (device, batch) for every read, from the monitor thread
+        :param on_alarm: optional function called with the device when one of its alarm rules goes off, from the monitor thread
+        :param baudrate: baud rate of the ports
+        :param settle: seconds to wait after opening a port
+        :param poll_interval: seconds between requests in POLLED mode
+        :param min_backoff: seconds to wait after the first failed attempt to open a port
+        :param max_backoff: maximum seconds between attempts
+        :param check_interval: seconds between checks that the devices are still plugged in
+        '''
+
+        def __init__(self, devices, mode=STREAM, publish=None, on_alarm=None, baudrate=115200, settle=1.0, poll_interval=0.06,
+                        min_backoff=0.5, max_backoff=10.0, check_interval=0.5):
+                if mode not in MODES:
+                        raise ValueError("Unknown acquisition mode %r, expected one of %s" % (mode, ", ".join(MODES)))
+                self.devices = list(devices)
+                self.mode = mode
+                self.publish = publish
+                self.on_alarm = on_alarm
+                self.baudrate = baudrate
+                self.settle = settle
+                self.poll_interval = poll_interval
+                self.min_backoff = min_backoff
+                self.max_backoff = max_backoff
+                self.check_interval = check_interval
+                self.cpu_time = 0.0 #CPU time used by the monitor thread
+                self.start_time = None
+                self._selector = None
+                self._wake = None #Pipe that wakes the thread up from select() to stop it
+                self._stopping = False
+                self._thread = None
+
+        def start(self, start_time=None):
+                """Start the monitor thread. Sample times are relative to start_time (a time.time(), now by default)."""
+                if self._thread is not None:
+                        return
+                self.start_time = time.time() if start_time is None else start_time
+                self._selector = selectors.DefaultSelector()
+                self._wake = os.pipe()
+                os.set_blocking(self._wake[0], False)
+                self._selector.register(self._wake[0], selectors.EVENT_READ, None)
+                now = time.monotonic()
+                for device in self.devices:
+                        device.acquisition = Acquisition(None, self.mode, self.start_time, alarms=device.alarms,
+                                on_alarm=lambda device=device: self._alarm(device), stats=device.stats)
+                        device.stats.start()
+                        device.state = CLOSED
+                        device.due = now
+                        device.backoff = self.min_backoff
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="DeviceMonitor")
+                self._thread.daemon = True
+                self._thread.start()
+
+        def stop(self):
+                """Stop the thread, stop the Arduinos ("22") and close the ports."""
+                if self._thread is None:
+                        return
+                self._stopping = True
+                os.write(self._wake[1], b'\0')
+                self._thread.join()
+                self._thread = None
+                for device in self.devices:
+                        if device.state == RUNNING:
+                                try:
+                                        device.port.write(('22'+'\n').encode('utf-8'))
+                                except (serial.SerialException, OSError) as e:
+                                        print(e)
+                        self._drop(device)
+                        device.stats.stop()
+                self._selector.close()
+                for fd in self._wake:
+                        os.close(fd)
+
+        def _alarm(self, device):
+                if self.on_alarm is not None:
+                        self.on_alarm(device)
+
+        def _drop(self, device, error=None):
+                """Close the port of device, and try to open it again after its backoff."""
+                if error is not None:
+                        print("Lost connection with %s (%s): %s" % (device.name, device.path, error))
+                        device.last_error = error
+                        device.stats.lost()
+                if device.port is not None:
+                        if device.state == RUNNING:
+                                self._selector.unregister(device.port)
+                        try:
+                                device.port.close()
+                        except (serial.SerialException, OSError):
+                                pass
+                device.port = None
+                device.state = CLOSED
+                device.due = time.monotonic() + device.backoff
+                if device.acquisition is not None:
+                        device.acquisition.breath_detector.reset()
+
+        def _timer(self, device, now):
+                """Do what is due for device: open its port, start it after settling, poll it or check that it is plugged in."""
+                if device.state == CLOSED:
+                        try:
+                                device.port = serial.Serial(device.path, self.baudrate, timeout=0)
+                        except (serial.SerialException, OSError) as e:
+                                device.failures += 1
+                                device.last_error = e
+                                device.due = now + device.backoff
+                                device.backoff = min(device.backoff * 2, self.max_backoff)
+                                return
+                        device.state = SETTLING
+                        device.due = now + self.settle
+                elif device.state == SETTLING:
+                        port = device.port
+                        port.reset_input_buffer() #Discard what the Arduino sent while booting
+                        device.decoder.reset()
+                        device.acquisition.resync()
+                        if device.settings is not None:
+                                port.write(device.settings.encode('utf-8'))
+                        if self.mode == STREAM:
+                                port.write("S\n".encode('utf-8'))
+                        self._selector.register(port, selectors.EVENT_READ, device)
+                        device.state = RUNNING
+                        device.connects += 1
+                        device.backoff = self.min_backoff
+                        device.checked = now
+                        device.due = now
+                        print("Connected to %s at %s" % (device.name, device.path))
+                else:
+                        if now - device.checked >= self.check_interval:
+                                device.checked = now
+                                if not os.path.exists(device.path): #Unplugged
+                                        self._drop(device, "disconnected")
+                                        return
+                        if self.mode == POLLED:
+                                device.port.write("1".encode('utf-8'))
+                                device.due = now + self.poll_interval
+                        else:
+                                device.due = device.checked + self.check_interval
+
+        def _read(self, device):
+                """Read and process everything waiting in the port of device."""
+                port = device.port
+                data = port.read(max(1, port.in_waiting)) #Non-blocking, the selector said that there is something
+                read_time = time.perf_counter()
+                samples = device.decoder.feed(data)
+                if not samples:
+                        return
+                parse_time = time.perf_counter()
+                batch = device.acquisition.process(samples, read_time=read_time, parse_time=parse_time)
+                with device.lock:
+                        device.waveform.extend(batch.times, samples, batch.gaps)
+                        device.metrics = batch.metrics
+                        if batch.breaths:
+                                device.breath = batch.breaths[-1]
+                        device.samples += len(samples)
+                if self.publish is not None:
+                        self.publish(device, batch)
+
+        def _run(self):
+                selector = self._selector
+                while not self._stopping:
+                        now = time.monotonic()
+                        for device in self.devices:
+                                if device.due <= now:
+                                        try:
+                                                self._timer(device, now)
+                                        except (serial.SerialException, OSError) as e:
+                                                self._drop(device, e)
+                        timeout = max(0.0, min(device.due for device in self.devices) - time.monotonic()) if self.devices else None
+                        for key, events in selector.select(timeout):
+                                device = key.data
+                                if device is None: #Woken up to stop
+                                        os.read(self._wake[0], 64)
+                                        continue
+                                try:
+                                        self._read(device)
+                                except (serial.SerialException, OSError) as e: #Unplugged, it is opened again after its backoff
+                                        self._drop(device, e)
+                                except Exception as e: #If there is any error, the system must keep working, therefore, we print the error
+                                        device.stats.errors += 1
+                                        print(e)
+                        self.cpu_time = time.thread_time()
@@ -0,0 +1,361 @@
+"""
+Telemetry stream for a central monitoring station on the local network.
+
+TelemetryPublisher sends every batch of the acquisition (samples, breaths, alarms) to any amount of subscribers, over
+plain TCP and/or WebSocket. The stream uses the format of the session files (see recorder.py): a file header and then
+chunks, so what a subscriber receives over TCP can be saved as is and opened with recorder.read_session() or replayed
+with replay.py. Over WebSocket every binary message holds one batch (or the header).
+
+        $ python3 main.py --publish 5555 --publish-ws 8765 --publish-host 0.0.0.0
+        $ nc raspberrypi.local 5555 > unit1.atmo
+
+Only the local host can subscribe unless another address is given (the stream has no authentication nor encryption).
+"""
+import base64
+import hashlib
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from instrumentation import AlarmEvent
+from recorder import (FILE_HEADER, FILE_MAGIC, FORMAT_VERSION, SAMPLE, BREATH, ALARM, SESSION, SESSION_RECORD, chunk, pack_alarm,
+        pack_breaths, pack_samples)
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+TCP, WEBSOCKET = 'tcp', 'websocket'
+
+def websocket_frame(payload, opcode=2):
+        """Unmasked WebSocket frame (server to client) of payload, binary by default."""
+        n = len(payload)
+        if n < 126:
+                header = bytes((0x80 | opcode, n))
+        elif n < 65536:
+                header = bytes((0x80 | opcode, 126)) + n.to_bytes(2, 'big')
+        else:
+                header = bytes((0x80 | opcode, 127)) + n.to_bytes(8, 'big')
+        return header + payload
+
+class Subscriber(object):
+        '''
+        One connected client of the publisher and the messages waiting to be sent to it.
+
+        :param sock: non-blocking socket
+        :param address: address of the client
+        :param kind: TCP or WEBSOCKET
+        :param max_pending: messages kept while the client does not read; older ones are dropped
+        '''
+
+        def __init__(self, sock, address, kind, max_pending):
+                self.sock = sock
+                self.address = address
+                self.kind = kind
+                self.pending = deque()
+                self.max_pending = max_pending
+                self.offset = 0 #Bytes of pending[0] already sent
+                self.request = bytearray() #WebSocket handshake request, and then frames received
+                self.ready = kind == TCP #False until the WebSocket handshake is done
+                self.dropped = 0 #Messages dropped because the client was too slow
+                self.sent = 0 #Bytes sent
+                self.stalled = None #time.monotonic() since which nothing could be sent, None if it is keeping up
+
+        def queue(self, message):
+                if len(self.pending) >= self.max_pending:
+                        if self.offset and len(self.pending) > 1: #Never cut a message that is half sent
+                                del self.pending[1]
+                        else:
+                                self.pending.popleft()
+                                self.offset = 0
+                        self.dropped += 1
+                self.pending.append(message)
+
+class TelemetryPublisher(object):
+        '''
+        Fans the batches of the acquisition out to the subscribers on the network, from its own thread.
+
+        publish() and publish_alarm() only put the batch in a bounded queue and never block (batches are dropped and counted
+        when it is full), so slow subscribers and the network never delay the acquisition. The publisher thread serializes
+        each batch once, into the bytes shared by all the TCP subscribers and the frame shared by all the WebSocket ones,
+        and keeps a bounded queue of messages per subscriber: a subscriber that does not read loses its oldest messages, and
+        is disconnected after stall_timeout seconds without being able to send it anything.
+
+        :param port: TCP port of the plain stream (None to disable it)
+        :param ws_port: TCP port of the WebSocket stream (None to disable it)
+        :param host: address to listen on, only the local host by default ('0.0.0.0' for every interface)
+        :param queue_size: maximum amount of batches waiting to be serialized
+        :param max_pending: maximum amount of messages waiting to be sent to one subscriber
+        :param stall_timeout: seconds after which a subscriber that does not read is disconnected
+        '''
+
+        def __init__(self, port=None, ws_port=None, host='127.0.0.1', queue_size=1000, max_pending=256, stall_timeout=10.0):
+                self.port = port
+                self.ws_port = ws_port
+                self.host = host
+                self.queue = queue.Queue(queue_size)
+                self.max_pending = max_pending
+                self.stall_timeout = stall_timeout
+                self.subscribers = []
+                self.dropped = 0 #Batches dropped because the queue was full
+                self.published = 0 #Messages serialized
+                self.start_time = 0.0 #time.time() of the current session
+                self.addresses = {} #Listening (host, port) of each kind, useful with port 0
+                self._listeners = []
+                self._selector = None
+                self._wake = None
+                self._thread = None
+
+        def start(self):
+                """Open the listening sockets and start the publisher thread."""
+                self._selector = selectors.DefaultSelector()
+                for port, kind in ((self.port, TCP), (self.ws_port, WEBSOCKET)):
+                        if port is None:
+                                continue
+                        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                        listener.bind((self.host, port))
+                        listener.listen(16)
+                        listener.setblocking(False)
+                        self._selector.register(listener, selectors.EVENT_READ, kind)
+                        self._listeners.append(listener)
+                        self.addresses[kind] = listener.getsockname()
+                self._wake = os.pipe()
+                os.set_blocking(self._wake[0], False)
+                os.set_blocking(self._wake[1], False)
+                self._selector.register(self._wake[0], selectors.EVENT_READ, None)
+                self._thread = threading.Thread(target=self._run, name="TelemetryPublisher")
+                self._thread.daemon = True
+                self._thread.start()
+
+        def stop(self):
+                """Send what is pending (for up to a second), disconnect the subscribers and close the sockets."""
+                if self._thread is None:
+                        return
+                self._put(None, block=True)
+                self._thread.join()
+                self._thread = None
+                for subscriber in list(self.subscribers):
+                        self._disconnect(subscriber)
+                for listener in self._listeners:
+                        listener.close()
+                self._listeners = []
+                self._selector.close()
+                for fd in self._wake:
+                        os.close(fd)
+
+        def start_session(self, start_time):
+                """Tell the subscribers that a new session started at start_time (a time.time()), the times of the next batches are relative to it."""
+                self._put(('session', start_time))
+
+        def publish(self, batch):
+                """Queue an acquisition.Batch to be sent. Never blocks."""
+                self._put(batch)
+
+        def publish_alarm(self, event):
+                """Queue an instrumentation.AlarmEvent to be sent. Never blocks."""
+                self._put(event)
+
+        def _put(self, item, block=False):
+                try:
+                        self.queue.put(item, block)
+                except queue.Full:
+                        self.dropped += 1
+                        return
+                try:
+                        os.write(self._wake[1], b'\0')
+                except BlockingIOError: #The thread has plenty of wake ups pending already
+                        pass
+
+        def _serialize(self, item):
+                """Message (bytes) of a queued item."""
+                if isinstance(item, AlarmEvent):
+                        return chunk(ALARM, 1, pack_alarm(item))
+                if isinstance(item, tuple) and item[0] == 'session':
+                        self.start_time = item[1]
+                        return chunk(SESSION, 1, SESSION_RECORD.pack(item[1]))
+                message = chunk(SAMPLE, len(item.samples), pack_samples(item))
+                if item.breaths:
+                        message += chunk(BREATH, len(item.breaths), pack_breaths(item))
+                return message
+
+        def _send(self, message):
+                """Queue message for every subscriber, serialized once for each protocol."""
+                self.published += 1
+                frame = None
+                for subscriber in list(self.subscribers): #_flush() can disconnect a subscriber
+                        if not subscriber.ready:
+                                continue
+                        if subscriber.kind == WEBSOCKET:
+                                if frame is None:
+                                        frame = websocket_frame(message)
+                                subscriber.queue(frame)
+                        else:
+                                subscriber.queue(message)
+                        self._flush(subscriber)
+
+        def _welcome(self, subscriber):
+                """First message of a subscriber: the header of the stream."""
+                header = FILE_HEADER.pack(FILE_MAGIC, FORMAT_VERSION, self.start_time)
+                subscriber.queue(header if subscriber.kind == TCP else websocket_frame(header))
+                self._flush(subscriber)
+
+        def _accept(self, listener, kind):
+                try:
+                        sock, address = listener.accept()
+                except OSError:
+                        return
+                sock.setblocking(False)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                subscriber = Subscriber(sock, address, kind, self.max_pending)
+                self.subscribers.append(subscriber)
+                self._selector.register(sock, selectors.EVENT_READ, subscriber)
+                print("Telemetry subscriber %s:%d connected (%s)" % (address[0], address[1], kind))
+                if subscriber.ready:
+                        self._welcome(subscriber)
+
+        def _disconnect(self, subscriber, reason=None):
+                if subscriber not in self.subscribers:
+                        return
+                self.subscribers.remove(subscriber)
+                try:
+                        self._selector.unregister(subscriber.sock)
+                except (KeyError, ValueError):
+                        pass
+                subscriber.sock.close()
+                print("Telemetry subscriber %s:%d disconnected%s" % (subscriber.address[0], subscriber.address[1], ": %s" % reason if reason else ""))
+
+        def _flush(self, subscriber):
+                """Send as much of the pending messages as the socket takes without blocking."""
+                sock = subscriber.sock
+                try:
+                        while subscriber.pending:
+                                message = subscriber.pending[0]
+                                sent = sock.send(memoryview(message)[subscriber.offset:])
+                                subscriber.sent += sent
+                                subscriber.offset += sent
+                                if subscriber.offset < len(message):
+                                        break
+                                subscriber.pending.popleft()
+                                subscriber.offset = 0
+                except BlockingIOError:
+                        pass
+                except OSError as e:
+                        self._disconnect(subscriber, e)
+                        return
+                if subscriber.pending:
+                        if subscriber.stalled is None:
+                                subscriber.stalled = time.monotonic()
+                        elif time.monotonic() - subscriber.stalled > self.stall_timeout:
+                                self._disconnect(subscriber, "not reading")
+                                return
+                else:
+                        subscriber.stalled = None
+                events = selectors.EVENT_READ | (selectors.EVENT_WRITE if subscriber.pending else 0)
+                if self._selector.get_key(sock).events != events:
+                        self._selector.modify(sock, events, subscriber)
+
+        def _receive(self, subscriber):
+                """Read what a subscriber sent: the WebSocket handshake, then control frames (close, ping). TCP subscribers only close."""
+                try:
+                        data = subscriber.sock.recv(4096)
+                except BlockingIOError:
+                        return
+                except OSError as e:
+                        self._disconnect(subscriber, e)
+                        return
+                if not data:
+                        self._disconnect(subscriber)
+                        return
+                if subscriber.kind == TCP:
+                        return
+                subscriber.request += data
+                if not subscriber.ready:
+                        self._handshake(subscriber)
+                else:
+                        self._control(subscriber)
+
+        def _handshake(self, subscriber):
+                request = subscriber.request
+                end = request.find(b'\r\n\r\n')
+                if end < 0:
+                        if len(request) > 8192:
+                                self._disconnect(subscriber, "bad WebSocket request")
+                        return
+                key = None
+                for line in bytes(request[:end]).split(b'\r\n')[1:]:
+                        name, separator, value = line.partition(b':')
+                        if name.strip().lower() == b'sec-websocket-key':
+                                key = value.strip()
+                del request[:end + 4]
+                if key is None:
+                        subscriber.sock.send(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+                        self._disconnect(subscriber, "not a WebSocket request")
+                        return
+                accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+                subscriber.queue(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+                subscriber.ready = True
+                self._welcome(subscriber)
+
+        def _control(self, subscriber):
+                """Handle the frames sent by a WebSocket client: answer pings and close, ignore the rest."""
+                data = subscriber.request
+                while len(data) >= 2:
+                        opcode = data[0] & 0x0F
+                        length = data[1] & 0x7F
+                        offset = 2
+                        if length == 126:
+                                offset = 4
+                        elif length == 127:
+                                offset = 10
+                        if len(data) < offset:
+                                return
+                        if length >= 126:
+                                length = int.from_bytes(data[2:offset], 'big')
+                        masked = data[1] & 0x80
+                        end = offset + (4 if masked else 0) + length
+                        if len(data) < end:
+                                return
+                        payload = bytes(data[end - length:end])
+                        if masked:
+                                mask = data[offset:offset + 4]
+                                payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+                        del data[:end]
+                        if opcode == 0x8: #Close
+                                subscriber.queue(websocket_frame(payload[:2], 0x8))
+                                self._flush(subscriber)
+                                self._disconnect(subscriber)
+                                return
+                        if opcode == 0x9: #Ping
+                                subscriber.queue(websocket_frame(payload, 0xA))
+                                self._flush(subscriber)
+
+        def _run(self):
+                selector = self._selector
+                running = True
+                deadline = None
+                while running or (deadline is not None and time.monotonic() < deadline and any(s.pending for s in self.subscribers)):
+                        for key, events in selector.select(0.5 if running else 0.05):
+                                if key.data is None: #Batches were queued
+                                        os.read(self._wake[0], 4096)
+                                elif key.data in (TCP, WEBSOCKET):
+                                        self._accept(key.fileobj, key.data)
+                                else:
+                                        subscriber = key.data
+                                        if events & selectors.EVENT_READ:
+                                                self._receive(subscriber)
+                                        if events & selectors.EVENT_WRITE and subscriber in self.subscribers:
+                                                self._flush(subscriber)
+                        while running:
+                                try:
+                                        item = self.queue.get_nowait()
+                                except queue.Empty:
+                                        break
+                                if item is None:
+                                        running = False
+                                        deadline = time.monotonic() + 1.0
+                                        break
+                                self._send(self._serialize(item))
+                        for subscriber in list(self.subscribers): #Disconnect the ones that stopped reading even if nothing new was sent
+                                if subscriber.stalled is not None:
+                                        self._flush(subscriber)
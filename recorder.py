@@ -0,0 +1,265 @@
+"""
+Recording of whole sessions: every sample received from the Arduino and every breath, at full rate.
+
+Session files are append-only sequences of chunks, so they survive power cuts: a chunk cut in half or with a bad CRC at
+the end of a file is ignored when reading it.
+        - File header: magic b"ATMOREC1", format version (uint16), time.time() of the session start (float64)
+        - Chunk header: magic b"CHNK", record type (uint8), amount of records (uint32), payload length (uint32),
+          CRC-32 of the payload (uint32)
+        - Records (little-endian):
+          SAMPLE: time (s since session start, float64), pressure, flow, volume, frequency, IE, PIP, plateau, PEEP (float32),
+                  error flags (uint8, bit 0 pressure, bit 1 volume, bit 2 flow), sequence number (int32, -1 if unknown),
+                  device timestamp (int64, micros() of the Arduino, -1 if unknown; only from format version 2)
+          BREATH: start, inspiration, expiration (float64), host metrics and firmware metrics (2 x 10 float32, NaN if unknown)
+          ALARM: time (float64), name of the rule (16 bytes, UTF-8 padded with zeros), latencies of the parse, evaluate and
+                 actuate stages and total (4 x float32, s), see instrumentation.AlarmEvent
+          SESSION: time.time() of the start of a new session (float64), the times of the next records are relative to it.
+                   Sent by publisher.TelemetryPublisher at every START, not written to files.
+Readers skip the chunks of types they do not know, and read the SAMPLE records of version 1 files (without device
+timestamp) too.
+"""
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from instrumentation import AlarmEvent
+from metrics import Breath, Metrics
+from telemetry import Sample, error_flags_to_pvf, pvf_to_error_flags
+
+FILE_MAGIC = b'ATMOREC1'
+FILE_HEADER = struct.Struct('<8sHd')
+FORMAT_VERSION = 2
+CHUNK_MAGIC = b'CHNK'
+CHUNK_HEADER = struct.Struct('<4sBIII')
+SAMPLE, BREATH, ALARM, SESSION = 1, 2, 3, 4
+SAMPLE_RECORD = struct.Struct('<d8fBiq')
+SAMPLE_RECORDS = {1: struct.Struct('<d8fBi'), 2: SAMPLE_RECORD} #Of each format version
+BREATH_RECORD = struct.Struct('<3d%df' % (2 * len(Metrics._fields)))
+ALARM_RECORD = struct.Struct('<d16s4f')
+SESSION_RECORD = struct.Struct('<d')
+FSYNC_POLICIES = ('never', 'interval', 'chunk')
+NAN = float('nan')
+
+def pack_metrics(metrics):
+        if metrics is None:
+                return (NAN,) * len(Metrics._fields)
+        return tuple(NAN if value is None else value for value in metrics)
+
+def unpack_metrics(values):
+        return Metrics(*[None if value != value else value for value in values])
+
+def pack_samples(batch):
+        """SAMPLE records of the samples of an acquisition.Batch."""
+        return b''.join(SAMPLE_RECORD.pack(t, sample.pressure, sample.flow, sample.volume, sample.frequency, sample.IE, sample.pip,
+                sample.plateau, sample.peep, pvf_to_error_flags(sample.error_pvf), -1 if sample.seq is None else sample.seq,
+                -1 if sample.device_time is None else sample.device_time) for t, sample in zip(batch.times, batch.samples))
+
+def pack_breaths(batch):
+        """BREATH records of the breaths of an acquisition.Batch."""
+        return b''.join(BREATH_RECORD.pack(breath.start, breath.inspiration, breath.expiration,
+                *(pack_metrics(breath.metrics) + pack_metrics(breath.firmware))) for breath in batch.breaths)
+
+def pack_alarm(event):
+        """ALARM record of an instrumentation.AlarmEvent."""
+        return ALARM_RECORD.pack(event.time, event.name.encode('utf-8')[:16], event.parse, event.evaluate, event.actuate, event.total)
+
+def chunk(kind, count, payload):
+        """Chunk (header and payload) of count records of type kind."""
+        return CHUNK_HEADER.pack(CHUNK_MAGIC, kind, count, len(payload), zlib.crc32(payload)) + payload
+
+class SessionRecorder(object):
+        '''
+        Writes the batches of the acquisition and the alarms that went off to session files from its own thread.
+
+        record() only puts the batch in a bounded queue and never blocks: if the disk stalls and the queue fills up, batches
+        are dropped (and counted in dropped) instead of delaying the acquisition or the alarms. The writer thread packs the
+        records in memory and writes them as chunks of chunk_records records, or every flush_interval seconds if there are
+        less. Files are rotated when they reach max_bytes or are open for max_seconds.
+
+        :param directory: directory of the session files (created if needed)
+        :param chunk_records: records per chunk
+        :param flush_interval: maximum seconds that a record waits in memory before being written
+        :param fsync: "never" (leave it to the OS), "interval" (every fsync_interval seconds) or "chunk" (after every write)
+        :param fsync_interval: seconds between fsyncs with the "interval" policy
+        :param max_bytes: size at which a file is closed and a new one is started
+        :param max_seconds: seconds after which a file is closed and a new one is started
+        :param queue_size: maximum amount of batches waiting to be written
+        '''
+
+        def __init__(self, directory, chunk_records=500, flush_interval=1.0, fsync='interval', fsync_interval=10.0, max_bytes=64 * 1024 * 1024,
+                        max_seconds=3600, queue_size=1000):
+                if fsync not in FSYNC_POLICIES:
+                        raise ValueError("Unknown fsync policy %r, expected one of %s" % (fsync, ", ".join(FSYNC_POLICIES)))
+                self.directory = directory
+                self.chunk_records = chunk_records
+                self.flush_interval = flush_interval
+                self.fsync = fsync
+                self.fsync_interval = fsync_interval
+                self.max_bytes = max_bytes
+                self.max_seconds = max_seconds
+                self.queue = queue.Queue(queue_size)
+                self.dropped = 0 #Batches dropped because the queue was full
+                self.written = 0 #Records written
+                self.files = [] #Paths of the files written in this session
+                self.last_error = None
+                self._thread = None
+                self._file = None
+
+        def start(self, start_time=None):
+                """Start a new session (times of the records are relative to start_time, a time.time())."""
+                self.start_time = time.time() if start_time is None else start_time
+                self._thread = threading.Thread(target=self._run, name="SessionRecorder")
+                self._thread.daemon = True
+                self._thread.start()
+
+        def stop(self, wait=True):
+                """Write everything pending and close the file. With wait=False the writer thread finishes in the background."""
+                if self._thread is None:
+                        return
+                self.queue.put(None)
+                if wait:
+                        self._thread.join()
+                self._thread = None
+
+        def record(self, batch):
+                """Queue an acquisition.Batch to be written. Never blocks."""
+                try:
+                        self.queue.put_nowait(batch)
+                except queue.Full:
+                        self.dropped += 1
+
+        def record_alarm(self, event):
+                """Queue an instrumentation.AlarmEvent to be written. Never blocks."""
+                self.record(event)
+
+        def _open(self):
+                os.makedirs(self.directory, exist_ok=True)
+                name = time.strftime('session-%Y%m%d-%H%M%S', time.localtime()) + '-%03d.atmo' % len(self.files)
+                path = os.path.join(self.directory, name)
+                self._file = open(path, 'ab')
+                self._file.write(FILE_HEADER.pack(FILE_MAGIC, FORMAT_VERSION, self.start_time))
+                self._opened = time.monotonic()
+                self._synced = self._opened
+                self.files.append(path)
+
+        def _close(self):
+                if self._file is not None:
+                        self._file.flush()
+                        if self.fsync != 'never':
+                                os.fsync(self._file.fileno())
+                        self._file.close()
+                        self._file = None
+
+        def _discard(self):
+                """Close the file after a write error, without raising: the next chunk starts a new file."""
+                if self._file is not None:
+                        try:
+                                self._file.close() #The descriptor is released even if flushing what was buffered fails
+                        except OSError:
+                                pass
+                        self._file = None
+
+        def _write(self, buffers):
+                """Write the pending records of buffers ({type: [count, bytearray]}) as chunks."""
+                if self._file is None:
+                        self._open()
+                for kind, (count, payload) in buffers.items():
+                        if count:
+                                self._file.write(chunk(kind, count, payload))
+                                self.written += count
+                                buffers[kind] = [0, bytearray()]
+                self._file.flush()
+                now = time.monotonic()
+                if self.fsync == 'chunk' or (self.fsync == 'interval' and now - self._synced >= self.fsync_interval):
+                        os.fsync(self._file.fileno())
+                        self._synced = now
+                if self._file.tell() >= self.max_bytes or now - self._opened >= self.max_seconds:
+                        self._close()
+
+        def _run(self):
+                buffers = {SAMPLE: [0, bytearray()], BREATH: [0, bytearray()], ALARM: [0, bytearray()]}
+                deadline = time.monotonic() + self.flush_interval
+                running = True
+                while running:
+                        try:
+                                batch = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                        except queue.Empty:
+                                batch = False
+                        if batch is None:
+                                running = False
+                        elif isinstance(batch, AlarmEvent):
+                                alarms = buffers[ALARM]
+                                alarms[1] += pack_alarm(batch)
+                                alarms[0] += 1
+                        elif batch:
+                                samples = buffers[SAMPLE]
+                                samples[1] += pack_samples(batch)
+                                samples[0] += len(batch.samples)
+                                breaths = buffers[BREATH]
+                                breaths[1] += pack_breaths(batch)
+                                breaths[0] += len(batch.breaths)
+                        pending = sum(count for count, payload in buffers.values())
+                        if pending and (not running or pending >= self.chunk_records or time.monotonic() >= deadline):
+                                try:
+                                        self._write(buffers)
+                                except OSError as e: #Disk full, SD card removed... keep acquiring, try again with the next chunk
+                                        print("Could not write the session file: %s" % e)
+                                        self.last_error = e
+                                        buffers = {SAMPLE: [0, bytearray()], BREATH: [0, bytearray()], ALARM: [0, bytearray()]}
+                                        self._discard()
+                        if time.monotonic() >= deadline:
+                                deadline = time.monotonic() + self.flush_interval
+                try:
+                        self._close()
+                except OSError as e:
+                        print("Could not close the session file: %s" % e)
+
+def read_session(path):
+        """
+        Read a session file, yielding (SAMPLE, [(time, Sample), ...]), (BREATH, [Breath, ...]) and (ALARM, [AlarmEvent, ...])
+        for every chunk, in order.
+        A truncated or corrupted chunk ends the file (the session start is returned by read_header()).
+        """
+        with open(path, 'rb') as f:
+                header = f.read(FILE_HEADER.size)
+                if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header)[0] != FILE_MAGIC:
+                        raise ValueError("%s is not a session file" % path)
+                version = FILE_HEADER.unpack(header)[1]
+                sample_record = SAMPLE_RECORDS.get(version, SAMPLE_RECORD)
+                while True:
+                        header = f.read(CHUNK_HEADER.size)
+                        if len(header) < CHUNK_HEADER.size:
+                                return
+                        magic, kind, count, length, crc = CHUNK_HEADER.unpack(header)
+                        payload = f.read(length)
+                        if magic != CHUNK_MAGIC or len(payload) < length or zlib.crc32(payload) != crc:
+                                print("%s: corrupted chunk at byte %d, ignoring the rest of the file" % (path, f.tell() - len(payload) - CHUNK_HEADER.size))
+                                return
+                        if kind == SAMPLE:
+                                records = []
+                                for values in sample_record.iter_unpack(payload):
+                                        t, p, fl, v, freq, ie, pip, plateau, peep, flags, seq = values[:11]
+                                        device_time = values[11] if len(values) > 11 and values[11] >= 0 else None
+                                        records.append((t, Sample(p, fl, v, freq, ie, pip, plateau, peep, error_flags_to_pvf(flags), None if seq < 0 else seq, device_time)))
+                                yield SAMPLE, records
+                        elif kind == BREATH:
+                                fields = len(Metrics._fields)
+                                records = []
+                                for values in BREATH_RECORD.iter_unpack(payload):
+                                        records.append(Breath(values[0], values[1], values[2], unpack_metrics(values[3:3 + fields]), unpack_metrics(values[3 + fields:])))
+                                yield BREATH, records
+                        elif kind == ALARM:
+                                records = []
+                                for t, name, parse, evaluate, actuate, total in ALARM_RECORD.iter_unpack(payload):
+                                        records.append(AlarmEvent(t, name.rstrip(b'\0').decode('utf-8', 'replace'), parse, evaluate, actuate, total))
+                                yield ALARM, records
+
+def read_header(path):
+        """Return (format version, session start time.time()) of a session file."""
+        with open(path, 'rb') as f:
+                magic, version, start_time = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != FILE_MAGIC:
+                raise ValueError("%s is not a session file" % path)
+        return version, start_time
@@ -0,0 +1,238 @@
+"""
+Replay of recorded sessions (see recorder.py) through the same pipeline as a live Arduino.
+
+SessionReplay stands in for connection.SerialConnection: the port it hands out answers the polls and the "S" command with
+the recorded samples, encoded as binary frames, at 1x, 10x or any other speed, or as fast as they can be read. Decoding,
+alarms, metrics and plots are exactly the ones used with the hardware.
+
+        $ python3 main.py --replay /home/pi/sessions/session-20260101-120000-000.atmo --replay-speed 10
+        $ python3 replay.py /home/pi/sessions/session-*.atmo --speed max #Throughput of the processing stages
+"""
+import argparse
+import time
+from clock import TICK, WRAP
+from recorder import SAMPLE, read_header, read_session
+from telemetry import SEQ_MODULO, encode_frame
+
+class ReplayPort(object):
+        '''
+        Serial port look-alike that plays a recorded session. Only what acquisition.SerialReader uses is implemented.
+
+        :param records: iterator of (time, telemetry.Sample), in order
+        :param speed: playback speed (1 is real time), None to send the samples as fast as they are read
+        :param timeout: seconds that read() waits for data, like the timeout of serial.Serial
+        '''
+
+        def __init__(self, records, speed=1.0, timeout=1):
+                self.records = records
+                self.speed = speed
+                self.timeout = timeout
+                self.pending = bytearray() #Encoded samples not read yet
+                self.next = None #Next (time, sample) to send
+                self.time = None #Session time of the last sample sent
+                self.sent = 0
+                self.polls = 0 #Polls ("1") not answered yet
+                self.streaming = False
+                self.finished = False
+                self.commands = [] #Commands written by the host, in order
+                self._command = b''
+                self._peek()
+                if self.next is not None:
+                        self.time = self.next[0]
+
+        def _peek(self):
+                if self.next is None and not self.finished:
+                        self.next = next(self.records, None)
+                        if self.next is None:
+                                self.finished = True
+                return self.next
+
+        def _due(self):
+                """Seconds until the next sample has to be sent (0 if it is due now, None if nothing is going to be sent)."""
+                if self._peek() is None:
+                        return None
+                if self.polls:
+                        return 0.0
+                if not self.streaming:
+                        return None
+                if self.speed is None:
+                        return 0.0
+                return max(0.0, self.origin + (self.next[0] - self.start) / self.speed - time.monotonic())
+
+        def _fill(self, size):
+                while len(self.pending) < size and self._due() == 0.0:
+                        t, sample = self.next
+                        self.next = None
+                        self.pending += encode_frame(sample, self.sent if sample.seq is None else sample.seq)
+                        self.time = t
+                        self.sent += 1
+                        if self.polls:
+                                self.polls -= 1
+
+        @property
+        def in_waiting(self):
+                self._fill(4096)
+                return len(self.pending)
+
+        def read(self, size=1):
+                deadline = time.monotonic() + self.timeout
+                self._fill(size)
+                while not self.pending:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                                break
+                        due = self._due()
+                        time.sleep(min(remaining, 0.01 if due is None else due))
+                        self._fill(size)
+                data = bytes(self.pending[:size])
+                del self.pending[:size]
+                return data
+
+        def write(self, data):
+                self._command += data
+                while self._command:
+                        if self._command[:1] == b'1': #Poll, not followed by a newline
+                                self.polls += 1
+                                self._command = self._command[1:]
+                                continue
+                        newline = self._command.find(b'\n')
+                        if newline < 0:
+                                break
+                        command = self._command[:newline].decode('utf-8', 'replace').strip()
+                        self._command = self._command[newline + 1:]
+                        self.commands.append(command)
+                        if command == 'S':
+                                self.streaming = True
+                                if self._peek() is not None: #Play from where it was stopped
+                                        self.start = self.next[0]
+                                        self.origin = time.monotonic()
+                        elif command == '22':
+                                self.streaming = False
+                                self.polls = 0
+                return len(data)
+
+        def flushInput(self):
+                self.pending = bytearray()
+
+        def close(self):
+                pass
+
+class SessionReplay(object):
+        '''
+        Replacement of connection.SerialConnection that plays recorded session files instead of talking to an Arduino.
+
+        :param paths: session files, played one after the other
+        :param speed: playback speed (1 is real time, 10 ten times faster), None to play as fast as possible
+        '''
+
+        def __init__(self, paths, speed=1.0):
+                self.paths = list(paths)
+                self.speed = speed
+                self.device = self.paths[0] if self.paths else None
+                self.port = ReplayPort(self._samples(), speed)
+                self.connects = 1
+                self.failures = 0
+                self.last_error = None
+
+        def _samples(self):
+                """
+                (time, Sample) of all the files, played as one session. The files of a session (rotated by the recorder) follow
+                each other already. The samples of a file of another session are moved to continue the previous one: the
+                times, sequence numbers and device timestamps start again in every session, which the acquisition would take
+                for lost samples or a clock jump. The gaps inside each file are kept.
+                """
+                session = None #Start time of the session of the previous file
+                last = None #(time, interval, Sample) of the last sample
+                for path in self.paths:
+                        start_time = read_header(path)[1]
+                        shift = None #(time, seq, device time) added to the samples of this file
+                        for kind, records in read_session(path):
+                                if kind != SAMPLE:
+                                        continue
+                                for t, sample in records:
+                                        if shift is None:
+                                                shift = (0.0, 0, 0)
+                                                if last is not None and start_time != session:
+                                                        shift = self._shift(last, t, sample)
+                                        if shift != (0.0, 0, 0):
+                                                t += shift[0]
+                                                sample = sample._replace(seq=None if sample.seq is None else (sample.seq + shift[1]) % SEQ_MODULO,
+                                                        device_time=None if sample.device_time is None else (sample.device_time + shift[2]) % WRAP)
+                                        last = (t, t - last[0] if last is not None else 0.0, sample)
+                                        yield t, sample
+                        session = start_time
+
+        @staticmethod
+        def _shift(last, t, sample):
+                """Offsets that put sample (at time t) one sample interval after the last sample of the previous file."""
+                previous_time, interval, previous = last
+                time_shift = previous_time + interval - t
+                seq_shift = (previous.seq + 1 - sample.seq) % SEQ_MODULO if previous.seq is not None and sample.seq is not None else 0
+                device_shift = 0
+                if previous.device_time is not None and sample.device_time is not None:
+                        device_shift = (previous.device_time + int(round(interval / TICK)) - sample.device_time) % WRAP
+                return time_shift, seq_shift, device_shift
+
+        @property
+        def connected(self):
+                return True
+
+        @property
+        def finished(self):
+                """True once every recorded sample was read."""
+                return self.port.finished and self.port.next is None and not self.port.pending
+
+        def clock(self):
+                """Session time of the last sample played, used as the clock of the acquisition instead of the wall clock."""
+                return self.port.time or 0.0
+
+        def start(self):
+                pass
+
+        def close(self):
+                pass
+
+        def get(self, timeout=None):
+                return self.port
+
+        def lost(self, port):
+                pass
+
+def parse_speed(value):
+        """argparse type of the playback speed: a number, or "max" (None)."""
+        if value == 'max':
+                return None
+        speed = float(value)
+        if speed <= 0:
+                raise argparse.ArgumentTypeError("the speed must be positive or max")
+        return speed
+
+if __name__ == "__main__":
+        from acquisition import Acquisition, STREAM
+        from alarms import AlarmEngine
+        parser = argparse.ArgumentParser(description="Replay recorded ATMO-Vent sessions through the acquisition pipeline")
+        parser.add_argument('paths', nargs='+', help="session files (.atmo), played in order")
+        parser.add_argument('--speed', type=parse_speed, default=None, help="playback speed, e.g. 1 or 10, or max (default max)")
+        group = parser.add_argument_group("settings checked by the alarm rules")
+        group.add_argument('--mode', choices=('C', 'P', 'F'), default='C', help="ventilation mode (default C)")
+        group.add_argument('--tidal-volume', type=int, default=400, help="mL (default 400)")
+        group.add_argument('--ie', type=int, default=5, help="I:E setting, 1:2.<ie> (default 5)")
+        group.add_argument('--pip', type=int, default=40, help="cm H2O (default 40)")
+        group.add_argument('--resistance-limit', type=float, default=None, help="cm H2O/L/s (default disabled)")
+        args = parser.parse_args()
+        replay = SessionReplay(args.paths, args.speed)
+        alarms = AlarmEngine()
+        alarms.configure(args.mode, pip=args.pip, tidal_volume=args.tidal_volume, IE=float('2.' + str(args.ie)), resistance_limit=args.resistance_limit)
+        acquisition = Acquisition(replay, STREAM, 0.0, alarms=alarms, clock=replay.clock)
+        counts = {'samples': 0, 'breaths': 0}
+        def publish(batch):
+                counts['samples'] += len(batch.samples)
+                counts['breaths'] += len(batch.breaths)
+                for name in batch.alarm:
+                        print("%.2f s: %s" % (alarms.on.get(name, batch.times[-1]), name))
+        started = time.perf_counter()
+        acquisition.run(publish, lambda: replay.finished)
+        elapsed = time.perf_counter() - started
+        print("%d samples, %d breaths, %d alarms in %.2f s (%.0f samples/s, %.2f s of session)" % (counts['samples'], counts['breaths'],
+                alarms.raised, elapsed, counts['samples'] / elapsed if elapsed else 0, replay.clock()))
+        print(acquisition.latency.summary())
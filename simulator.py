@@ -0,0 +1,264 @@
+"""
+Arduino simulator for running ATMO-Vent without hardware.
+
+It opens a Linux pseudo-terminal and speaks the same protocol as the firmware, so main.py (or any other user of a serial
+port) can be pointed to it instead of /dev/serial/by-id/...:
+        - "C,freq,tidal_volume,insp_pause,IE,PIP\\n": start continuous mandatory ventilation
+        - "22C,...\\n": update the continuous mandatory ventilation settings
+        - "P,freq,tidal_volume,insp_pause,trigger,PIP\\n" / "F,...\\n": start assisted control (pressure/flow trigger)
+        - "22\\n": stop (also stops streaming)
+        - "1": answer with one sample (polled mode)
+        - "S\\n": send samples continuously at the configured rate (stream mode)
+Samples are sent as ASCII lines or binary frames (see telemetry.py), optionally with device timestamps from a clock that
+drifts, and faults can be injected.
+
+Usage:
+        $ python3 simulator.py --rate 100 --link /tmp/arduino
+        #change the "self.arduino_id" variable in main.py to /tmp/arduino (or the pty path printed)
+"""
+import argparse
+import math
+import os
+import random
+import select
+import threading
+import time
+import tty
+from telemetry import Sample, encode_frame, encode_line
+
+FAULTS = ('P00', '0V0', '00F', 'garbage')
+
+class ArduinoSimulator(object):
+        '''
+        Simulated Arduino behind a pseudo-terminal.
+
+        The patient is a single compartment lung (compliance mL/cm H2O, resistance cm H2O/L/s) ventilated with constant
+        inspiratory flow, an optional inspiratory pause and passive expiration down to PEEP.
+
+        :param rate: samples per second sent in stream mode
+        :param binary: send binary frames instead of ASCII lines
+        :param fault_rate: probability of injecting a fault in each sample
+        :param faults: faults to choose from: "P00", "0V0" and "00F" set the error field, "garbage" sends a corrupted line
+        :param compliance: lung compliance (mL/cm H2O)
+        :param resistance: airway resistance (cm H2O/L/s)
+        :param peep: PEEP (cm H2O)
+        :param noise: standard deviation of the noise added to pressure and flow
+        :param seed: seed of the random generator, for reproducible runs
+        :param timestamps: send the device timestamp (micros()) of every sample
+        :param clock_drift: drift of the simulated device clock in ppm (positive: slower than the host)
+        '''
+
+        def __init__(self, rate=100, binary=False, fault_rate=0.0, faults=FAULTS, compliance=30.0, resistance=10.0, peep=5.0, noise=0.1, seed=None,
+                        timestamps=False, clock_drift=0.0):
+                self.rate = rate
+                self.binary = binary
+                self.timestamps = timestamps
+                self.clock_drift = clock_drift
+                self.fault_rate = fault_rate
+                self.faults = tuple(faults)
+                self.compliance = compliance
+                self.resistance = resistance
+                self.peep = peep
+                self.noise = noise
+                self.random = random.Random(seed)
+                #Ventilation settings, changed by the commands
+                self.mode = None #"C", "P", "F" or None when stopped
+                self.frequency = 20.0
+                self.tidal_volume = 400.0
+                self.insp_pause = 0.0
+                self.IE = 2.0
+                self.pip_limit = 40.0
+                self.streaming = False
+                #Statistics
+                self.seq = 0
+                self.sent = 0 #Samples sent
+                self.dropped = 0 #Samples that did not fit in the pty buffer (the host was not reading)
+                self.commands = [] #Commands received, in order
+                self.pending_faults = []
+                self.sent_at = None #If set to a dict, the time.monotonic() at which each sequence number (mod 65536) was sent is stored in it
+                self.master = None
+                self.slave = None
+                self.path = None
+                self.link = None
+                self._thread = None
+                self._stopping = False
+
+        def start(self, link=None):
+                """Open the pseudo-terminal and start answering in a background thread. Return the path of the port."""
+                self.master, self.slave = os.openpty()
+                tty.setraw(self.slave) #No echo and no newline translation, like a real serial port
+                os.set_blocking(self.master, False)
+                self.path = os.ttyname(self.slave)
+                if link is not None:
+                        if os.path.lexists(link):
+                                os.unlink(link)
+                        os.symlink(self.path, link)
+                        self.link = link
+                self.t0 = time.monotonic()
+                self._stopping = False
+                self._thread = threading.Thread(target=self._run, name="ArduinoSimulator")
+                self._thread.daemon = True
+                self._thread.start()
+                return link or self.path
+
+        def stop(self):
+                """Stop answering and close the pseudo-terminal."""
+                self._stopping = True
+                if self._thread is not None:
+                        self._thread.join()
+                        self._thread = None
+                if self.link is not None and os.path.islink(self.link):
+                        os.unlink(self.link)
+                for fd in (self.master, self.slave):
+                        if fd is not None:
+                                os.close(fd)
+                self.master = self.slave = None
+
+        def inject(self, fault):
+                """Inject fault ("P00", "0V0", "00F" or "garbage") in the next sample sent."""
+                if fault not in FAULTS:
+                        raise ValueError("Unknown fault %r, expected one of %s" % (fault, ", ".join(FAULTS)))
+                self.pending_faults.append(fault)
+
+        def sample(self, t):
+                """Simulated sample at time t (seconds since start)."""
+                peep = self.peep
+                if self.mode is None:
+                        pressure, flow, volume = peep, 0.0, 0.0
+                else:
+                        period = 60.0 / self.frequency
+                        inspiration = period / (1 + self.IE)
+                        pause = min(self.insp_pause, inspiration * 0.5)
+                        flow_time = inspiration - pause
+                        phase = t % period
+                        if phase < flow_time: #Constant inspiratory flow
+                                flow_ls = self.tidal_volume / 1000 / flow_time
+                                volume = flow_ls * phase * 1000
+                                pressure = peep + self.resistance * flow_ls + volume / self.compliance
+                        elif phase < inspiration: #Inspiratory pause
+                                flow_ls = 0.0
+                                volume = self.tidal_volume
+                                pressure = peep + volume / self.compliance
+                        else: #Passive expiration
+                                tau = self.resistance * self.compliance / 1000
+                                decay = math.exp(-(phase - inspiration) / tau)
+                                volume = self.tidal_volume * decay
+                                flow_ls = -volume / 1000 / tau
+                                pressure = peep + volume / self.compliance + self.resistance * flow_ls
+                        pressure = min(pressure, self.pip_limit)
+                        flow = flow_ls * 60 #L/min
+                pressure += self.random.gauss(0, self.noise)
+                flow += self.random.gauss(0, self.noise)
+                flow_peak = self.tidal_volume / 1000 / max(60.0 / self.frequency / (1 + self.IE) - self.insp_pause, 0.05)
+                plateau = peep + self.tidal_volume / self.compliance
+                pip = min(plateau + self.resistance * flow_peak, self.pip_limit)
+                return Sample(round(pressure, 2), round(flow, 2), round(volume, 2), self.frequency, self.IE, round(pip, 2), round(plateau, 2), peep, '000', None, None)
+
+        def _send(self, t):
+                fault = None
+                if self.pending_faults:
+                        fault = self.pending_faults.pop(0)
+                elif self.fault_rate and self.random.random() < self.fault_rate:
+                        fault = self.random.choice(self.faults)
+                if fault == 'garbage':
+                        data = bytes(self.random.randrange(32, 127) for i in range(self.random.randrange(1, 40))) + b'\n'
+                else:
+                        sample = self.sample(t)
+                        if fault is not None:
+                                sample = sample._replace(error_pvf=fault)
+                        if self.timestamps:
+                                sample = sample._replace(device_time=int(t * (1 - self.clock_drift * 1e-6) * 1e6) & 0xFFFFFFFF)
+                        data = encode_frame(sample, self.seq) if self.binary else encode_line(sample)
+                if self.sent_at is not None:
+                        self.sent_at[self.seq & 0xFFFF] = time.monotonic()
+                self.seq += 1
+                try:
+                        os.write(self.master, data)
+                        self.sent += 1
+                except BlockingIOError:
+                        self.dropped += 1
+                except OSError: #Nobody has the port open
+                        self.dropped += 1
+
+        def _command(self, line):
+                self.commands.append(line)
+                fields = line.split(',')
+                name = fields[0]
+                if name == 'S':
+                        self.streaming = True
+                elif name == '22' and len(fields) == 1:
+                        self.mode = None
+                        self.streaming = False
+                elif name in ('C', '22C', 'P', 'F') and len(fields) == 6:
+                        try:
+                                values = [float(value) for value in fields[1:]]
+                        except ValueError:
+                                return
+                        self.mode = name[-1]
+                        self.frequency = values[0] or self.frequency
+                        self.tidal_volume = values[1]
+                        self.insp_pause = values[2]
+                        if self.mode == 'C': #The GUI shows the I:E setting as "1:2." followed by the value
+                                self.IE = float('2.' + fields[4].split('.')[0])
+                        self.pip_limit = values[4] if values[4] > 0 else self.pip_limit
+
+        def _run(self):
+                buffer = b''
+                next_sample = time.monotonic()
+                while not self._stopping:
+                        now = time.monotonic()
+                        timeout = max(0.0, next_sample - now) if self.streaming else 0.05
+                        readable, _, _ = select.select([self.master], [], [], min(timeout, 0.05))
+                        if readable:
+                                try:
+                                        buffer += os.read(self.master, 4096)
+                                except (BlockingIOError, OSError):
+                                        pass
+                                while buffer:
+                                        if buffer[:1] == b'1': #Poll, not followed by a newline
+                                                buffer = buffer[1:]
+                                                self._send(time.monotonic() - self.t0)
+                                                continue
+                                        if buffer[:1] in (b'\n', b'\r'):
+                                                buffer = buffer[1:]
+                                                continue
+                                        newline = buffer.find(b'\n')
+                                        if newline < 0:
+                                                break
+                                        self._command(buffer[:newline].decode('utf-8', 'replace').strip())
+                                        buffer = buffer[newline + 1:]
+                        if self.streaming:
+                                now = time.monotonic()
+                                if now >= next_sample:
+                                        self._send(now - self.t0)
+                                        next_sample += 1.0 / self.rate
+                                        if next_sample < now: #Do not try to catch up after a stall
+                                                next_sample = now + 1.0 / self.rate
+                        else:
+                                next_sample = time.monotonic()
+
+if __name__ == "__main__":
+        parser = argparse.ArgumentParser(description="Simulated ATMO-Vent Arduino on a pseudo-terminal")
+        parser.add_argument('--rate', type=float, default=100, help="samples per second in stream mode (default 100)")
+        parser.add_argument('--binary', action='store_true', help="send binary frames instead of ASCII lines")
+        parser.add_argument('--fault-rate', type=float, default=0.0, help="probability of a fault in each sample (default 0)")
+        parser.add_argument('--faults', default=','.join(FAULTS), help="comma separated faults to inject (default %s)" % ','.join(FAULTS))
+        parser.add_argument('--compliance', type=float, default=30.0, help="lung compliance in mL/cm H2O (default 30)")
+        parser.add_argument('--resistance', type=float, default=10.0, help="airway resistance in cm H2O/L/s (default 10)")
+        parser.add_argument('--peep', type=float, default=5.0, help="PEEP in cm H2O (default 5)")
+        parser.add_argument('--seed', type=int, default=None, help="random seed")
+        parser.add_argument('--timestamps', action='store_true', help="send the device timestamp of every sample")
+        parser.add_argument('--clock-drift', type=float, default=0.0, help="drift of the device clock in ppm (default 0)")
+        parser.add_argument('--link', default=None, help="also make the port available at this path (symbolic link)")
+        args = parser.parse_args()
+        simulator = ArduinoSimulator(args.rate, args.binary, args.fault_rate, args.faults.split(','), args.compliance, args.resistance, args.peep, seed=args.seed,
+                timestamps=args.timestamps, clock_drift=args.clock_drift)
+        print("Simulated Arduino at %s" % simulator.start(args.link))
+        try:
+                while True:
+                        time.sleep(1)
+        except KeyboardInterrupt:
+                pass
+        finally:
+                simulator.stop()
+                print("Sent %d samples (%d dropped)" % (simulator.sent, simulator.dropped))
@@ -0,0 +1,250 @@
+"""
+Decoding of the telemetry sent by the Arduino.
+
+Two formats are understood and can be mixed in the same byte stream:
+        - ASCII CSV lines (old firmware): "pressure,flow,volume,frequency,IE,PIP,plateau,PEEP,error\\n", optionally followed
+          by ",micros" (the device timestamp, see below)
+        - Binary frames (new firmware): a fixed-size little-endian struct starting with a sync word and
+          ending with a CRC-16/CCITT of everything before it. Version 2 frames also carry the device timestamp.
+The device timestamp is the micros() of the Arduino when the sample was measured (32 bits, it wraps around every 71
+minutes), see clock.DeviceClock.
+The sync word starts with 0xA5, a byte that can never appear in an ASCII line, so the decoder does not
+need to be told which format the firmware speaks.
+"""
+import binascii
+import struct
+from collections import deque, namedtuple
+
+POLLED = 'polled' #The host asks for every sample writing "1" (works with every firmware)
+STREAM = 'stream' #The Arduino sends samples continuously after receiving "S"
+MODES = (POLLED, STREAM) #Acquisition modes, see acquisition.SerialReader
+
+CSV_FIELDS = 9 #Amount of comma separated values in one ASCII line (one more with the device timestamp)
+
+#Binary frame layout: sync word, sequence number, pressure, flow, volume, frequency, IE, PIP, plateau, PEEP,
+#error flags (bit 0: pressure, bit 1: volume, bit 2: flow) and the CRC of all the previous bytes.
+FRAME_SYNC = b'\xa5\x5a'
+FRAME_HEADER = struct.Struct('<2sH8fB')
+FRAME_CRC = struct.Struct('<H')
+FRAME_SIZE = FRAME_HEADER.size + FRAME_CRC.size
+#Version 2: the same with the device timestamp after the sequence number
+FRAME2_SYNC = b'\xa5\x5b'
+FRAME2_HEADER = struct.Struct('<2sHI8fB')
+FRAME2_SIZE = FRAME2_HEADER.size + FRAME_CRC.size
+MAX_LINE = 256 #Longer runs of bytes without a newline are garbage, not a CSV line
+SEQ_MODULO = 1 << 16 #Sequence numbers of the binary frames wrap around
+
+Sample = namedtuple('Sample', ['pressure', 'flow', 'volume', 'frequency', 'IE', 'pip', 'plateau', 'peep', 'error_pvf', 'seq', 'device_time'])
+Sample.__doc__ = '''
+One telemetry sample. error_pvf keeps the firmware convention: "000" when everything is fine, "P00" if pressure
+fails, "0V0" if volume, "00F" if flow, "PVF" if all of them. seq is None for ASCII lines, device_time (micros() of the
+Arduino) is None if the firmware does not send it.
+'''
+
+def crc16(data):
+        """CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) of data, as computed by the firmware."""
+        return binascii.crc_hqx(data, 0xFFFF)
+
+def error_flags_to_pvf(flags):
+        """Convert the binary error bit field into the "PVF" string used by the ASCII protocol."""
+        return ('P' if flags & 1 else '0') + ('V' if flags & 2 else '0') + ('F' if flags & 4 else '0')
+
+def pvf_to_error_flags(error_pvf):
+        """Inverse of error_flags_to_pvf()."""
+        return (1 if error_pvf[0:1] == 'P' else 0) | (2 if error_pvf[1:2] == 'V' else 0) | (4 if error_pvf[2:3] == 'F' else 0)
+
+def encode_frame(sample, seq):
+        """
+        Build the binary frame of a sample, as the firmware sends it (version 2 if it has a device timestamp). Used by the
+        simulator and the benchmarks.
+        """
+        values = (sample.pressure, sample.flow, sample.volume, sample.frequency, sample.IE, sample.pip, sample.plateau, sample.peep,
+                pvf_to_error_flags(sample.error_pvf))
+        if sample.device_time is None:
+                header = FRAME_HEADER.pack(FRAME_SYNC, seq & 0xFFFF, *values)
+        else:
+                header = FRAME2_HEADER.pack(FRAME2_SYNC, seq & 0xFFFF, sample.device_time & 0xFFFFFFFF, *values)
+        return header + FRAME_CRC.pack(crc16(header))
+
+def encode_line(sample):
+        """Build the ASCII CSV line of a sample, as the old firmware sends it (with the device timestamp if it has one)."""
+        line = '%.2f,%.2f,%.2f,%.2f,%.2f,%.2f,%.2f,%.2f,%s' % (sample.pressure, sample.flow, sample.volume, sample.frequency,
+                sample.IE, sample.pip, sample.plateau, sample.peep, sample.error_pvf)
+        if sample.device_time is not None:
+                line += ',%d' % (sample.device_time & 0xFFFFFFFF)
+        return (line + '\n').encode('utf-8')
+
+def parse_line(line):
+        """
+        Parse one ASCII CSV line (without the trailing newline). Raises ValueError if it does not have the
+        expected amount of fields or a value is not a number.
+        """
+        fields = line.decode('utf-8').rstrip('\r').split(',')
+        if len(fields) != CSV_FIELDS and len(fields) != CSV_FIELDS + 1:
+                raise ValueError("expected %d or %d fields, received %d: %r" % (CSV_FIELDS, CSV_FIELDS + 1, len(fields), line))
+        return Sample(float(fields[0]), float(fields[1]), float(fields[2]), float(fields[3]), float(fields[4]),
+                float(fields[5]), float(fields[6]), float(fields[7]), fields[8].strip(), None,
+                int(fields[9]) if len(fields) > CSV_FIELDS else None)
+
+class FrameDecoder(object):
+        '''
+        Incremental decoder of the Arduino byte stream.
+
+        Bytes are passed to feed() in chunks of any size (one serial read). Every complete binary frame or
+        ASCII line found is decoded and returned; incomplete data is kept for the next call. Rejected input is
+        never silently lost: it is counted in the attributes below and the reason of the last rejection is
+        kept in last_error.
+        - frames: binary frames decoded
+        - lines: ASCII lines decoded
+        - malformed: ASCII lines rejected (wrong amount of fields, not a number, not UTF-8) and garbage bytes
+        - wrong_fields: the ones of the malformed lines that did not have CSV_FIELDS fields (or one more)
+        - crc_errors: binary frames rejected because of their CRC
+        '''
+
+        def __init__(self):
+                self.buffer = bytearray()
+                self.frames = 0
+                self.lines = 0
+                self.malformed = 0
+                self.wrong_fields = 0
+                self.crc_errors = 0
+                self.last_error = None
+
+        def reset(self):
+                """Discard any partial frame or line (e.g. after flushing the serial input)."""
+                del self.buffer[:]
+
+        def feed(self, data):
+                """Append data to the internal buffer and return the list of Samples that could be decoded."""
+                buf = self.buffer
+                buf += data
+                samples = []
+                end = len(buf)
+                pos = 0
+                while pos < end:
+                        if buf[pos] == 0xA5:
+                                if end - pos < 2:
+                                        break #Wait for the rest of the sync word
+                                version = buf[pos + 1]
+                                if version == 0x5A:
+                                        header = FRAME_HEADER
+                                elif version == 0x5B:
+                                        header = FRAME2_HEADER
+                                else:
+                                        self._reject("bad sync word")
+                                        pos += 1
+                                        continue
+                                crc_end = pos + header.size
+                                if end - crc_end < FRAME_CRC.size:
+                                        break #Wait for the rest of the frame
+                                if crc16(buf[pos:crc_end]) != FRAME_CRC.unpack_from(buf, crc_end)[0]:
+                                        self.crc_errors += 1
+                                        self.last_error = "CRC mismatch in frame"
+                                        #Resynchronize on the next sync word, the rest of the frame is not counted again as garbage
+                                        sync = buf.find(b'\xa5', pos + 1)
+                                        while 0 <= sync < end - 1 and buf[sync + 1] not in (0x5A, 0x5B): #0xA5 inside the values
+                                                sync = buf.find(b'\xa5', sync + 1)
+                                        pos = sync if sync >= 0 else end
+                                        continue
+                                if header is FRAME_HEADER:
+                                        _, seq, p, f, v, freq, ie, pip, plateau, peep, flags = header.unpack_from(buf, pos)
+                                        device_time = None
+                                else:
+                                        _, seq, device_time, p, f, v, freq, ie, pip, plateau, peep, flags = header.unpack_from(buf, pos)
+                                samples.append(Sample(p, f, v, freq, ie, pip, plateau, peep, error_flags_to_pvf(flags), seq, device_time))
+                                self.frames += 1
+                                pos = crc_end + FRAME_CRC.size
+                                continue
+                        newline = buf.find(b'\n', pos)
+                        sync = buf.find(b'\xa5', pos, end if newline < 0 else newline)
+                        if sync >= 0: #A binary frame starts before the end of the line, what we have so far is garbage
+                                self._reject("garbage before frame: %r" % bytes(buf[pos:sync]))
+                                pos = sync
+                                continue
+                        if newline < 0:
+                                if end - pos > MAX_LINE:
+                                        self._reject("line too long")
+                                        pos = end
+                                break #Wait for the rest of the line
+                        line = bytes(buf[pos:newline])
+                        pos = newline + 1
+                        if not line.strip():
+                                continue
+                        try:
+                                samples.append(parse_line(line))
+                                self.lines += 1
+                        except ValueError as e: #Also catches UnicodeDecodeError
+                                if line.count(b',') not in (CSV_FIELDS - 1, CSV_FIELDS):
+                                        self.wrong_fields += 1
+                                self._reject(str(e))
+                del buf[:pos]
+                return samples
+
+        def _reject(self, reason):
+                self.malformed += 1
+                self.last_error = reason
+
+class SequenceChecker(object):
+        '''
+        Detects the samples lost between the ones received.
+
+        Binary frames carry a sequence number: a jump of n means that n - 1 samples were lost (corrupted frames, bytes
+        dropped by the serial port). Jumps backwards or of more than half the range of the numbers are taken as a restart of
+        the firmware, not as lost samples. ASCII lines have no sequence number, so every line rejected by the decoder is
+        counted as a lost sample instead; where it was inside the read is not known, its gap is placed before the first
+        sample of the read.
+
+        The fraction of samples lost over the last window seconds is given by loss(), for the data loss alarm.
+
+        :param window: seconds over which loss() is computed
+        '''
+
+        def __init__(self, window=2.0):
+                self.window = window
+                self.expected = None #Sequence number of the next sample, None if not known
+                self.lost = 0 #Samples lost
+                self.gaps = 0 #Places where samples were lost
+                self.recent = deque() #(time, samples received, samples lost) of the reads in the last window
+                self.received = 0 #Samples received in recent
+                self.missing = 0 #Samples lost in recent
+
+        def reset(self):
+                """Forget the expected sequence number (the Arduino was reconnected and rebooted)."""
+                self.expected = None
+
+        def check(self, samples, now, rejected=0):
+                """
+                Return the gaps before the samples of a read received at now, as a list of (index of the sample after the
+                gap, samples lost). rejected is the amount of lines rejected by the decoder since the previous read.
+                """
+                gaps = []
+                if rejected and samples[0].seq is None: #ASCII lines
+                        gaps.append((0, rejected))
+                expected = self.expected
+                for i, sample in enumerate(samples):
+                        seq = sample.seq
+                        if seq is None:
+                                expected = None
+                                continue
+                        if expected is not None and seq != expected:
+                                missing = (seq - expected) % SEQ_MODULO
+                                if missing < SEQ_MODULO // 2:
+                                        gaps.append((i, missing))
+                        expected = (seq + 1) % SEQ_MODULO
+                self.expected = expected
+                lost = sum(missing for i, missing in gaps)
+                self.lost += lost
+                self.gaps += len(gaps)
+                self.recent.append((now, len(samples), lost))
+                self.received += len(samples)
+                self.missing += lost
+                while self.recent[0][0] < now - self.window:
+                        t, received, missing = self.recent.popleft()
+                        self.received -= received
+                        self.missing -= missing
+                return gaps
+
+        def loss(self):
+                """Fraction of the samples lost in the last window seconds (up to the last read)."""
+                total = self.received + self.missing
+                return self.missing / total if total else 0.0
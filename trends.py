@@ -0,0 +1,151 @@
+"""
+History of the metrics of every breath, with min/mean/max rollups at several resolutions for the trend view.
+"""
+import numpy as np
+from metrics import Metrics
+
+FIELDS = Metrics._fields
+#(seconds per bucket, buckets kept): at one breath every 2-6 s, the 1 s rollup keeps several hours, the 1 min rollup two
+#days and the 10 min rollup a week
+RESOLUTIONS = ((1, 4096), (60, 2880), (600, 1008))
+
+def metric_values(metrics):
+        """Values of a metrics.Metrics as a float array, NaN for the ones that are None."""
+        return np.array([np.nan if value is None else value for value in metrics], dtype=float)
+
+class Rollup(object):
+        '''
+        Min, mean and max of every metric over fixed time buckets, updated incrementally with each breath: a breath only
+        touches the newest bucket (or starts a new one), nothing is ever recomputed. Only buckets with at least one breath
+        are stored.
+
+        As in waveform.WaveformBuffer, every bucket is written twice in arrays twice as long as the capacity, so the buckets
+        in order are always a contiguous slice and window() returns views (except the means, computed for the buckets of
+        the window only).
+
+        :param resolution: seconds per bucket
+        :param capacity: maximum amount of buckets kept, the oldest ones are overwritten
+        '''
+
+        def __init__(self, resolution, capacity):
+                self.resolution = resolution
+                self.capacity = capacity
+                n = len(FIELDS)
+                self.time = np.zeros(2 * capacity) #Start of each bucket
+                self.count = np.zeros((n, 2 * capacity)) #Breaths with a value of each metric in each bucket
+                self.sum = np.zeros((n, 2 * capacity))
+                self.min = np.zeros((n, 2 * capacity))
+                self.max = np.zeros((n, 2 * capacity))
+                self.reset()
+
+        def __len__(self):
+                return self.size
+
+        def reset(self):
+                self.head = 0 #Position where the next bucket will be written
+                self.size = 0 #Amount of buckets stored
+                self.bucket = None #Index (start time / resolution) of the newest bucket
+
+        def add(self, t, values):
+                """Add the metric values (float array, NaN if unknown) of a breath that ended at t."""
+                bucket = int(t // self.resolution)
+                valid = ~np.isnan(values)
+                if bucket == self.bucket:
+                        i = self.head - 1 if self.head else self.capacity - 1
+                        count = self.count[:, i] + valid
+                        total = self.sum[:, i] + np.where(valid, values, 0.0)
+                        low = np.fmin(self.min[:, i], values)
+                        high = np.fmax(self.max[:, i], values)
+                else:
+                        i = self.head
+                        self.head = i + 1 if i + 1 < self.capacity else 0
+                        self.size = min(self.size + 1, self.capacity)
+                        self.bucket = bucket
+                        count = valid.astype(float)
+                        total = np.where(valid, values, 0.0)
+                        low = high = values
+                        self.time[i] = self.time[i + self.capacity] = bucket * self.resolution
+                for j in (i, i + self.capacity):
+                        self.count[:, j] = count
+                        self.sum[:, j] = total
+                        self.min[:, j] = low
+                        self.max[:, j] = high
+
+        def window(self, field, seconds, end=None):
+                """
+                Return (time, min, mean, max) of the metric field in the buckets of the seconds before end (the newest bucket by
+                default), oldest first. Buckets without any value of the metric are NaN.
+                """
+                k = FIELDS.index(field)
+                stop = self.head + self.capacity
+                start = stop - self.size
+                if self.size:
+                        times = self.time[start:stop]
+                        if end is None:
+                                end = times[-1]
+                        start += int(np.searchsorted(times, end - seconds))
+                        stop -= len(times) - int(np.searchsorted(times, end, side='right'))
+                count = self.count[k, start:stop]
+                mean = np.divide(self.sum[k, start:stop], count, out=np.full(stop - start, np.nan), where=count > 0)
+                return self.time[start:stop], self.min[k, start:stop], mean, self.max[k, start:stop]
+
+class TrendStore(object):
+        '''
+        Metrics of every breath since the app started, and their Rollup at each resolution.
+
+        add() costs the same whatever the amount of history, and window() picks the finest rollup that draws the requested
+        span in at most max_points buckets, so the trend view of 12 or 24 hours never goes through the breaths themselves.
+
+        :param capacity: maximum amount of breaths kept (the oldest ones are overwritten)
+        :param resolutions: ((seconds per bucket, buckets kept), ...), finest first
+        :param max_points: maximum amount of buckets returned by window()
+        '''
+
+        def __init__(self, capacity=100000, resolutions=RESOLUTIONS, max_points=2000):
+                self.capacity = capacity
+                self.times = np.zeros(capacity) #End time of each breath
+                self.values = np.zeros((capacity, len(FIELDS)))
+                self.head = 0
+                self.size = 0
+                self.total = 0 #Breaths added (tells readers if something changed)
+                self.rollups = [Rollup(resolution, buckets) for resolution, buckets in resolutions]
+                self.max_points = max_points
+
+        def __len__(self):
+                return self.size
+
+        def add(self, t, metrics):
+                """Add the metrics.Metrics of a breath that ended at t (a time.time())."""
+                values = metric_values(metrics)
+                i = self.head
+                self.times[i] = t
+                self.values[i] = values
+                self.head = i + 1 if i + 1 < self.capacity else 0
+                self.size = min(self.size + 1, self.capacity)
+                self.total += 1
+                for rollup in self.rollups:
+                        rollup.add(t, values)
+
+        def breaths(self, n=None):
+                """Return (times, values) of the last n breaths (all by default), oldest first. values has one column per metric."""
+                n = self.size if n is None else min(n, self.size)
+                index = (self.head - n + np.arange(n)) % self.capacity
+                return self.times[index], self.values[index]
+
+        def rollup(self, seconds):
+                """Finest rollup that covers seconds in at most max_points buckets (the coarsest one if none does)."""
+                for rollup in self.rollups:
+                        if seconds / rollup.resolution <= self.max_points and rollup.capacity * rollup.resolution >= seconds:
+                                return rollup
+                return self.rollups[-1]
+
+        def window(self, field, seconds, end=None):
+                """Return (time, min, mean, max) of the metric field over the last seconds, see Rollup.window()."""
+                return self.rollup(seconds).window(field, seconds, end)
+
+        def reset(self):
+                self.head = 0
+                self.size = 0
+                self.total = 0
+                for rollup in self.rollups:
+                        rollup.reset()
@@ -0,0 +1,146 @@
+"""
+Storage of the waveform history shown in the plots, and its min/max decimation for long windows.
+"""
+import numpy as np
+
+class WaveformBuffer(object):
+        '''
+        Fixed-capacity ring buffer with the time, pressure, volume and flow of the last samples.
+
+        Every sample is written twice, at position i and i + capacity of arrays twice as long as the capacity. This way
+        the samples in order (oldest to newest) are always a contiguous slice, and view()/window() return NumPy views
+        of the buffer instead of copies. Appending a sample is O(1) and never allocates.
+        The returned views are only meant to be passed straight to setData(): they are overwritten by later appends.
+
+        :param capacity: maximum amount of samples kept
+        '''
+        TIME, PRESSURE, VOLUME, FLOW = range(4)
+
+        def __init__(self, capacity):
+                self.capacity = capacity
+                self.data = np.zeros((4, 2 * capacity))
+                self.head = 0 #Position where the next sample will be written
+                self.count = 0 #Amount of samples stored
+                self.total = 0 #Amount of samples appended since the last reset (tells readers if something changed)
+                self.resets = 0 #Amount of resets
+
+        def __len__(self):
+                return self.count
+
+        def append(self, t, pressure, volume, flow):
+                """Add a sample, overwriting the oldest one once the buffer is full."""
+                i = self.head
+                column = (t, pressure, volume, flow)
+                self.data[:, i] = column
+                self.data[:, i + self.capacity] = column
+                self.head = i + 1 if i + 1 < self.capacity else 0
+                if self.count < self.capacity:
+                        self.count += 1
+                self.total += 1
+
+        def extend(self, times, samples, gaps=()):
+                """
+                Add the samples (telemetry.Sample) received at times. Where samples were lost (gaps, see acquisition.Batch) a
+                NaN point is added first, so the plots draw a break instead of a line bridging the lost data.
+                """
+                after = set(index for index, missing in gaps)
+                for k, (t, sample) in enumerate(zip(times, samples)):
+                        if k in after:
+                                previous = self.data[0, self.head + self.capacity - 1] if self.count else t
+                                self.append((previous + t) / 2, np.nan, np.nan, np.nan)
+                        self.append(t, sample.pressure, sample.volume, sample.flow)
+
+        def view(self):
+                """Return the (time, pressure, volume, flow) views of all the stored samples, oldest first."""
+                end = self.head + self.capacity
+                start = end - self.count
+                data = self.data
+                return data[0, start:end], data[1, start:end], data[2, start:end], data[3, start:end]
+
+        def window(self, seconds):
+                """Return the (time, pressure, volume, flow) views of the samples of the last given seconds, oldest first."""
+                end = self.head + self.capacity
+                start = end - self.count
+                data = self.data
+                if self.count:
+                        start += int(np.searchsorted(data[0, start:end], data[0, end - 1] - seconds))
+                return data[0, start:end], data[1, start:end], data[2, start:end], data[3, start:end]
+
+        def drop(self, n):
+                """Remove the n newest samples (total is not decreased, it still tells readers that something changed)."""
+                n = min(n, self.count)
+                self.head = (self.head - n) % self.capacity
+                self.count -= n
+                self.total += 1
+
+        def reset(self):
+                """Forget all the samples (the memory is kept for the next acquisition)."""
+                self.head = 0
+                self.count = 0
+                self.total = 0
+                self.resets += 1
+
+class MinMaxDecimator(object):
+        '''
+        Min/max decimation of the samples of a WaveformBuffer, to plot long windows with a constant amount of points.
+
+        Time is divided in buckets of seconds / buckets seconds (about one per pixel of the plot), and every bucket is stored
+        as two points at its start time: the minimum and the maximum of each signal. Drawn as a line, each bucket becomes a
+        vertical segment covering every value it had, so a spike of a single sample is never hidden however long the window.
+        A bucket with a NaN point (samples lost, see WaveformBuffer.extend()) is NaN, so the break is kept too.
+        The buckets are aligned to multiples of their width, so a bucket never changes once a later one starts: update() only
+        reduces the samples added since the previous call and merges them with the last (open) bucket.
+
+        :param seconds: length of the window
+        :param buckets: amount of buckets in the window
+        '''
+
+        def __init__(self, seconds, buckets=1024):
+                self.seconds = seconds
+                self.buckets = buckets
+                self.width = float(seconds) / buckets
+                self.points = WaveformBuffer(2 * (buckets + 2)) #(time, pressure, volume, flow) of the min and max of each bucket
+                self.reset()
+
+        def reset(self):
+                self.points.reset()
+                self.bucket = None #Index (start time / width) of the open bucket
+                self.low = None #Minimum and maximum of pressure, volume and flow in the open bucket
+                self.high = None
+                self.seen = 0 #waveform.total at the last update
+                self.resets = None #waveform.resets at the last update
+
+        def update(self, waveform):
+                """Add the samples appended to waveform since the last call."""
+                if waveform.resets != self.resets: #The waveform was reset (or it is the first update)
+                        self.reset()
+                        self.resets = waveform.resets
+                new = min(waveform.total - self.seen, len(waveform))
+                self.seen = waveform.total
+                if new <= 0:
+                        return
+                t, pressure, volume, flow = waveform.view()
+                t = t[-new:]
+                values = np.vstack((pressure[-new:], volume[-new:], flow[-new:]))
+                index = np.floor(t / self.width).astype(np.int64)
+                starts = np.flatnonzero(np.concatenate(([True], index[1:] != index[:-1])))
+                low = np.minimum.reduceat(values, starts, axis=1)
+                high = np.maximum.reduceat(values, starts, axis=1)
+                points = self.points
+                for j, start in enumerate(starts): #One iteration per bucket touched, a few per frame
+                        bucket = int(index[start])
+                        if bucket == self.bucket: #The open bucket goes on: merge and rewrite its two points
+                                self.low = np.minimum(self.low, low[:, j])
+                                self.high = np.maximum(self.high, high[:, j])
+                                points.drop(2)
+                        else:
+                                self.bucket = bucket
+                                self.low = low[:, j]
+                                self.high = high[:, j]
+                        x = bucket * self.width
+                        points.append(x, *self.low)
+                        points.append(x, *self.high)
+
+        def window(self):
+                """Return the (time, pressure, volume, flow) views of the points of the window, oldest first, like WaveformBuffer.window()."""
+                return self.points.window(self.seconds)